@@ -0,0 +1,476 @@
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+from MyUtil.popo_logging import get_logger
+
+"""
+智能体调用调度器
+
+回调端点只负责把事件放进调度队列，由调度器自己的工作线程执行智能体调用和回复。
+端点通过job.wait_started等待工作线程真正开始反向调用智能体（session仍有效时），而不是固定休眠。
+队列有上限，并按popo_app_key、agent_app_id分别限制同时执行的智能体调用数，避免一个繁忙的群占满所有工作线程。
+同一会话（session_id）中，上一条消息的回复还在生成时用户继续发消息是正常的聊天行为，后到的消息不等上一次调用结束，
+直接开始执行（排队等待会超过session的有效期），同一会话的调用由会话记忆的get-or-reserve共用同一个conversation_id；
+配置了合并窗口时，窗口内连续发来的消息合并成一次智能体调用。
+合并等待不超过端点等待时间的一半，合并后用最新一条消息的端点（其session仍有效）调用智能体。
+并发上限只是软限制：排队到最晚开始时间（session失效前）仍未开始的任务由端点调用start_overdue，
+不再受并发上限限制、在新线程中立即开始，已接收的消息不会因排队被丢弃。
+用户撤回消息时，还在排队的任务直接移出队列，正在执行的任务标记为已取消，不再回复。
+"""
+
+logger = get_logger(__name__)
+
+# 调度器工作线程数（所有机器人共享），不少于端点配置的单机器人、单智能体并发上限
+default_worker_count = 16
+# 等待执行的任务上限，超过后拒绝新任务
+default_max_queue_size = 200
+# 单个popo机器人等待执行的任务上限，防止一个机器人占满整个队列
+default_max_queue_size_per_app_key = 50
+# 单个popo机器人（popo_app_key）默认同时执行的智能体调用数
+default_max_concurrency_per_app_key = 4
+# 单个智能体（agent_app_id）默认同时执行的调用数
+default_max_concurrency_per_agent = 4
+# 合并消息时最多等待合并窗口的倍数，防止用户持续发消息导致一直不执行
+max_merge_window_multiple = 4
+# 端点等待调度器开始调用智能体的默认时间，秒
+default_handoff_timeout = 1
+# 合并等待最多占端点等待时间的比例，剩余时间留给工作线程开始调用
+max_merge_delay_ratio = 0.5
+# 距端点停止等待不足该时间的任务不再开始执行，秒（开始执行到反向调用送达也需要时间）
+handoff_start_margin = 0.2
+
+
+class DispatchQueueFullError(Exception):
+    """调度队列已满，任务被拒绝"""
+    pass
+
+
+@dataclass
+class AgentDispatchJob:
+    """一次待执行的智能体调用"""
+    # 实际执行智能体调用和回复的函数，参数为job本身
+    handler: Callable[["AgentDispatchJob"], None]
+    plugin_settings: Any
+    robot_event: Any
+    message_recipient: str
+    popo_bot: Any
+    # 入队时间（time.monotonic）
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # 最早可执行时间（time.monotonic），用于合并窗口
+    ready_at: float = 0.0
+    # 合并进本次调用的全部事件（按到达顺序），robot_event始终是最新的一条
+    events: list = field(default_factory=list, repr=False)
+    # 开始执行时间（time.monotonic）
+    dispatched_at: Optional[float] = None
+    # 工作线程开始反向调用智能体
+    started: threading.Event = field(default_factory=threading.Event, repr=False)
+    # 智能体调用及回复全部结束（无论成功失败）
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    # 消息已被撤回，不再调用智能体或回复
+    cancelled: threading.Event = field(default_factory=threading.Event, repr=False)
+    error: Optional[BaseException] = None
+    # 端点等待开始调用的时间，秒，超过后端点返回、session失效
+    handoff_timeout: float = default_handoff_timeout
+    # 最晚开始执行的时间（time.monotonic），合并消息时顺延到最新一条消息的端点
+    start_deadline: float = 0.0
+
+    def __post_init__(self):
+        if not self.events:
+            self.events.append(self.robot_event)
+        if not self.start_deadline:
+            self.start_deadline = self.enqueued_at + self.handoff_timeout - handoff_start_margin
+
+    @property
+    def app_key(self) -> str:
+        return self.plugin_settings.popo_app_key
+
+    @property
+    def agent_app_id(self) -> str:
+        return self.plugin_settings.agent_app_id
+
+    @property
+    def lane_key(self) -> tuple:
+        """合并消息的维度，与会话记忆的key一致"""
+        return self.agent_app_id, self.app_key, self.robot_event.event_data.session_id
+
+    @property
+    def merge_window(self) -> float:
+        """消息合并窗口，秒，0表示不合并；不超过max_merge_delay，保证端点返回前开始调用"""
+        merge_window_ms = getattr(self.plugin_settings, "message_merge_window_ms", None)
+        return min(merge_window_ms / 1000, self.max_merge_delay) if merge_window_ms else 0.0
+
+    @property
+    def max_merge_delay(self) -> float:
+        """从第一条消息到开始执行最多等待的时间，秒"""
+        merge_window_ms = getattr(self.plugin_settings, "message_merge_window_ms", None) or 0
+        return min(merge_window_ms / 1000 * max_merge_window_multiple, self.handoff_timeout * max_merge_delay_ratio)
+
+    @property
+    def uuids(self) -> list:
+        """合并进本次调用的全部消息的uuid"""
+        return [event.event_data.uuid for event in self.events]
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set()
+
+    @property
+    def query(self) -> str:
+        """发给智能体的输入，多条消息按到达顺序换行拼接"""
+        if len(self.events) == 1:
+            return self.robot_event.event_data.notify
+        return "\n".join(event.event_data.notify for event in self.events)
+
+    def merge(self, other: "AgentDispatchJob") -> None:
+        """
+        把同一会话中后到的消息合并进本任务，并推迟执行时间
+
+        改用最新一条消息的handler（及其session）调用智能体，先到的消息的端点可能已经返回
+        """
+        self.events.extend(other.events)
+        self.robot_event = other.robot_event
+        self.handler = other.handler
+        self.ready_at = min(other.enqueued_at + self.merge_window, self.enqueued_at + self.max_merge_delay)
+        self.start_deadline = max(self.start_deadline, other.start_deadline)
+
+    @property
+    def max_concurrency_per_app_key(self) -> int:
+        return getattr(self.plugin_settings, "max_concurrency_per_app_key", None) or default_max_concurrency_per_app_key
+
+    @property
+    def max_concurrency_per_agent(self) -> int:
+        return getattr(self.plugin_settings, "max_concurrency_per_agent", None) or default_max_concurrency_per_agent
+
+    @property
+    def wait_time(self) -> Optional[float]:
+        """在队列中等待的时间，秒"""
+        if self.dispatched_at is None:
+            return None
+        return self.dispatched_at - self.enqueued_at
+
+    def remove_event(self, uuid: str) -> bool:
+        """移除被撤回的消息，返回是否还有剩余消息"""
+        self.events = [event for event in self.events if event.event_data.uuid != uuid]
+        if self.events:
+            self.robot_event = self.events[-1]
+        return bool(self.events)
+
+    def mark_started(self) -> None:
+        self.started.set()
+
+    def wait_started(self, timeout: float = None) -> bool:
+        return self.started.wait(timeout)
+
+    def wait_done(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+
+class PopoAgentDispatcher:
+    def __init__(self, worker_count: int = default_worker_count, max_queue_size: int = default_max_queue_size,
+                 max_queue_size_per_app_key: int = default_max_queue_size_per_app_key):
+        self.worker_count = worker_count
+        self.max_queue_size = max_queue_size
+        self.max_queue_size_per_app_key = max_queue_size_per_app_key
+        self._pending: "deque[AgentDispatchJob]" = deque()
+        self._pending_by_app_key: Counter = Counter()
+        self._running_by_app_key: Counter = Counter()
+        self._running_by_agent: Counter = Counter()
+        # 会话中尚未执行、还可以合并新消息的任务
+        self._mergeable_by_lane: dict = {}
+        # (popo_app_key, 消息uuid) -> 排队中或执行中的任务，用于撤回
+        self._jobs_by_uuid: dict = {}
+        self._running = 0
+        self._cond = threading.Condition()
+        self._workers: list = []
+        # 统计信息
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._merged = 0
+        self._recalled = 0
+        # 到最晚开始时间仍在排队、超出并发上限开始执行的任务数
+        self._overdue = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._wait_time_last = 0.0
+        # 按popo_app_key分组的同名统计，端点只返回自己机器人的这一份
+        self._stats_by_app_key: dict = {}
+
+    def _app_key_stats_locked(self, app_key: str) -> Counter:
+        stats = self._stats_by_app_key.get(app_key)
+        if stats is None:
+            stats = self._stats_by_app_key[app_key] = Counter()
+        return stats
+
+    def _ensure_workers(self, min_count: int = 0) -> None:
+        """工作线程数不少于min_count（任务配置的并发上限），否则并发上限内的任务也要排队等空闲线程"""
+        if len(self._workers) >= max(self.worker_count, min_count):
+            return
+        with self._cond:
+            self.worker_count = max(self.worker_count, min_count)
+            while len(self._workers) < self.worker_count:
+                worker = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"popo-agent-dispatcher-{len(self._workers)}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, job: AgentDispatchJob) -> AgentDispatchJob:
+        """
+        放入调度队列后立即返回
+
+        :raises DispatchQueueFullError: 等待中的任务已达上限
+        """
+        self._ensure_workers(max(job.max_concurrency_per_app_key, job.max_concurrency_per_agent))
+        with self._cond:
+            merge_window = job.merge_window
+            if merge_window:
+                lane_job = self._mergeable_by_lane.get(job.lane_key)
+                if lane_job is not None:
+                    lane_job.merge(job)
+                    self._index_uuids_locked(lane_job, job.uuids)
+                    self._merged += 1
+                    self._app_key_stats_locked(job.app_key)["merged"] += 1
+                    self._cond.notify()
+                    return lane_job
+                job.ready_at = job.enqueued_at + merge_window
+            if len(self._pending) >= self.max_queue_size:
+                self._rejected += 1
+                self._app_key_stats_locked(job.app_key)["rejected"] += 1
+                raise DispatchQueueFullError(f"智能体调度队列已满（{self.max_queue_size}），请稍后再试")
+            if self._pending_by_app_key[job.app_key] >= self.max_queue_size_per_app_key:
+                self._rejected += 1
+                self._app_key_stats_locked(job.app_key)["rejected"] += 1
+                raise DispatchQueueFullError(f"机器人的待处理消息已达上限（{self.max_queue_size_per_app_key}），请稍后再试")
+            self._pending.append(job)
+            self._pending_by_app_key[job.app_key] += 1
+            self._index_uuids_locked(job, job.uuids)
+            if merge_window:
+                self._mergeable_by_lane[job.lane_key] = job
+            self._submitted += 1
+            self._app_key_stats_locked(job.app_key)["submitted"] += 1
+            self._cond.notify()
+        return job
+
+    def _index_uuids_locked(self, job: AgentDispatchJob, uuids: list) -> None:
+        for uuid in uuids:
+            self._jobs_by_uuid[(job.app_key, uuid)] = job
+
+    def _unindex_uuids_locked(self, job: AgentDispatchJob, uuids: list) -> None:
+        for uuid in uuids:
+            if self._jobs_by_uuid.get((job.app_key, uuid)) is job:
+                del self._jobs_by_uuid[(job.app_key, uuid)]
+
+    def _remove_pending_locked(self, job: AgentDispatchJob) -> None:
+        self._pending.remove(job)
+        if self._mergeable_by_lane.get(job.lane_key) is job:
+            del self._mergeable_by_lane[job.lane_key]
+        self._pending_by_app_key[job.app_key] -= 1
+        if self._pending_by_app_key[job.app_key] <= 0:
+            del self._pending_by_app_key[job.app_key]
+
+    def recall(self, app_key: str, uuid: str) -> Optional[str]:
+        """
+        撤回消息
+
+        :return: "dropped" 任务还在排队，已移出队列；"removed" 从合并的任务中移除了这条消息；
+                 "cancelled" 任务正在执行，已标记取消；None 没有找到对应的任务（已执行完或从未收到）
+        """
+        with self._cond:
+            job = self._jobs_by_uuid.pop((app_key, uuid), None)
+            if job is None:
+                return None
+            self._recalled += 1
+            self._app_key_stats_locked(app_key)["recalled"] += 1
+            if job.dispatched_at is None:
+                if job.remove_event(uuid):
+                    return "removed"
+                self._remove_pending_locked(job)
+                job.cancelled.set()
+                # 唤醒等待中的端点
+                job.started.set()
+                job.done.set()
+                self._cond.notify_all()
+                return "dropped"
+            # 执行中的合并任务只撤回了部分消息时，回复仍然有意义
+            if len(job.events) > 1 and any((app_key, other) in self._jobs_by_uuid for other in job.uuids):
+                return "removed"
+            job.cancelled.set()
+            return "cancelled"
+
+    def start_overdue(self, job: AgentDispatchJob) -> bool:
+        """
+        端点等到最晚开始时间后调用：任务仍在排队时不再受并发上限限制，在新线程中立即开始执行，
+        保证在端点返回、session失效前反向调用智能体
+
+        :return: 端点是否需要继续等待任务开始反向调用；已开始反向调用、已结束（含已撤回），
+                 或合并了更新的消息、由更新消息的端点继续等待时返回False
+        """
+        with self._cond:
+            if job.started.is_set() or job.done.is_set():
+                return False
+            if job.dispatched_at is not None:
+                # 工作线程已经开始执行，还没有送出反向调用
+                return True
+            if time.monotonic() < job.start_deadline:
+                return False
+            self._remove_pending_locked(job)
+            self._dispatch_locked(job)
+            self._overdue += 1
+            self._app_key_stats_locked(job.app_key)["overdue"] += 1
+        threading.Thread(target=self._run_and_release, args=(job,), name="popo-agent-dispatcher-overdue",
+                         daemon=True).start()
+        return True
+
+    def _is_runnable(self, job: AgentDispatchJob) -> bool:
+        return (self._running_by_app_key[job.app_key] < job.max_concurrency_per_app_key and
+                self._running_by_agent[job.agent_app_id] < job.max_concurrency_per_agent)
+
+    def _take_runnable_locked(self) -> "tuple[Optional[AgentDispatchJob], Optional[float]]":
+        """
+        按入队顺序找第一个可执行的任务，被限流的机器人不会挡住其他机器人
+
+        :return: (任务, None)，或没有可执行任务时 (None, 最近一个合并窗口结束的时间)
+        """
+        now = time.monotonic()
+        next_ready_at = None
+        for index, job in enumerate(self._pending):
+            if job.ready_at > now:
+                # 合并窗口未结束
+                if next_ready_at is None or job.ready_at < next_ready_at:
+                    next_ready_at = job.ready_at
+                continue
+            if self._is_runnable(job):
+                del self._pending[index]
+                if self._mergeable_by_lane.get(job.lane_key) is job:
+                    del self._mergeable_by_lane[job.lane_key]
+                self._pending_by_app_key[job.app_key] -= 1
+                if self._pending_by_app_key[job.app_key] <= 0:
+                    del self._pending_by_app_key[job.app_key]
+                self._dispatch_locked(job)
+                return job, None
+        return None, next_ready_at
+
+    def _dispatch_locked(self, job: AgentDispatchJob) -> None:
+        """已移出队列的任务计入执行中"""
+        self._running_by_app_key[job.app_key] += 1
+        self._running_by_agent[job.agent_app_id] += 1
+        self._running += 1
+        job.dispatched_at = time.monotonic()
+        wait_time = job.wait_time
+        self._wait_time_total += wait_time
+        self._wait_time_last = wait_time
+        self._wait_time_max = max(self._wait_time_max, wait_time)
+        stats = self._app_key_stats_locked(job.app_key)
+        stats["dispatched"] += 1
+        stats["wait_time_total"] += wait_time
+        stats["wait_time_last"] = wait_time
+        stats["wait_time_max"] = max(stats["wait_time_max"], wait_time)
+
+    def _release_locked(self, job: AgentDispatchJob) -> None:
+        for counter, key in ((self._running_by_app_key, job.app_key), (self._running_by_agent, job.agent_app_id)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+        self._unindex_uuids_locked(job, job.uuids)
+        self._running -= 1
+        self._completed += 1
+        self._app_key_stats_locked(job.app_key)["completed"] += 1
+        # 释放的并发名额可能让多个被限流的任务变为可执行
+        self._cond.notify_all()
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                job, next_ready_at = self._take_runnable_locked()
+                while job is None:
+                    self._cond.wait(None if next_ready_at is None else max(0.0, next_ready_at - time.monotonic()))
+                    job, next_ready_at = self._take_runnable_locked()
+            self._run_and_release(job)
+
+    def _run_and_release(self, job: AgentDispatchJob) -> None:
+        try:
+            self._run(job)
+        finally:
+            with self._cond:
+                self._release_locked(job)
+
+    def _run(self, job: AgentDispatchJob) -> None:
+        try:
+            job.handler(job)
+        except Exception as e:
+            job.error = e
+            logger.error("智能体调度任务执行失败: %s", e)
+        finally:
+            # handler提前失败时也要唤醒等待中的端点
+            job.started.set()
+            job.done.set()
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def get_stats(self) -> dict:
+        """进程内全部机器人的队列深度、并发数和排队等待时间，用于基准测试和排查，端点只返回get_app_key_stats"""
+        with self._cond:
+            dispatched = self._submitted - len(self._pending)
+            oldest_wait = time.monotonic() - self._pending[0].enqueued_at if self._pending else 0.0
+            return {
+                "queue_depth": len(self._pending),
+                "max_queue_size": self.max_queue_size,
+                "running": self._running,
+                "worker_count": self.worker_count,
+                "queue_depth_by_app_key": dict(self._pending_by_app_key),
+                "running_by_app_key": dict(self._running_by_app_key),
+                "running_by_agent": dict(self._running_by_agent),
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "merged": self._merged,
+                "recalled": self._recalled,
+                "overdue": self._overdue,
+                "completed": self._completed,
+                "wait_time_avg": round(self._wait_time_total / dispatched, 4) if dispatched else 0.0,
+                "wait_time_max": round(self._wait_time_max, 4),
+                "wait_time_last": round(self._wait_time_last, 4),
+                "oldest_pending_wait": round(oldest_wait, 4),
+            }
+
+    def get_app_key_stats(self, app_key: str) -> dict:
+        """单个机器人的队列深度、并发数、任务计数和排队等待时间，不包含其他机器人的数据"""
+        with self._cond:
+            oldest = next((job.enqueued_at for job in self._pending if job.app_key == app_key), None)
+            stats = self._stats_by_app_key.get(app_key, Counter())
+            dispatched = stats["dispatched"]
+            return {
+                "queue_depth": self._pending_by_app_key.get(app_key, 0),
+                "max_queue_size": self.max_queue_size_per_app_key,
+                "running": self._running_by_app_key.get(app_key, 0),
+                "submitted": stats["submitted"],
+                "rejected": stats["rejected"],
+                "merged": stats["merged"],
+                "recalled": stats["recalled"],
+                "overdue": stats["overdue"],
+                "completed": stats["completed"],
+                "wait_time_avg": round(stats["wait_time_total"] / dispatched, 4) if dispatched else 0.0,
+                "wait_time_max": round(stats["wait_time_max"], 4),
+                "wait_time_last": round(stats["wait_time_last"], 4),
+                "oldest_pending_wait": round(time.monotonic() - oldest, 4) if oldest is not None else 0.0,
+            }
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_agent_dispatcher() -> PopoAgentDispatcher:
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = PopoAgentDispatcher()
+    return _dispatcher
@@ -1,68 +1,271 @@
-import logging
 import re
+from bisect import bisect_right
 from enum import Enum, auto
-import requests
-from cachetools import TTLCache, cached
-from cachetools.keys import hashkey
+from typing import Union
+
+from MyUtil.popo_http_client import get_http_client
+from MyUtil.popo_logging import debug_payload, get_logger
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_metrics import get_metrics
+from MyUtil.popo_token_manager import PopoAccessToken, get_token_manager
+
+logger = get_logger(__name__)
 
 class PopoMessageReceiverType(Enum):
     USER = auto()
     GROUP = auto()
 
+# 单条POPO消息的最大字符数，超过后拆成多条发送
+max_message_chars = 5000
+# 接收人：popo邮箱或群号
+_email_pattern = re.compile(r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]{2,}$')
+_group_pattern = re.compile(r'^\d{5,10}$')
+# 多个接收人之间的分隔符：中英文逗号、分号、空白
+_receiver_separator_pattern = re.compile(r'[,，;；\s]+')
+# 代码块的开始/结束行
+_code_fence_pattern = re.compile(r'^[ \t]*```', re.M)
+# 图片标签：[img]与[/img]之间是一个不含空白的地址，否则只是普通文本
+_image_tag_pattern = re.compile(r'\[img\][ \t]*(?:(?!\[img\])\S)+?[ \t]*\[/img\]')
+
+
+def _find_image_tags(text: str) -> "tuple[list, list]":
+    """
+    [img]...[/img]标签的开始、结束位置
+
+    只有中间是一个地址（不含换行和空白）的才算图片标签，未闭合的[img]不会与很远处的[/img]配成一对
+    """
+    starts, ends = [], []
+    for match in _image_tag_pattern.finditer(text):
+        starts.append(match.start())
+        ends.append(match.end())
+    return starts, ends
+
+
+def _find_code_blocks(text: str) -> "tuple[list, list]":
+    """代码块（含开始、结束行）的开始、结束位置，未闭合的代码块延续到末尾"""
+    starts, ends = [], []
+    for match in _code_fence_pattern.finditer(text):
+        if len(starts) == len(ends):
+            starts.append(match.start())
+        else:
+            line_end = text.find("\n", match.end())
+            ends.append(len(text) if line_end == -1 else line_end)
+    if len(starts) > len(ends):
+        ends.append(len(text))
+    return starts, ends
+
+
+def _find_span(starts: list, ends: list, position: int) -> int:
+    """position严格位于哪个区间内部，返回区间下标，不在任何区间内返回-1"""
+    index = bisect_right(starts, position) - 1
+    if index >= 0 and starts[index] < position < ends[index]:
+        return index
+    return -1
+
+
+def split_message(message: str, max_chars: int = max_message_chars) -> list:
+    """
+    把超长消息拆成不超过max_chars的多段
+
+    优先在段落（空行）和代码块边界拆分，其次在换行处，不会拆开[img]...[/img]标签（标签本身超长时除外）；
+    代码块本身超长时在代码行之间拆分，并为前后两段补全```。
+    只做一次扫描和二分查找，耗时与消息长度成线性关系。
+    """
+    if len(message) <= max_chars:
+        return [message]
+
+    image_starts, image_ends = _find_image_tags(message)
+    code_starts, code_ends = _find_code_blocks(message)
+    # 拆分位置按优先级分组：段落/代码块边界、代码块外的换行、代码块内的换行
+    paragraph_breaks, line_breaks, code_line_breaks = [], [], []
+    code_index = 0
+    position = message.find("\n")
+    while position != -1:
+        while code_index < len(code_ends) and code_ends[code_index] < position:
+            code_index += 1
+        has_code = code_index < len(code_starts)
+        if has_code and code_starts[code_index] <= position < code_ends[code_index]:
+            code_line_breaks.append(position)
+        elif message.startswith("\n\n", position) or \
+                has_code and (code_ends[code_index] == position or code_starts[code_index] == position + 1):
+            # 空行、代码块结束行之后、代码块开始行之前
+            paragraph_breaks.append(position)
+        else:
+            line_breaks.append(position)
+        position = message.find("\n", position + 1)
+
+    segments = []
+    start = 0
+    prefix = ""
+    length = len(message)
+    while start < length:
+        # 补全代码块的```需要预留长度
+        budget = max(1, max_chars - len(prefix) - 4)
+        if length - start <= max_chars - len(prefix):
+            end = length
+        else:
+            limit = start + budget
+            end = 0
+            for breaks in (paragraph_breaks, line_breaks, code_line_breaks):
+                index = bisect_right(breaks, limit) - 1
+                # 太靠前的拆分位置会产生过短的段落，交给下一优先级
+                if index >= 0 and breaks[index] > start + budget // 2:
+                    end = breaks[index]
+                    break
+            if not end:
+                end = limit
+            image = _find_span(image_starts, image_ends, end)
+            if image != -1:
+                # 不拆开图片标签；图片标签本身超过一段的长度时只能在limit处硬拆
+                if image_starts[image] > start:
+                    end = image_starts[image]
+                elif image_ends[image] - start <= budget:
+                    end = image_ends[image]
+        segment = message[start:end]
+        next_prefix = ""
+        code = _find_span(code_starts, code_ends, end)
+        if code != -1 and end < length:
+            # 在代码块中间拆开：本段补上结束行，下一段重复开始行
+            fence_line_end = message.find("\n", code_starts[code])
+            if fence_line_end == -1:
+                fence_line_end = code_ends[code]
+            if end <= fence_line_end:
+                end = code_starts[code] if code_starts[code] > start else fence_line_end
+                segment = message[start:end]
+            if end > fence_line_end:
+                segment += "\n```"
+                next_prefix = message[code_starts[code]:fence_line_end].strip() + "\n"
+        segment = prefix + segment
+        if segment.strip():
+            segments.append(segment.strip("\n"))
+        prefix = next_prefix
+        start = end
+        # 下一段不以换行开头
+        while start < length and message[start] == "\n":
+            start += 1
+    return segments
+
+
+def split_receivers(receivers: str) -> list:
+    """把逗号、分号或空白分隔的多个接收人拆成列表，去掉空项和重复项，保持原有顺序"""
+    return list(dict.fromkeys(receiver for receiver in _receiver_separator_pattern.split(receivers or "") if receiver))
+
+
+# 判断为触发POPO频率限制的错误信息关键字（小写）
+rate_limit_error_keywords = ("too many", "rate limit", "frequency", "频率", "频繁", "限流")
+
+
+class PopoApiError(ValueError):
+    """POPO开放平台接口返回错误"""
+
+    def __init__(self, message: str, errcode=None, errmsg: str = None, status_code: int = None):
+        super().__init__(message)
+        self.errcode = errcode
+        self.errmsg = errmsg
+        self.status_code = status_code
+
+
+class PopoRateLimitError(PopoApiError):
+    """触发了POPO的发送频率限制，稍后重试可能成功"""
+    pass
+
+
+def _parse_response(response) -> dict:
+    try:
+        return response.json() or {}
+    except ValueError:
+        return {}
+
+
+def _raise_for_send_response(response) -> None:
+    data = _parse_response(response)
+    if response.status_code == 200 and data.get("errcode") == 0:
+        return
+    errmsg = data.get("errmsg", "未收到错误信息")
+    message = f"popo消息发送错误：发送消息失败。errmsg：{errmsg}"
+    if response.status_code == 429 or any(keyword in str(errmsg).lower() for keyword in rate_limit_error_keywords):
+        raise PopoRateLimitError(message, data.get("errcode"), errmsg, response.status_code)
+    raise PopoApiError(message, data.get("errcode"), errmsg, response.status_code)
+
 class PopoBot:
-    # 类级别的缓存，所有实例共享，实现单例缓存效果
-    _token_cache = TTLCache(maxsize=200, ttl=7200)  # token缓存六个小时
+    # POPO开放平台接口地址
+    api_base_url = "https://open.popo.netease.com/open-apis"
 
     def __init__(self, app_key, app_secret):
         self.appKey = app_key
         self.app_secret = app_secret
 
     @classmethod
-    @cached(_token_cache)  # 使用类级别的缓存
     def get_token(cls, app_key: str, app_secret: str) -> str:
+        # token由进程内共享的token管理器缓存，并在过期前后台刷新
+        return get_token_manager(cls.fetch_access_token).get_token(app_key, app_secret)
 
+    @classmethod
+    def fetch_access_token(cls, app_key: str, app_secret: str) -> PopoAccessToken:
+        """请求token接口，返回token及其过期时间"""
         body = {
             "appKey": app_key,
             "appSecret": app_secret
         }
-        response = requests.post(
-            "https://open.popo.netease.com/open-apis/robots/v1/token",
-            json=body,
-            timeout=3
-        )
+        with get_metrics().span("token_fetch", app_key):
+            response = get_http_client().post(
+                cls.api_base_url + "/robots/v1/token",
+                json=body,
+                timeout=3
+            )
         if response.status_code != 200 or response.json().get("errcode") != 0:
             errmsg = response.json().get("errmsg", "未收到错误信息")
             raise ValueError(f"popo消息发送错误：获取token失败。errmsg：{errmsg}")
-        return response.json().get("data").get("accessToken")
+        return PopoAccessToken.from_response_data(response.json().get("data"))
 
     @classmethod
-    def clear_token_cache_for(cls, app_key: str, app_secret: str) -> None:
-        # 只清理指定 app_key/app_secret 的缓存
-        cache_key = hashkey(cls, app_key, app_secret)
-        try:
-            del cls._token_cache[cache_key]
-        except KeyError:
-            pass
+    def clear_token_cache_for(cls, app_key: str, app_secret: str, access_token: str = None) -> None:
+        # 只清理指定 app_key/app_secret 的缓存；传入access_token时，只有缓存的仍是该token才清理
+        get_token_manager(cls.fetch_access_token).invalidate(app_key, app_secret, access_token)
 
     def validate_receiver(self, receiver: str) -> PopoMessageReceiverType:
 
-        email_pattern = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]{2,}$'
-        group_pattern = r'^\d{5,10}$'
-
-        if re.match(email_pattern, receiver):
+        if _email_pattern.match(receiver):
             return PopoMessageReceiverType.USER
-        elif re.match(group_pattern, receiver):
+        elif _group_pattern.match(receiver):
             return PopoMessageReceiverType.GROUP
         else:
             raise ValueError("popo消息发送错误：无效的popo用户邮箱或群号")
 
-    def send_message(self, receiver: str, message: str, at: str =  None,auto_convert_markdown_image_link: bool = True) -> None:
-        self.validate_receiver(receiver)
+    def build_message_content(self, receiver: str, message: Union[str, PopoMessage], at: str = None,
+                              auto_convert_markdown_image_link: bool = True) -> list:
+        """构造rich_text消息的content节点列表，message可以是已经解析好的PopoMessage"""
+        receiver_type = self.validate_receiver(receiver)
+
+        if not isinstance(message, PopoMessage):
+            message = PopoMessage.parse(message, auto_convert_markdown_image_link)
+
+        if at and receiver_type == PopoMessageReceiverType.GROUP:
+            return message.to_rich_text_content(at)
+        return message.to_rich_text_content()
+
+    def build_message_parts(self, receiver: str, message: Union[str, PopoMessage], at: str = None,
+                            auto_convert_markdown_image_link: bool = True) -> list:
+        """超长消息按split_message拆分后每段的content节点列表，只在第一段@"""
+        if not isinstance(message, PopoMessage):
+            message = PopoMessage.parse(message, auto_convert_markdown_image_link)
+        # @时正文前会多一个换行
+        parts = message.split(max_message_chars - 1)
+        return [self.build_message_content(receiver, part, at if index == 0 else None)
+                for index, part in enumerate(parts)]
 
-        if auto_convert_markdown_image_link:
-            pattern = r'!\[(.*?)]\(([^()]*(\([^()]*\)[^()]*)*)\)'
-            message = re.sub(pattern, r'[img]\2[/img]', message)
+    def send_message(self, receiver: str, message: Union[str, PopoMessage], at: str =  None,auto_convert_markdown_image_link: bool = True) -> None:
+        # 超长消息拆成多段按顺序发送，共用同一个连接池
+        for content in self.build_message_parts(receiver, message, at, auto_convert_markdown_image_link):
+            self.send_rich_text(receiver, content)
 
+    def send_rich_text(self, receiver: str, content: list) -> None:
+        """
+        发送rich_text消息
+
+        :raises PopoRateLimitError: 触发了发送频率限制
+        :raises PopoApiError: 其他接口错误
+        """
         headers = {
             "Content-Type": "application/json",
             # 调用类方法获取token
@@ -71,49 +274,36 @@ class PopoBot:
         body = {
             "receiver": receiver,
             "message": {
-                "content": [
-                    {
-                        "tag": "text",
-                        "text": message
-                    }
-                ]
+                "content": content
             },
             "msgType": "rich_text"
         }
 
-        if at and self.validate_receiver(receiver) == PopoMessageReceiverType.GROUP:
-            body["message"]["content"][0]["text"] = "\n"+message
-            body["message"]["content"].insert(0,{"tag": "at", "email": at})
-
-        logging.debug(f"发送消息：{body}")
+        debug_payload(logger, "发送消息：%s", body)
 
-        response = requests.post(
-            "https://open.popo.netease.com/open-apis/robots/v1/im/send-msg",
-            json=body,
-            headers=headers,
-            timeout=5
-        )
-        if response.status_code != 200 or response.json().get("errcode") != 0:
-            errmsg = response.json().get("errmsg", "未收到错误信息")
-            if "access token expired" in str(errmsg).lower():
+        with get_metrics().span("popo_send", self.appKey):
+            response = get_http_client().post(
+                self.api_base_url + "/robots/v1/im/send-msg",
+                json=body,
+                headers=headers,
+                timeout=5
+            )
+            if "access token expired" in str(_parse_response(response).get("errmsg")).lower():
                 # 失效时清理对应 app_key 的缓存并重试一次
-                self.clear_token_cache_for(self.appKey, self.app_secret)
+                self.clear_token_cache_for(self.appKey, self.app_secret, headers["Open-Access-Token"])
                 headers["Open-Access-Token"] = self.get_token(self.appKey, self.app_secret)
-                response2 = requests.post(
-                    "https://open.popo.netease.com/open-apis/robots/v1/im/send-msg",
+                response = get_http_client().post(
+                    self.api_base_url + "/robots/v1/im/send-msg",
                     json=body,
                     headers=headers,
                     timeout=5
                 )
-                if response2.status_code != 200 or response2.json().get("errcode") != 0:
-                    errmsg = response2.json().get("errmsg", "未收到错误信息")
-                    raise ValueError(f"popo消息发送错误：发送消息失败。errmsg：{errmsg}")
-
+            _raise_for_send_response(response)
 
 if __name__ == '__main__':
     popo1 = PopoBot("AAA", "BBB")
     popo2 = PopoBot("AAA", "BBB")
 
-    # 两个实例会共享同一个token缓存
+    # 两个实例会共享同一个token管理器
     popo1.send_message("wb.wangfeng07@mesg.corp.netease.com", "老王真帅")
     popo2.send_message("wb.wangfeng07@mesg.corp.netease.com", "老王真帅2")
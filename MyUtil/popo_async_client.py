@@ -0,0 +1,319 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import astuple, dataclass
+from typing import Iterable, Optional, Union
+
+from MyUtil.popo_application_bot_util import PopoBot, PopoRateLimitError, _parse_response, _raise_for_send_response
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_metrics import get_metrics
+from MyUtil.popo_logging import get_logger, log_sampled
+from MyUtil.popo_send_queue import get_send_queue
+
+"""
+POPO应用机器人的asyncio客户端
+
+一条通知要发给成百上千个接收人时，同步的PopoBot只能一个接一个地发。这里基于httpx.AsyncClient并发发送，
+用信号量限制同时进行的请求数。token与PopoBot共用同一个token管理器，接口错误同样抛出PopoApiError/PopoRateLimitError。
+每次发送与发送队列共用按popo_app_key和接收人的令牌桶，触发频率限制时按发送队列的退避策略重试。
+同步代码（Dify工具）通过send_to_many_sync调用：协程提交到进程内共享的后台事件循环执行，
+同一个机器人的AsyncPopoBot及其连接池在多次调用之间复用，不再每次新建事件循环和连接。
+"""
+
+logger = get_logger(__name__)
+
+# 后台事件循环中缓存的AsyncPopoBot数量上限，超过后关闭最久未使用的
+max_cached_clients = 64
+
+
+@dataclass
+class PopoAsyncClientConfig:
+    # 同时进行的发送请求数上限，同时也是连接池的最大连接数
+    max_concurrency: int = 20
+    # 建立连接超时，秒
+    connect_timeout: float = 3.0
+    # 读取响应超时，秒
+    read_timeout: float = 5.0
+
+
+@dataclass
+class PopoFanOutResult:
+    receiver: str
+    # 发送失败的异常，成功为None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class AsyncPopoBot:
+    """
+    PopoBot的asyncio版本
+
+    httpx.AsyncClient绑定创建它的事件循环，一个实例只在一个事件循环内使用，用完调用aclose（或使用async with）。
+    网络错误抛出httpx.HTTPError，与PopoBot抛出requests的异常相对应。
+    """
+
+    def __init__(self, app_key: str, app_secret: str, config: PopoAsyncClientConfig = None):
+        self.appKey = app_key
+        self.app_secret = app_secret
+        self.config = config or PopoAsyncClientConfig()
+        # 消息的解析、拆分和接收人校验与同步版本完全一致
+        self._popo_bot = PopoBot(app_key, app_secret)
+        self._client = None
+        self._semaphore = asyncio.Semaphore(self.config.max_concurrency)
+
+    async def __aenter__(self) -> "AsyncPopoBot":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    def _get_client(self):
+        if self._client is None:
+            import httpx
+
+            config = self.config
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+                limits=httpx.Limits(max_connections=config.max_concurrency,
+                                    max_keepalive_connections=config.max_concurrency),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def get_token(self) -> str:
+        # 缓存未命中时token管理器会同步请求token接口，放到线程里执行，不阻塞事件循环
+        return await _run_blocking(PopoBot.get_token, self.appKey, self.app_secret)
+
+    async def send_rich_text(self, receiver: str, content: list) -> None:
+        """
+        发送rich_text消息，与发送队列共用限速，触发频率限制时退避重试
+
+        :raises PopoRateLimitError: 重试后仍触发发送频率限制
+        :raises PopoApiError: 其他接口错误
+        """
+        send_queue = get_send_queue()
+        retries = 0
+        while True:
+            wait = send_queue.reserve(self.appKey, receiver)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                await self._post_rich_text(receiver, content)
+                return
+            except PopoRateLimitError:
+                get_metrics().increment("popo_send_rate_limited", self.appKey)
+                if retries >= send_queue.config.max_retries:
+                    raise
+                retry_delay = send_queue.config.retry_delay(retries)
+                retries += 1
+                log_sampled(logger, logging.WARNING, ("popo_send_rate_limited", self.appKey),
+                            "popo消息群发触发频率限制，%.2f秒后第%d次重试: receiver = %s", retry_delay, retries, receiver)
+                await asyncio.sleep(retry_delay)
+
+    async def _post_rich_text(self, receiver: str, content: list) -> None:
+        headers = {
+            "Content-Type": "application/json",
+            "Open-Access-Token": await self.get_token()
+        }
+        body = {
+            "receiver": receiver,
+            "message": {
+                "content": content
+            },
+            "msgType": "rich_text"
+        }
+        url = PopoBot.api_base_url + "/robots/v1/im/send-msg"
+        async with self._semaphore:
+            with get_metrics().span("popo_send", self.appKey):
+                response = await self._get_client().post(url, json=body, headers=headers)
+                if "access token expired" in str(_parse_response(response).get("errmsg")).lower():
+                    # 与PopoBot相同：清理缓存后重试一次，并发的多个请求共用同一次token请求
+                    await _run_blocking(PopoBot.clear_token_cache_for, self.appKey, self.app_secret,
+                                        headers["Open-Access-Token"])
+                    headers["Open-Access-Token"] = await self.get_token()
+                    response = await self._get_client().post(url, json=body, headers=headers)
+                _raise_for_send_response(response)
+
+    async def send_message(self, receiver: str, message: Union[str, PopoMessage], at: str = None,
+                           auto_convert_markdown_image_link: bool = True) -> None:
+        # 超长消息拆成多段，同一接收人的多段按顺序发送
+        for content in self._popo_bot.build_message_parts(receiver, message, at, auto_convert_markdown_image_link):
+            await self.send_rich_text(receiver, content)
+
+    async def send_to_many(self, receivers: Iterable[str], message: Union[str, PopoMessage], at: str = None,
+                           auto_convert_markdown_image_link: bool = True) -> "list[PopoFanOutResult]":
+        """
+        把同一条消息并发发给多个接收人，单个接收人失败不影响其他接收人
+
+        :return: 与receivers顺序一致的发送结果
+        """
+        receivers = list(receivers)
+        if not isinstance(message, PopoMessage):
+            # 只解析一次，所有接收人共用
+            message = PopoMessage.parse(message, auto_convert_markdown_image_link)
+        if receivers:
+            # 先取一次token，避免缓存为空时每个接收人都去排队等待token
+            await self.get_token()
+        errors = await asyncio.gather(
+            *(self.send_message(receiver, message, at) for receiver in receivers),
+            return_exceptions=True,
+        )
+        results = []
+        for receiver, error in zip(receivers, errors):
+            if isinstance(error, BaseException) and not isinstance(error, Exception):
+                # 取消等不属于发送失败，继续向上抛出
+                raise error
+            results.append(PopoFanOutResult(receiver, error))
+        failed = sum(1 for result in results if not result.ok)
+        if failed:
+            logger.warning("popo消息群发：%d个接收人中%d个发送失败", len(results), failed)
+        return results
+
+
+class _BackgroundEventLoop:
+    """
+    进程内共享的后台事件循环，同步代码提交的协程都在这里执行
+
+    gevent monkey patch之后threading.Thread只是同一线程内的greenlet，事件循环改在gevent线程池的原生线程中运行，
+    并且必须在该线程内创建（gevent的selector绑定创建它的线程的hub）。
+    跨线程等待结果使用threading.Event（patch后为gevent的Event，可以被其他原生线程唤醒）。
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # (app_key, app_secret, 配置) -> AsyncPopoBot，按最近使用排序，只在事件循环内访问
+        self._clients: "OrderedDict[tuple, AsyncPopoBot]" = OrderedDict()
+        # 正在使用各个AsyncPopoBot的调用数，使用中的不会被关闭
+        self._in_use: Counter = Counter()
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    started = threading.Event()
+                    holder = {}
+
+                    def run_forever():
+                        loop = holder["loop"] = asyncio.new_event_loop()
+                        asyncio.set_event_loop(loop)
+                        loop.call_soon(started.set)
+                        loop.run_forever()
+
+                    _start_native_thread(run_forever)
+                    started.wait()
+                    self._loop = holder["loop"]
+        return self._loop
+
+    def run(self, coroutine):
+        """在后台事件循环中运行协程并等待结果"""
+        loop = self._get_loop()
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            coroutine.close()
+            raise RuntimeError("不能在后台事件循环中同步等待协程，请直接await")
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        done = threading.Event()
+        future.add_done_callback(lambda _: done.set())
+        done.wait()
+        return future.result()
+
+    @asynccontextmanager
+    async def client(self, app_key: str, app_secret: str, config: PopoAsyncClientConfig = None):
+        """复用的AsyncPopoBot，只能在后台事件循环内使用"""
+        config = config or PopoAsyncClientConfig()
+        key = (app_key, app_secret, astuple(config))
+        client = self._clients.pop(key, None) or AsyncPopoBot(app_key, app_secret, config)
+        self._clients[key] = client
+        self._in_use[key] += 1
+        try:
+            self._close_idle_clients()
+            yield client
+        finally:
+            self._in_use[key] -= 1
+            if self._in_use[key] <= 0:
+                del self._in_use[key]
+
+    def _close_idle_clients(self) -> None:
+        """缓存超过上限时关闭最久未使用、且没有调用正在使用的客户端"""
+        overflow = len(self._clients) - max_cached_clients
+        if overflow <= 0:
+            return
+        for key in [key for key in self._clients if key not in self._in_use][:overflow]:
+            asyncio.get_running_loop().create_task(self._clients.pop(key).aclose())
+
+
+class _DaemonThreadExecutor(concurrent.futures.Executor):
+    """
+    每次调用启动一个守护线程，只用于偶尔发生的token请求
+
+    不使用asyncio.to_thread的默认线程池：patch后它的线程是事件循环线程里的greenlet，
+    进程退出时concurrent.futures会在atexit之前等待这些线程结束，而事件循环已不再运行，退出会一直卡住
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="popo-async-blocking", daemon=True).start()
+        return future
+
+
+_blocking_executor = _DaemonThreadExecutor()
+
+
+async def _run_blocking(func, *args):
+    """在线程中执行同步调用，不阻塞事件循环"""
+    return await asyncio.get_running_loop().run_in_executor(_blocking_executor, func, *args)
+
+
+def _start_native_thread(target) -> None:
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched("threading"):
+        # 长期占用gevent线程池中的一个原生线程
+        get_hub().threadpool.spawn(target)
+    else:
+        threading.Thread(target=target, name="popo-async-loop", daemon=True).start()
+
+
+_background_loop = _BackgroundEventLoop()
+
+
+def run_sync(coroutine):
+    """在同步代码中运行协程，协程在进程内共享的后台事件循环中执行"""
+    return _background_loop.run(coroutine)
+
+
+def send_to_many_sync(app_key: str, app_secret: str, receivers: Iterable[str], message: Union[str, PopoMessage],
+                      at: str = None, auto_convert_markdown_image_link: bool = True,
+                      config: PopoAsyncClientConfig = None) -> "list[PopoFanOutResult]":
+    """AsyncPopoBot.send_to_many的同步版本，同一个机器人多次调用复用同一个连接池"""
+
+    async def send():
+        async with _background_loop.client(app_key, app_secret, config) as popo_bot:
+            return await popo_bot.send_to_many(receivers, message, at, auto_convert_markdown_image_link)
+
+    return run_sync(send())
@@ -1,32 +1,34 @@
-import logging
-import sys
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from dify_plugin.config.logger_format import plugin_logger_handler
+from typing import Optional
+
 from models.popo_bot_callback_structures import PopoEventType, RobotEvent
-from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings
-
-logger = logging.getLogger(__name__)
-if sys.platform in ('win32', 'cygwin', 'darwin'):
-    # 清空已有的handlers避免重复
-    logger.handlers.clear()
-    logger.setLevel(logging.DEBUG)
-    # 为开发环境创建专门的handler
-    dev_handler = logging.StreamHandler()
-    dev_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    dev_handler.setFormatter(dev_formatter)
-    logger.addHandler(dev_handler)
-    logger.propagate = False  # 防止日志向父级传播
-else:
-    logger.setLevel(logging.INFO)
-    logger.addHandler(plugin_logger_handler)
-
-# 存储会话记忆
-memory_dict = {}
+from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings, MemoryBackendType
+from MyUtil.popo_logging import get_logger, lazy
+
+logger = get_logger(__name__)
+
 # 记忆有效期，小时
 memory_validity_period = 1
+# 进程内记忆的条数上限，超过后淘汰最久未写入的
+memory_max_size = 10000
+# 后台清理过期记忆的间隔，秒
+memory_sweep_interval = 60
+# 持久化记忆每次清理时检查的条数下限
+storage_sweep_batch = 20
+# 持久化记忆的清理在一个有效期内检查完key列表中的全部记忆
+storage_sweep_rounds = memory_validity_period * 3600 // memory_sweep_interval
+# 等待同一会话中先到的调用创建会话的最长时间，秒
+reservation_wait_timeout = 120
+
 
 class PopoBotMemory:
-    def __init__(self, bot_account: str, message_source: str, conversation_id: str, last_time: datetime):
+    def __init__(self, bot_account: str, message_source: str, conversation_id: str, last_time: datetime,
+                 agent_app_id: str = None, popo_app_key: str = None):
 
         # 机器人账号
         self.bot_account = bot_account
@@ -37,6 +39,9 @@ class PopoBotMemory:
         # 最后一次popo消息的时间
         self.last_time = last_time
         # self.last_app_id = last_app_id
+        # 所属智能体和popo机器人，用于批量清理
+        self.agent_app_id = agent_app_id
+        self.popo_app_key = popo_app_key
 
     def to_dict(self) -> dict:
         return {
@@ -45,6 +50,8 @@ class PopoBotMemory:
             "conversation_id": self.conversation_id,
             "last_time": self.last_time,
             # "last_app_id": self.last_app_id
+            "agent_app_id": self.agent_app_id,
+            "popo_app_key": self.popo_app_key,
         }
 
     @classmethod
@@ -55,42 +62,566 @@ class PopoBotMemory:
             conversation_id=data["conversation_id"],
             last_time=data["last_time"],
             # last_app_id=data["last_app_id"]
+            agent_app_id=data.get("agent_app_id"),
+            popo_app_key=data.get("popo_app_key"),
         )
 
+    def to_json_bytes(self) -> bytes:
+        data = self.to_dict()
+        data["last_time"] = self.last_time.strftime("%Y-%m-%d %H:%M:%S")
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+    @classmethod
+    def from_json_bytes(cls, raw: bytes) -> "PopoBotMemory":
+        data = json.loads(raw)
+        data["last_time"] = datetime.strptime(data["last_time"], "%Y-%m-%d %H:%M:%S")
+        return cls.from_dict(data)
+
+    def is_expired(self) -> bool:
+        return datetime.now() > self.last_time + timedelta(hours=memory_validity_period)
+
+
+class PopoBotMemoryBackend(ABC):
+    """会话记忆的存储后端"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[PopoBotMemory]:
+        """获取未过期的记忆，过期的记忆会被顺带删除"""
+
+    @abstractmethod
+    def set(self, key: str, memory: PopoBotMemory) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """清理已过期的记忆，返回清理的条数"""
+
+    @abstractmethod
+    def clear(self, agent_app_id: str = None, popo_app_key: str = None) -> int:
+        """清理全部记忆，或指定智能体/popo机器人的记忆，返回清理的条数"""
+
+    @abstractmethod
+    def clear_idle(self, idle_seconds: float, popo_app_key: str = None) -> int:
+        """清理超过idle_seconds未写入的全部记忆，或指定popo机器人的记忆，返回清理的条数"""
+
+    @abstractmethod
+    def list_keys(self, agent_app_id: str = None, popo_app_key: str = None) -> list:
+        pass
+
+    def count(self, agent_app_id: str = None, popo_app_key: str = None) -> int:
+        return len(self.list_keys(agent_app_id, popo_app_key))
+
+
+class _MemoryIndex:
+    """
+    记忆的索引，非线程安全，由后端加锁使用
+
+    - 按写入时间排序的过期索引：每次写入都移到末尾，过期时间（写入时间+有效期）因此单调递增，
+      清理过期/闲置记忆时只需从头部弹出，不必遍历全部记忆
+    - 按agent_app_id、popo_app_key的二级索引：批量清理的耗时只与命中的记忆条数有关
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._expire_at: "OrderedDict[str, float]" = OrderedDict()
+        self._owner: dict = {}
+        self._by_agent: dict = {}
+        self._by_app_key: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._expire_at)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._expire_at
+
+    def touch(self, key: str, memory: PopoBotMemory) -> None:
+        self._expire_at[key] = time.monotonic() + self.ttl_seconds
+        self._expire_at.move_to_end(key)
+        owner = (memory.agent_app_id, memory.popo_app_key)
+        if self._owner.get(key) != owner:
+            self._unlink(key)
+            self._owner[key] = owner
+            self._by_agent.setdefault(owner[0], set()).add(key)
+            self._by_app_key.setdefault(owner[1], set()).add(key)
+
+    def discard(self, key: str) -> None:
+        if self._expire_at.pop(key, None) is not None:
+            self._unlink(key)
+
+    def _unlink(self, key: str) -> None:
+        owner = self._owner.pop(key, None)
+        if owner is None:
+            return
+        for index, value in ((self._by_agent, owner[0]), (self._by_app_key, owner[1])):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+    def pop_oldest(self) -> str:
+        key = next(iter(self._expire_at))
+        self.discard(key)
+        return key
+
+    def pop_expired(self, limit: int = None, now: float = None) -> list:
+        """弹出过期时间早于now的key，now默认为当前时间"""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        while self._expire_at and (limit is None or len(expired) < limit):
+            key, expire_at = next(iter(self._expire_at.items()))
+            if expire_at > now:
+                break
+            self.discard(key)
+            expired.append(key)
+        return expired
+
+    def pop_idle(self, idle_seconds: float, popo_app_key: str = None) -> list:
+        # 写入时间早于 now-idle_seconds 等价于过期时间早于 now-idle_seconds+有效期
+        now = time.monotonic() - idle_seconds + self.ttl_seconds
+        if popo_app_key is None:
+            return self.pop_expired(now=now)
+        idle = [key for key in self._by_app_key.get(popo_app_key, ()) if self._expire_at[key] <= now]
+        for key in idle:
+            self.discard(key)
+        return idle
+
+    def keys(self, agent_app_id: str = None, popo_app_key: str = None) -> list:
+        if agent_app_id is None and popo_app_key is None:
+            return list(self._expire_at)
+        candidates = [self._by_agent.get(agent_app_id, set()) if agent_app_id is not None else None,
+                      self._by_app_key.get(popo_app_key, set()) if popo_app_key is not None else None]
+        candidates = [keys for keys in candidates if keys is not None]
+        smallest = min(candidates, key=len)
+        return [key for key in smallest if all(key in keys for keys in candidates)]
+
+    def pop_matching(self, agent_app_id: str = None, popo_app_key: str = None) -> list:
+        keys = self.keys(agent_app_id, popo_app_key)
+        for key in keys:
+            self.discard(key)
+        return keys
+
+
+class InProcessMemoryBackend(PopoBotMemoryBackend):
+    """进程内的LRU+TTL记忆，插件重启后丢失"""
+
+    def __init__(self, max_size: int = memory_max_size, ttl_seconds: float = memory_validity_period * 3600):
+        self.max_size = max_size
+        self._memories: dict = {}
+        self._index = _MemoryIndex(ttl_seconds)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._memories)
+
+    def get(self, key: str) -> Optional[PopoBotMemory]:
+        with self._lock:
+            memory = self._memories.get(key)
+            if memory is not None and memory.is_expired():
+                self._remove_locked(key)
+                return None
+            return memory
+
+    def set(self, key: str, memory: PopoBotMemory) -> None:
+        with self._lock:
+            self._memories[key] = memory
+            self._index.touch(key, memory)
+            while len(self._memories) > self.max_size:
+                self._memories.pop(self._index.pop_oldest(), None)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._remove_locked(key)
+
+    def discard(self, key: str, memory: PopoBotMemory) -> None:
+        """记忆仍是memory时才删除，不影响并发写入的新记忆"""
+        with self._lock:
+            if self._memories.get(key) is memory:
+                self._remove_locked(key)
+
+    def sweep(self) -> int:
+        with self._lock:
+            return self._drop_locked(self._index.pop_expired())
+
+    def clear(self, agent_app_id: str = None, popo_app_key: str = None) -> int:
+        with self._lock:
+            return self._drop_locked(self._index.pop_matching(agent_app_id, popo_app_key))
+
+    def clear_idle(self, idle_seconds: float, popo_app_key: str = None) -> int:
+        with self._lock:
+            return self._drop_locked(self._index.pop_idle(idle_seconds, popo_app_key))
+
+    def list_keys(self, agent_app_id: str = None, popo_app_key: str = None) -> list:
+        with self._lock:
+            return self._index.keys(agent_app_id, popo_app_key)
+
+    def _drop_locked(self, keys: list) -> int:
+        for key in keys:
+            self._memories.pop(key, None)
+        return len(keys)
+
+    def _remove_locked(self, key: str) -> None:
+        self._memories.pop(key, None)
+        self._index.discard(key)
+
+
+class SessionStorageMemoryBackend(PopoBotMemoryBackend):
+    """
+    基于插件持久化存储（session.storage）的记忆，插件重启、多个插件进程之间共享
+
+    session.storage只在端点返回前可用，所以每次调用都用当前请求的storage创建一个实例。
+    智能体调用送出后端点随即返回，之后写入的记忆（set）只放进进程内记忆，由同一会话下一条消息读取记忆时
+    （端点仍在等待，session有效）写入持久化存储；只有一条消息的会话不会被持久化。
+    每个popo机器人在持久化存储中维护一份记忆key列表，过期清理、批量清理和列出记忆都基于这份列表，
+    插件重启前和其他插件进程写入的记忆同样可见。多个进程同时新增key时可能漏记少量key，这些记忆仍会在读取时按有效期删除。
+    """
+
+    # 本进程确认已在key列表中的记忆key，避免每次写入都读写key列表
+    _indexed_keys: "OrderedDict[str, None]" = OrderedDict()
+    # popo_app_key -> 本进程上次清理的时间（time.monotonic）
+    _last_sweep: dict = {}
+    # popo_app_key -> 下次清理从key列表的哪个位置开始
+    _sweep_cursor: dict = {}
+    _state_lock = threading.Lock()
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @staticmethod
+    def get_index_key(popo_app_key: str) -> str:
+        return "popobot_conversation_memory_index_" + popo_app_key
+
+    def get(self, key: str) -> Optional[PopoBotMemory]:
+        # session失效后写入、尚未持久化的记忆
+        pending = in_process_backend.get(key)
+        memory = self._read(key)
+        if pending is not None:
+            if memory is None or pending.last_time >= memory.last_time:
+                # 先持久化再移除，并发读取的调用总能读到其中之一
+                self._persist(key, pending)
+                memory = pending
+            in_process_backend.discard(key, pending)
+        if memory is not None and memory.is_expired():
+            self.delete(key)
+            return None
+        return memory
+
+    def set(self, key: str, memory: PopoBotMemory) -> None:
+        # 调用方在智能体调用送出之后写入，session可能已失效
+        in_process_backend.set(key, memory)
+
+    def delete(self, key: str) -> None:
+        # key列表中的记录由清理时移除
+        in_process_backend.delete(key)
+        self._delete_from_storage([key])
+
+    def sweep(self, limit: int = None, popo_app_key: str = None) -> int:
+        """检查popo机器人key列表中的一批记忆，删除已过期和已不存在的，返回删除的条数"""
+        if popo_app_key is None:
+            raise ValueError("持久化记忆只能按popo机器人清理")
+        index = self._load_index(popo_app_key)
+        if not index:
+            return 0
+        keys = sorted(index)
+        if limit is None:
+            limit = max(storage_sweep_batch, len(keys) // storage_sweep_rounds + 1)
+        with self._state_lock:
+            start = self._sweep_cursor.get(popo_app_key, 0) % len(keys)
+            self._sweep_cursor[popo_app_key] = start + limit
+        batch = (keys[start:] + keys[:start])[:limit]
+        expired = [key for key in batch if self._is_stale(key)]
+        return self._remove(popo_app_key, expired)
+
+    def sweep_if_due(self, popo_app_key: str) -> int:
+        """距本进程上次清理该popo机器人的记忆超过memory_sweep_interval时清理一批"""
+        now = time.monotonic()
+        with self._state_lock:
+            if now - self._last_sweep.get(popo_app_key, now - memory_sweep_interval) < memory_sweep_interval:
+                return 0
+            self._last_sweep[popo_app_key] = now
+        return self.sweep(popo_app_key=popo_app_key)
+
+    def clear(self, agent_app_id: str = None, popo_app_key: str = None) -> int:
+        if popo_app_key is None:
+            raise ValueError("持久化记忆只能按popo机器人清理")
+        keys = self.list_keys(agent_app_id, popo_app_key)
+        return self._remove(popo_app_key, keys)
+
+    def clear_idle(self, idle_seconds: float, popo_app_key: str = None) -> int:
+        if popo_app_key is None:
+            raise ValueError("持久化记忆只能按popo机器人清理")
+        deadline = datetime.now() - timedelta(seconds=idle_seconds)
+        idle = []
+        for key in self.list_keys(popo_app_key=popo_app_key):
+            memory = self._read(key)
+            if memory is None or memory.last_time <= deadline:
+                idle.append(key)
+        return self._remove(popo_app_key, idle)
+
+    def list_keys(self, agent_app_id: str = None, popo_app_key: str = None) -> list:
+        if popo_app_key is None:
+            raise ValueError("持久化记忆只能按popo机器人列出")
+        index = self._load_index(popo_app_key)
+        return [key for key, agent in index.items() if agent_app_id is None or agent == agent_app_id]
+
+    def _read(self, key: str) -> Optional[PopoBotMemory]:
+        try:
+            if not self.storage.exist(key):
+                return None
+            return PopoBotMemory.from_json_bytes(self.storage.get(key))
+        except Exception as e:
+            logger.warning("读取持久化记忆失败: keyName = %s, error = %s", key, e)
+            return None
+
+    def _is_stale(self, key: str) -> bool:
+        memory = self._read(key)
+        return memory is None or memory.is_expired()
+
+    def _persist(self, key: str, memory: PopoBotMemory) -> None:
+        self.storage.set(key, memory.to_json_bytes())
+        with self._state_lock:
+            if key in self._indexed_keys:
+                self._indexed_keys.move_to_end(key)
+                return
+        index = self._load_index(memory.popo_app_key)
+        if key not in index:
+            index[key] = memory.agent_app_id
+            self._save_index(memory.popo_app_key, index)
+        with self._state_lock:
+            self._indexed_keys[key] = None
+            while len(self._indexed_keys) > memory_max_size:
+                self._indexed_keys.popitem(last=False)
+
+    def _remove(self, popo_app_key: str, keys: list) -> int:
+        """删除记忆并从key列表中移除"""
+        if not keys:
+            return 0
+        for key in keys:
+            in_process_backend.delete(key)
+        self._delete_from_storage(keys)
+        with self._state_lock:
+            for key in keys:
+                self._indexed_keys.pop(key, None)
+        # 重新读取key列表，减少覆盖其他进程刚加入的key
+        index = self._load_index(popo_app_key)
+        for key in keys:
+            index.pop(key, None)
+        self._save_index(popo_app_key, index)
+        return len(keys)
+
+    def _load_index(self, popo_app_key: str) -> dict:
+        """记忆key -> agent_app_id"""
+        index_key = self.get_index_key(popo_app_key)
+        try:
+            if not self.storage.exist(index_key):
+                return {}
+            return json.loads(self.storage.get(index_key))
+        except Exception as e:
+            logger.warning("读取持久化记忆的key列表失败: keyName = %s, error = %s", index_key, e)
+            return {}
+
+    def _save_index(self, popo_app_key: str, index: dict) -> None:
+        self.storage.set(self.get_index_key(popo_app_key), json.dumps(index, ensure_ascii=False).encode("utf-8"))
+
+    def _delete_from_storage(self, keys: list) -> int:
+        for key in keys:
+            try:
+                self.storage.delete(key)
+            except Exception as e:
+                logger.warning("删除持久化记忆失败: keyName = %s, error = %s", key, e)
+        return len(keys)
+
+
+# 进程内记忆，所有端点共享
+in_process_backend = InProcessMemoryBackend()
+_sweeper_started = False
+_sweeper_lock = threading.Lock()
+
+
+def _sweep_loop() -> None:
+    while True:
+        time.sleep(memory_sweep_interval)
+        try:
+            swept = in_process_backend.sweep()
+            if swept:
+                logger.debug("清理过期记忆%d条，剩余%d条", swept, len(in_process_backend))
+        except Exception as e:
+            logger.error("清理过期记忆失败: %s", e)
+
+
+def _ensure_sweeper() -> None:
+    global _sweeper_started
+    if _sweeper_started:
+        return
+    with _sweeper_lock:
+        if not _sweeper_started:
+            threading.Thread(target=_sweep_loop, name="popo-memory-sweeper", daemon=True).start()
+            _sweeper_started = True
+
+
+def get_memory_backend(plugin_settings: PopoBotEndpointSettings, storage=None) -> PopoBotMemoryBackend:
+    """按端点配置选择记忆后端，持久化存储需要传入当前请求的session.storage"""
+    # 持久化存储的记忆在session失效后也会先写入进程内记忆
+    _ensure_sweeper()
+    if plugin_settings.memory_backend == MemoryBackendType.STORAGE and storage is not None:
+        return SessionStorageMemoryBackend(storage)
+    return in_process_backend
+
+
+def sweep_storage_memory(popo_app_key: str, storage) -> int:
+    """
+    清理popo机器人已过期的持久化记忆，每个进程每隔memory_sweep_interval最多清理一批
+
+    持久化存储只在端点返回前可用，由回调端点在交接智能体调用之后、返回之前调用
+    """
+    try:
+        return SessionStorageMemoryBackend(storage).sweep_if_due(popo_app_key)
+    except Exception as e:
+        logger.error("清理过期的持久化记忆失败: %s", e)
+        return 0
+
+
 # 设置会话记忆
-def set_popobot_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings, conversation_id: str) -> None:
+def set_popobot_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings, conversation_id: str, storage=None) -> None:
     if rebot_event.event_type == PopoEventType.IM_P2P_TO_ROBOT_MSG:
         bot_account = rebot_event.event_data.from_
     else:
         bot_account = rebot_event.event_data.at_list[0]
     message_source = rebot_event.event_data.session_id
     key_name = get_memory_key_name(rebot_event,plugin_settings)
-    memory_content = PopoBotMemory(bot_account, message_source, conversation_id, datetime.strptime(rebot_event.event_data.addtime, "%Y-%m-%d %H:%M:%S"))
-    # session.storage.set(key_name, json.dumps(memory_content, ensure_ascii=False).encode('utf-8'))
-    memory_dict[key_name] = memory_content
-    logger.debug(f"存入记忆成功: keyName = {key_name}, memory_content = {memory_content.to_dict()}")
+    memory_content = PopoBotMemory(bot_account, message_source, conversation_id, datetime.strptime(rebot_event.event_data.addtime, "%Y-%m-%d %H:%M:%S"),
+                                   plugin_settings.agent_app_id, plugin_settings.popo_app_key)
+    get_memory_backend(plugin_settings, storage).set(key_name, memory_content)
+    logger.debug("存入记忆成功: keyName = %s, memory_content = %s", key_name, lazy(memory_content.to_dict))
+
+class PopoConversationReservation:
+    """
+    get-or-reserve的结果
+
+    - memory不为None：已有会话，直接使用memory.conversation_id
+    - is_owner为True：没有会话，由调用方创建新会话，拿到conversation_id后必须commit，失败时release
+    调用结束后用commit刷新记忆的最后消息时间（与原来的set_popobot_memory一致）；
+    commit在智能体调用送出之后，持久化存储的记忆此时只写入进程内，下次读取时再持久化
+    """
+
+    def __init__(self, key_name: str, memory: Optional[PopoBotMemory], is_owner: bool,
+                 rebot_event: RobotEvent = None, plugin_settings: PopoBotEndpointSettings = None, storage=None):
+        self.key_name = key_name
+        self.memory = memory
+        self.is_owner = is_owner
+        self._rebot_event = rebot_event
+        self._plugin_settings = plugin_settings
+        self._storage = storage
+
+    @property
+    def conversation_id(self) -> str:
+        return "" if self.memory is None else self.memory.conversation_id
+
+    def commit(self, conversation_id: str) -> None:
+        """保存会话并唤醒等待中的调用，可重复调用"""
+        set_popobot_memory(self._rebot_event, self._plugin_settings, conversation_id, self._storage)
+        self.release()
+
+    def release(self) -> None:
+        if self.is_owner:
+            self.is_owner = False
+            with _reservation_lock:
+                event = _reservations.pop(self.key_name, None)
+            if event is not None:
+                event.set()
+
+    def __enter__(self) -> "PopoConversationReservation":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+# 正在创建会话的key，同一进程内同一会话同时只有一个调用创建新会话
+_reservations: dict = {}
+_reservation_lock = threading.Lock()
+
+
+# 原子地获取会话记忆，没有记忆时预占创建会话的权利
+def reserve_popobot_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings, storage=None,
+                           timeout: float = reservation_wait_timeout) -> PopoConversationReservation:
+    key_name = get_memory_key_name(rebot_event, plugin_settings)
+    backend = get_memory_backend(plugin_settings, storage)
+    deadline = time.monotonic() + timeout
+    while True:
+        memory = backend.get(key_name)
+        if memory is not None:
+            return PopoConversationReservation(key_name, memory, False, rebot_event, plugin_settings, storage)
+        with _reservation_lock:
+            event = _reservations.get(key_name)
+            if event is None:
+                _reservations[key_name] = threading.Event()
+                reservation = PopoConversationReservation(key_name, None, True, rebot_event, plugin_settings, storage)
+                break
+        # 同一会话中先到的调用正在创建会话，等它commit后复用它的conversation_id
+        logger.debug("等待会话创建: keyName = %s", key_name)
+        if not event.wait(max(0.0, deadline - time.monotonic())):
+            logger.warning("等待会话创建超时，将创建新会话: keyName = %s", key_name)
+            return PopoConversationReservation(key_name, None, False, rebot_event, plugin_settings, storage)
+    # 拿到预占后再读一次：上一个调用可能在我们读记忆和加锁之间刚好commit
+    memory = backend.get(key_name)
+    if memory is not None:
+        reservation.release()
+        return PopoConversationReservation(key_name, memory, False, rebot_event, plugin_settings, storage)
+    return reservation
+
 
 # 获取会话记忆
-def get_popobot_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings) -> "PopoBotMemory | None":
+def get_popobot_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings, storage=None) -> "PopoBotMemory | None":
     key_name = get_memory_key_name(rebot_event,plugin_settings)
-    # memory_content_dict = session.storage.get(key_name).decode('utf-8')
-    memory_content = memory_dict.get(key_name)
-    if memory_content is None:
-        return None
-    elif datetime.now() > memory_content.last_time + timedelta(hours=memory_validity_period):
-        memory_dict.pop(key_name,None)
-        return None
-    else:
-        return memory_content
+    return get_memory_backend(plugin_settings, storage).get(key_name)
 
 
-def clear_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings) -> None:
+def clear_memory(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings, storage=None) -> None:
     key_name = get_memory_key_name(rebot_event,plugin_settings)
-    memory_dict.pop(key_name,None)
+    get_memory_backend(plugin_settings, storage).delete(key_name)
+
+
+def _memory_backends(storage=None) -> list:
+    backends = [in_process_backend]
+    if storage is not None:
+        backends.append(SessionStorageMemoryBackend(storage))
+    return backends
+
+
+# 以下批量操作作用于进程内记忆；传入storage时同时作用于持久化存储中该popo机器人key列表里的记忆
+# 由回调端点的记忆管理请求调用，都限定在端点自己的popo机器人内，不提供跨机器人清理的操作
+def clear_memory_by_agent(agent_app_id: str, popo_app_key: str, storage=None) -> int:
+    """清理popo机器人下指定智能体的记忆，同一智能体接入的其他机器人的会话不受影响"""
+    return sum(backend.clear(agent_app_id=agent_app_id, popo_app_key=popo_app_key)
+               for backend in _memory_backends(storage))
+
+
+def clear_memory_by_app_key(popo_app_key: str, storage=None) -> int:
+    return sum(backend.clear(popo_app_key=popo_app_key) for backend in _memory_backends(storage))
+
+
+def clear_idle_memory(idle_seconds: float, storage=None, popo_app_key: str = None) -> int:
+    """清理超过idle_seconds秒没有新消息的记忆"""
+    return sum(backend.clear_idle(idle_seconds, popo_app_key) for backend in _memory_backends(storage))
+
+
+def list_memory_keys(agent_app_id: str = None, popo_app_key: str = None, storage=None) -> list:
+    keys = []
+    for backend in _memory_backends(storage):
+        keys.extend(backend.list_keys(agent_app_id, popo_app_key))
+    # 尚未持久化的记忆可能同时在持久化存储中有旧版本
+    return list(dict.fromkeys(keys))
+
 
+def count_memory(agent_app_id: str = None, popo_app_key: str = None, storage=None) -> int:
+    return len(list_memory_keys(agent_app_id, popo_app_key, storage))
 
-def clear_all_memory() -> None:
-    pass
 
 def get_memory_key_name(rebot_event:RobotEvent, plugin_settings: PopoBotEndpointSettings) -> str:
-    return "popobot_conversation_memory_" + plugin_settings.agent_app_id + "_" + plugin_settings.popo_app_key + "_" + rebot_event.event_data.session_id
\ No newline at end of file
+    return "popobot_conversation_memory_" + plugin_settings.agent_app_id + "_" + plugin_settings.popo_app_key + "_" + rebot_event.event_data.session_id
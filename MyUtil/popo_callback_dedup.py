@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from models.popo_bot_callback_structures import RobotEvent
+from MyUtil.popo_logging import get_logger
+
+"""
+POPO回调去重
+
+POPO在3秒内未收到响应时会重发回调，同一条消息（event_data.uuid）只应触发一次智能体调用。
+进程内按时间窗口记录已处理的回调，超过窗口或条数上限时从最早的开始淘汰；
+端点配置callback_dedup_backend为storage时传入session.storage，同时写入持久化存储，插件重启或多个插件进程之间也能识别重发。
+"""
+
+logger = get_logger(__name__)
+
+# 去重时间窗口，秒（POPO的重发都在几分钟内）
+dedup_window_seconds = 600
+# 进程内最多记录的回调数
+dedup_max_size = 20000
+# 持久化存储每次写入时顺带清理的过期记录条数
+storage_sweep_batch = 5
+
+
+def get_dedup_key(robot_event: RobotEvent, popo_app_key: str) -> str:
+    """
+    回调的去重key
+
+    撤回事件与被撤回消息的uuid相同，所以带上事件类型；同一条群消息可能@了多个机器人，所以带上popo_app_key
+    """
+    return f"popo_callback_dedup_{popo_app_key}_{robot_event.event_type.value}_{robot_event.event_data.uuid}"
+
+
+class PopoCallbackDeduplicator:
+    def __init__(self, window_seconds: float = dedup_window_seconds, max_size: int = dedup_max_size):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        # key -> (首次收到的时间（time.time()）, popo_app_key)，按首次收到的顺序排列
+        self._seen: "OrderedDict[str, tuple]" = OrderedDict()
+        # 本进程写入持久化存储、尚未清理的key，按写入顺序排列
+        self._stored: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        # 统计信息，按popo_app_key分组，端点只返回自己机器人的统计
+        self._checked: Counter = Counter()
+        self._duplicates: Counter = Counter()
+        self._size: Counter = Counter()
+
+    def is_duplicate(self, key: str, storage=None, popo_app_key: str = None) -> bool:
+        """
+        检查回调是否已处理过，未处理过的同时标记为已处理
+
+        :param storage: session.storage，不传则只在进程内去重
+        :param popo_app_key: 统计所属的popo机器人
+        """
+        now = time.time()
+        with self._lock:
+            self._checked[popo_app_key] += 1
+            self._evict_locked(now)
+            if key in self._seen:
+                self._duplicates[popo_app_key] += 1
+                return True
+            self._seen[key] = (now, popo_app_key)
+            self._size[popo_app_key] += 1
+        if storage is None:
+            return False
+
+        # 其他进程可能已处理过该回调
+        try:
+            if storage.exist(key):
+                seen_at = float(storage.get(key).decode())
+                if now - seen_at < self.window_seconds:
+                    with self._lock:
+                        self._duplicates[popo_app_key] += 1
+                    return True
+            storage.set(key, str(now).encode())
+        except Exception as e:
+            # 持久化存储异常时退化为进程内去重
+            logger.warning("回调去重读写持久化存储失败: key = %s, error = %s", key, e)
+            return False
+        with self._lock:
+            self._stored[key] = now
+            expired = self._pop_stored_expired_locked(now, storage_sweep_batch)
+        # 存储调用是网络请求，不在锁内执行
+        for expired_key in expired:
+            try:
+                storage.delete(expired_key)
+            except Exception as e:
+                logger.warning("清理回调去重记录失败: key = %s, error = %s", expired_key, e)
+        return False
+
+    def forget(self, key: str, storage=None) -> None:
+        """撤销标记，之后的重发会被当作新回调处理"""
+        with self._lock:
+            seen = self._seen.pop(key, None)
+            if seen is not None:
+                self._discount_size_locked(seen[1])
+            stored = self._stored.pop(key, None) is not None
+        if storage is not None and stored:
+            try:
+                storage.delete(key)
+            except Exception as e:
+                logger.warning("清理回调去重记录失败: key = %s, error = %s", key, e)
+
+    def _evict_locked(self, now: float) -> None:
+        seen = self._seen
+        while seen:
+            key, (seen_at, popo_app_key) = next(iter(seen.items()))
+            if now - seen_at < self.window_seconds and len(seen) < self.max_size:
+                break
+            seen.popitem(last=False)
+            self._discount_size_locked(popo_app_key)
+
+    def _discount_size_locked(self, popo_app_key: str) -> None:
+        self._size[popo_app_key] -= 1
+        if self._size[popo_app_key] <= 0:
+            del self._size[popo_app_key]
+
+    def _pop_stored_expired_locked(self, now: float, limit: int) -> list:
+        expired = []
+        stored = self._stored
+        while stored and len(expired) < limit:
+            key, stored_at = next(iter(stored.items()))
+            if now - stored_at < self.window_seconds:
+                break
+            stored.popitem(last=False)
+            expired.append(key)
+        return expired
+
+    def get_stats(self, popo_app_key: str) -> dict:
+        """popo机器人的去重命中率，即重发回调占该机器人全部回调的比例"""
+        with self._lock:
+            checked = self._checked[popo_app_key]
+            duplicates = self._duplicates[popo_app_key]
+            return {
+                "checked": checked,
+                "duplicates": duplicates,
+                "hit_rate": round(duplicates / checked, 4) if checked else 0.0,
+                "size": self._size[popo_app_key],
+            }
+
+
+_deduplicator = None
+_deduplicator_lock = threading.Lock()
+
+
+def get_callback_deduplicator() -> PopoCallbackDeduplicator:
+    global _deduplicator
+    if _deduplicator is None:
+        with _deduplicator_lock:
+            if _deduplicator is None:
+                _deduplicator = PopoCallbackDeduplicator()
+    return _deduplicator
@@ -1,12 +1,86 @@
 import base64
-
-from Crypto.Cipher import AES
+import binascii
 import hashlib
+import hmac
+import json
+from typing import Any, Union
 
 """
 POPO消息加解密工具
 """
 
+# AES分组长度，字节
+block_size = 16
+# base64密文超过这个长度时按块流式解密，字符数
+stream_decrypt_threshold = 16 * 1024
+# 流式解密每次处理的base64字符数（4的整数倍）
+stream_chunk_size = 64 * 1024
+
+
+def _aes():
+    """pycryptodome加载较慢，第一次加解密时才导入，插件启动时不需要"""
+    from Crypto.Cipher import AES
+    return AES
+
+
+def _strip_padding(buffer: bytearray) -> bytearray:
+    """校验并原地去除PKCS#7补位，补位不合法（通常是密钥不正确）时抛出ValueError"""
+    pad = buffer[-1] if buffer else 0
+    if not 1 <= pad <= block_size or buffer.count(pad, len(buffer) - pad) != pad:
+        raise ValueError("解密失败，补位校验不通过，请检查aes_key是否正确")
+    del buffer[-pad:]
+    return buffer
+
+
+class AESCBCStreamDecryptor:
+    """
+    分块解密base64编码的AES/CBC密文，适合很大的合并消息
+
+    base64文本可以分多次、按任意长度传入，解码、解密后的明文直接写入同一个预分配的缓冲区，
+    不会同时保留完整的密文、解密结果和去掉补位后的副本。
+
+        decryptor = aes_cipher.stream_decryptor(len(encrypted_text) // 4 * 3)
+        for chunk in chunks:
+            decryptor.update(chunk)
+        plaintext = decryptor.finish()
+    """
+
+    def __init__(self, key: bytes, iv: bytes, size_hint: int = 0):
+        AES = _aes()
+        self._cipher = AES.new(key=key, mode=AES.MODE_CBC, IV=iv)
+        # 明文缓冲区，size_hint不小于明文长度时不会再扩容
+        self._buffer = bytearray(size_hint)
+        self._length = 0
+        # 不足4个字符的base64、不足一个分组的密文，留到下次一起处理
+        self._base64_tail = b""
+        self._cipher_tail = b""
+
+    def update(self, encrypted_chunk: Union[str, bytes]) -> None:
+        if isinstance(encrypted_chunk, str):
+            encrypted_chunk = encrypted_chunk.encode("ascii")
+        data = self._base64_tail + encrypted_chunk
+        usable = len(data) - len(data) % 4
+        self._base64_tail = data[usable:]
+        encrypted = self._cipher_tail + binascii.a2b_base64(data[:usable])
+        size = len(encrypted) - len(encrypted) % block_size
+        self._cipher_tail = encrypted[size:]
+        if not size:
+            return
+        end = self._length + size
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(end - len(self._buffer)))
+        self._cipher.decrypt(memoryview(encrypted)[:size], output=memoryview(self._buffer)[self._length:end])
+        self._length = end
+
+    def finish(self) -> bytearray:
+        """返回去掉补位的明文"""
+        if self._base64_tail or self._cipher_tail:
+            raise ValueError("加密文本长度不是16字节的整数倍")
+        if not self._length:
+            raise ValueError("加密文本不能为空")
+        del self._buffer[self._length:]
+        return _strip_padding(self._buffer)
+
 
 class AESCipher:
     '''
@@ -21,53 +95,80 @@ class AESCipher:
         # 偏移量
         self.iv = iv.encode()
 
-    def aes_cbc_encrypt(self, text):
+    def aes_cbc_encrypt(self, text: Union[str, bytes]) -> str:
         """
         AES/CBC/PKCS5Padding 加密
         """
-        BLOCK_SIZE = AES.block_size
-        # 需要加密的文件，不足BLOCK_SIZE的补位(text可能是含中文，而中文字符utf-8编码占3个位置,gbk是2，所以需要以len(text.encode())，而不是len(text)计算补码)
-        text = text + (BLOCK_SIZE - len(text.encode()) % BLOCK_SIZE) * chr(BLOCK_SIZE - len(text.encode()) % BLOCK_SIZE)
+        # 按UTF-8编码后的长度补位（中文占3个字节），只编码一次
+        data = text.encode() if isinstance(text, str) else bytes(text)
+        pad = block_size - len(data) % block_size
+        data += bytes((pad,)) * pad
         # 创建一个aes对象 key 秘钥 mdoe 定义模式 iv#偏移量--必须16字节
+        AES = _aes()
         cipher = AES.new(key=self.key, mode=AES.MODE_CBC, IV=self.iv)
         # 利用AES对象进行加密
-        encrypted_text = cipher.encrypt(text.encode())
+        encrypted_text = cipher.encrypt(data)
 
         return base64.b64encode(encrypted_text).decode('utf-8')
 
-    def aes_cbc_decrypt(self, encrypted_text):
+    def stream_decryptor(self, size_hint: int = 0) -> AESCBCStreamDecryptor:
+        """分块解密用的解密器，size_hint为预计的明文字节数"""
+        return AESCBCStreamDecryptor(self.key, self.iv, size_hint)
+
+    def aes_cbc_decrypt_bytes(self, encrypted_text: Union[str, bytes]) -> bytearray:
         """
-        AES/CBC/PKCS5Padding 解密
+        AES/CBC/PKCS5Padding 解密，返回去掉补位的明文字节
+
+        短密文整段解密，长密文按块流式解密，明文都直接写入预分配的缓冲区
         """
         if not encrypted_text:
             raise ValueError("加密文本不能为空")
-        try:
-            encrypted_text = base64.b64decode(encrypted_text)
-            # 创建一个aes对象 key 秘钥 mdoe 定义模式 iv#偏移量--必须16字节
-            cipher = AES.new(key=self.key, mode=AES.MODE_CBC, IV=self.iv)
-            # 利用AES对象进行解密
-            decrypted_text = cipher.decrypt(encrypted_text)
-            # 去除补位
-            dec_res = decrypted_text[:-ord(decrypted_text[len(decrypted_text) - 1:])]
-            return dec_res.decode()
-        except Exception as e:
-            raise
+        if len(encrypted_text) > stream_decrypt_threshold:
+            decryptor = self.stream_decryptor(len(encrypted_text) // 4 * 3)
+            for start in range(0, len(encrypted_text), stream_chunk_size):
+                decryptor.update(encrypted_text[start:start + stream_chunk_size])
+            return decryptor.finish()
+
+        encrypted = binascii.a2b_base64(encrypted_text)
+        if not encrypted or len(encrypted) % block_size:
+            raise ValueError("加密文本长度不是16字节的整数倍")
+        # 秘钥必须16字节
+        AES = _aes()
+        decrypted = bytearray(len(encrypted))
+        AES.new(key=self.key, mode=AES.MODE_CBC, IV=self.iv).decrypt(encrypted, output=decrypted)
+        return _strip_padding(decrypted)
+
+    def aes_cbc_decrypt(self, encrypted_text) -> str:
+        """
+        AES/CBC/PKCS5Padding 解密
+        """
+        return self.aes_cbc_decrypt_bytes(encrypted_text).decode()
+
+    def aes_cbc_decrypt_json(self, encrypted_text) -> Any:
+        """解密并解析JSON，POPO的回调固定为UTF-8，直接解码明文缓冲区（json.loads传入bytes时还会先探测编码）"""
+        return json.loads(self.aes_cbc_decrypt_bytes(encrypted_text).decode())
 
     def popo_check_signature(self, token: str, timestamp, nonce, signature):
-        temp_data_dict = {
-            'token': token,
-            'timestamp': timestamp,
-            'nonce': nonce
-        }
-        sorted_data = sorted(temp_data_dict.items(), key=lambda x: x[1])
-        data = ''
-        for k, v in sorted_data:
-            data += v
-        hash_object = hashlib.sha256()
-        hash_object.update(data.encode())
-        hash_value = hash_object.hexdigest()
-
-        return hash_value == signature
+        return PopoSignatureVerifier(token).verify(timestamp, nonce, signature)
+
+
+class PopoSignatureVerifier:
+    """
+    POPO回调签名校验：sha256(token、timestamp、nonce按字典序拼接)
+
+    同一个机器人token可以复用同一个实例
+    """
+
+    def __init__(self, token: str):
+        self.token = token or ""
+
+    def verify(self, timestamp, nonce, signature) -> bool:
+        if not timestamp or not nonce or not signature:
+            return False
+        data = "".join(sorted((self.token, timestamp, nonce)))
+        hash_value = hashlib.sha256(data.encode()).hexdigest()
+        # 常量时间比较，避免通过响应时间猜测签名
+        return hmac.compare_digest(hash_value.encode(), str(signature).encode())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Mapping
+
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_encryption_tool import AESCipher, PopoSignatureVerifier
+from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings
+
+"""
+端点配置缓存
+
+按端点配置的指纹缓存解析后的配置、AES加解密对象和签名校验对象，回调时不再每次重新解析配置和派生密钥。
+缓存按最近使用淘汰；多个端点可以共用同一个popo机器人，每个机器人最多保留max_configs_per_app_key份配置，
+配置被修改后旧指纹对应的缓存随之淘汰。
+"""
+
+# 最多缓存的端点配置数
+max_cached_configs = 256
+# 同一个popo机器人最多缓存的配置数（多个端点共用一个机器人，或配置被修改）
+max_configs_per_app_key = 8
+
+
+@dataclass
+class PopoEndpointConfig:
+    fingerprint: str
+    plugin_settings: PopoBotEndpointSettings
+    aes_cipher: AESCipher
+    signature_verifier: PopoSignatureVerifier
+    popo_bot: PopoBot
+
+
+def get_settings_fingerprint(settings: Mapping) -> str:
+    """
+    端点配置的指纹，配置的任何字段变化都会得到不同的指纹
+
+    对repr取sha256，比json序列化快，缓存的key中也不保留appSecret、aesKey等原文；字段顺序不同只会多一次缓存未命中
+    """
+    return hashlib.sha256(repr(settings).encode("utf-8")).hexdigest()
+
+
+class PopoEndpointConfigCache:
+    def __init__(self, max_size: int = max_cached_configs):
+        self.max_size = max_size
+        # 指纹 -> 配置，按最近使用排序
+        self._configs: "OrderedDict[str, PopoEndpointConfig]" = OrderedDict()
+        # popo_app_key -> 该机器人缓存中的配置指纹，按最近使用排序
+        self._fingerprints_by_app_key: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, settings: Mapping) -> PopoEndpointConfig:
+        fingerprint = get_settings_fingerprint(settings)
+        with self._lock:
+            config = self._configs.get(fingerprint)
+            if config is not None:
+                self._configs.move_to_end(fingerprint)
+                self._fingerprints_by_app_key[config.plugin_settings.popo_app_key].move_to_end(fingerprint)
+                return config
+
+        # 解析失败时直接抛出，与之前每次解析配置的行为一致
+        plugin_settings = PopoBotEndpointSettings(settings)
+        config = PopoEndpointConfig(
+            fingerprint=fingerprint,
+            plugin_settings=plugin_settings,
+            aes_cipher=AESCipher(plugin_settings.aes_key or ""),
+            signature_verifier=PopoSignatureVerifier(plugin_settings.token),
+            popo_bot=PopoBot(plugin_settings.popo_app_key, plugin_settings.popo_app_secret),
+        )
+        with self._lock:
+            if fingerprint in self._configs:
+                # 并发的请求已经放入了同一份配置
+                return self._configs[fingerprint]
+            fingerprints = self._fingerprints_by_app_key.setdefault(plugin_settings.popo_app_key, OrderedDict())
+            fingerprints[fingerprint] = None
+            self._configs[fingerprint] = config
+            if len(fingerprints) > max_configs_per_app_key:
+                # 同一个机器人最久未使用的配置，通常是修改前的旧配置
+                self._evict_locked(next(iter(fingerprints)))
+            while len(self._configs) > self.max_size:
+                self._evict_locked(next(iter(self._configs)))
+        return config
+
+    def _evict_locked(self, fingerprint: str) -> None:
+        evicted = self._configs.pop(fingerprint)
+        app_key = evicted.plugin_settings.popo_app_key
+        fingerprints = self._fingerprints_by_app_key[app_key]
+        del fingerprints[fingerprint]
+        if not fingerprints:
+            del self._fingerprints_by_app_key[app_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._configs.clear()
+            self._fingerprints_by_app_key.clear()
+
+    def __len__(self) -> int:
+        return len(self._configs)
+
+
+_config_cache = None
+_config_cache_lock = threading.Lock()
+
+
+def get_endpoint_config_cache() -> PopoEndpointConfigCache:
+    global _config_cache
+    if _config_cache is None:
+        with _config_cache_lock:
+            if _config_cache is None:
+                _config_cache = PopoEndpointConfigCache()
+    return _config_cache
+
+
+def get_endpoint_config(settings: Mapping) -> PopoEndpointConfig:
+    return get_endpoint_config_cache().get(settings)
@@ -0,0 +1,124 @@
+import threading
+from dataclasses import dataclass
+
+"""
+POPO开放平台HTTP客户端
+
+所有调用open.popo.netease.com（以及自定义机器人webhook）的请求共用同一个requests.Session，
+按host复用连接池并保持长连接，避免每条回复都重新做一次TCP+TLS握手。
+Session在第一次请求时才创建，插件启动时不会加载requests。
+"""
+
+
+@dataclass
+class PopoHttpClientConfig:
+    # 缓存的host连接池数量（每个host一个池）
+    pool_connections: int = 10
+    # 每个host连接池内保持的最大连接数
+    pool_maxsize: int = 32
+    # 连接池满时是否阻塞等待空闲连接（False则临时新建连接，用完即丢弃）
+    pool_block: bool = False
+    # 建立连接超时，秒
+    connect_timeout: float = 3.0
+    # 读取响应超时，秒
+    read_timeout: float = 5.0
+    # 连接失败的重试次数（请求未发出，重试不会导致重复发送）
+    connect_retries: int = 2
+    # 读取失败/特定状态码的重试次数，发消息接口非幂等，默认不重试
+    read_retries: int = 0
+    # 重试退避系数，第n次重试前等待 backoff_factor * 2^(n-1) 秒
+    backoff_factor: float = 0.2
+    # 需要重试的HTTP状态码（仅在read_retries>0时生效）
+    status_forcelist: tuple = (502, 503, 504)
+
+
+class PopoHttpClient:
+    """线程安全、懒加载的连接池HTTP客户端"""
+
+    def __init__(self, config: PopoHttpClientConfig = None):
+        self.config = config or PopoHttpClientConfig()
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self) -> tuple:
+        return self.config.connect_timeout, self.config.read_timeout
+
+    def _build_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        config = self.config
+        retry = Retry(
+            total=None,
+            connect=config.connect_retries,
+            read=config.read_retries,
+            status=config.read_retries,
+            other=0,
+            backoff_factor=config.backoff_factor,
+            status_forcelist=config.status_forcelist,
+            allowed_methods=None,  # POST同样按上面的次数重试，非幂等场景由read_retries=0保证
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config.pool_connections,
+            pool_maxsize=config.pool_maxsize,
+            pool_block=config.pool_block,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @property
+    def session(self):
+        # 双重检查，避免并发首次调用时重复创建
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._build_session()
+        return self._session
+
+    def post(self, url: str, timeout=None, **kwargs):
+        """
+        发送POST请求，未指定timeout时使用配置的(连接超时, 读取超时)
+
+        :param timeout: 单个数字表示读取超时（连接超时沿用配置），也可以传(连接超时, 读取超时)
+        """
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (self.config.connect_timeout, timeout)
+        return self.session.post(url, timeout=timeout, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+# 进程内共享的客户端
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_http_client() -> PopoHttpClient:
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = PopoHttpClient()
+    return _default_client
+
+
+def configure_http_client(config: PopoHttpClientConfig) -> PopoHttpClient:
+    """替换共享客户端的配置，旧的连接池会被关闭"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is not None:
+            _default_client.close()
+        _default_client = PopoHttpClient(config)
+    return _default_client
@@ -0,0 +1,111 @@
+import logging
+import os
+import sys
+import threading
+import time
+
+from dify_plugin.config.logger_format import plugin_logger_handler
+
+"""
+插件共用的日志配置
+
+- get_logger：各模块统一的logger，本地开发（Windows/macOS）输出DEBUG日志到控制台，线上只输出INFO及以上到插件日志
+- 日志参数用 %s 占位符传入，级别未开启时不会格式化；需要额外计算的参数用 lazy 包装，真正输出时才调用
+- 回调原文、解密内容、请求体等完整内容只在设置了环境变量 POPO_LOG_PAYLOADS=1 且开启DEBUG时输出（debug_payload）
+- 高频日志（重复回调、排队已满、频率限制等）用 log_sampled 按key限流，省略的条数附在下一条里
+"""
+
+# 本地开发环境，输出DEBUG日志到控制台
+is_dev = sys.platform in ('win32', 'cygwin', 'darwin')
+# 是否在DEBUG日志中输出完整的回调内容和请求体，默认不输出
+log_payloads = os.environ.get("POPO_LOG_PAYLOADS", "").lower() in ("1", "true", "yes")
+
+_dev_handler = None
+_configure_lock = threading.Lock()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """返回配置好handler和级别的logger，同一个name重复调用不会重复添加handler"""
+    global _dev_handler
+    logger = logging.getLogger(name)
+    if getattr(logger, "_popo_configured", False):
+        return logger
+    with _configure_lock:
+        if getattr(logger, "_popo_configured", False):
+            return logger
+        # 清空已有的handlers避免重复
+        logger.handlers.clear()
+        if is_dev:
+            logger.setLevel(logging.DEBUG)
+            # 开发环境所有模块共用一个控制台handler
+            if _dev_handler is None:
+                _dev_handler = logging.StreamHandler()
+                _dev_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+            logger.addHandler(_dev_handler)
+            logger.propagate = False  # 防止日志向父级传播
+        else:
+            logger.setLevel(logging.INFO)
+            logger.addHandler(plugin_logger_handler)
+        logger._popo_configured = True
+    return logger
+
+
+class lazy:
+    """
+    延迟计算的日志参数，只有日志真正输出时才调用func
+
+    logger.debug("记忆：%s", lazy(memory.to_dict))
+    """
+    __slots__ = ("_func", "_args")
+
+    def __init__(self, func, *args):
+        self._func = func
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._func(*self._args))
+
+
+def debug_payload(logger: logging.Logger, msg: str, *args) -> None:
+    """输出完整的回调内容、请求体等调试信息，需要设置环境变量 POPO_LOG_PAYLOADS=1"""
+    if log_payloads and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args)
+
+
+class LogSampler:
+    """高频日志限流：同一个key每interval秒最多输出一条，期间省略的条数附在下一条输出里"""
+
+    def __init__(self, interval: float = 10.0, max_keys: int = 1024):
+        self.interval = interval
+        self.max_keys = max_keys
+        # key -> [下次允许输出的时间time.monotonic, 省略的条数]
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def log(self, logger: logging.Logger, level: int, key, msg: str, *args) -> bool:
+        """返回这一条是否输出"""
+        if not logger.isEnabledFor(level):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None and now < state[0]:
+                state[1] += 1
+                return False
+            suppressed = state[1] if state is not None else 0
+            if state is None and len(self._states) >= self.max_keys:
+                self._states.clear()
+            self._states[key] = [now + self.interval, 0]
+        if suppressed:
+            msg += "（此前省略%d条同类日志）"
+            args += (suppressed,)
+        logger.log(level, msg, *args)
+        return True
+
+
+_log_sampler = LogSampler()
+
+
+def log_sampled(logger: logging.Logger, level: int, key, msg: str, *args) -> bool:
+    """用进程内共享的LogSampler输出高频日志"""
+    return _log_sampler.log(logger, level, key, msg, *args)
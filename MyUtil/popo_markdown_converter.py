@@ -0,0 +1,258 @@
+import re
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import Iterator, Optional
+
+"""
+Markdown转POPO消息格式
+
+只向后扫描、不回溯的实现，耗时与文本长度成线性关系，大模型输出大量括号等异常内容时也不会出现回溯爆炸。
+
+- 图片：![说明](地址) 转为POPO的 [img]地址[/img]。匹配规则与原来的正则
+  !\\[(.*?)]\\(([^()]*(\\([^()]*\\)[^()]*)*)\\) 完全一致：说明不跨行、取最短的可匹配说明，地址可跨行、
+  可以包含不嵌套的成对括号
+- 可选：链接、加粗、列表、代码块，POPO的rich_text只有纯文本，转换为可读的纯文本形式
+"""
+
+# 列表项转换后的前缀
+list_bullet = "• "
+
+
+# 只有单个字符类，查找下一个括号，不会回溯
+_paren_pattern = re.compile(r"[()]")
+
+
+def _find_all(text: str, sub: str) -> list:
+    positions = []
+    position = text.find(sub)
+    while position != -1:
+        positions.append(position)
+        position = text.find(sub, position + 1)
+    return positions
+
+
+def _url_end(text: str, position: int, memo: dict) -> Optional[int]:
+    """
+    从position开始解析图片地址，返回图片语法的结束位置，不匹配返回None
+
+    地址的解析只与之后的括号序列有关：深度0遇到")"结束，"("后的下一个括号必须是")"，否则不匹配。
+    按深度0时所在的括号位置记录结果，每个括号最多解析一次。
+    """
+    path = []
+    result = None
+    while True:
+        match = _paren_pattern.search(text, position)
+        if match is None:
+            break
+        paren = match.start()
+        if paren in memo:
+            result = memo[paren]
+            break
+        path.append(paren)
+        if text[paren] == ")":
+            result = paren + 1
+            break
+        match = _paren_pattern.search(text, paren + 1)
+        if match is None or text[match.start()] != ")":
+            break
+        position = match.start() + 1
+    for paren in path:
+        memo[paren] = result
+    return result
+
+
+def _next_candidate(text: str, position: int, memo: dict) -> "tuple[int, Optional[int]]":
+    """从position开始找下一个地址能匹配的"]("，返回其位置和图片语法的结束位置"""
+    candidate = text.find("](", position)
+    while candidate != -1:
+        end = _url_end(text, candidate + 2, memo)
+        if end is not None:
+            return candidate, end
+        candidate = text.find("](", candidate + 1)
+    return -1, None
+
+
+def iter_markdown_images(text: str) -> Iterator["tuple[int, int, int, int]"]:
+    """
+    按顺序找出与原正则相同的markdown图片
+
+    :return: (图片语法开始, 图片语法结束, 地址开始, 地址结束) 的迭代器
+    """
+    start = text.find("![")
+    if start == -1:
+        return
+    memo = {}
+    # 下一个可用的"]("、下一个换行，都只向后查找，整体线性
+    candidate, candidate_end = _next_candidate(text, start + 2, memo)
+    newline = -1
+    while start != -1 and candidate != -1:
+        if candidate < start + 2:
+            candidate, candidate_end = _next_candidate(text, start + 2, memo)
+            if candidate == -1:
+                break
+        if newline < start + 2:
+            newline = text.find("\n", start + 2)
+            if newline == -1:
+                newline = len(text)
+        if newline < candidate:
+            # 说明部分不能跨行
+            start = text.find("![", start + 1)
+            continue
+        yield start, candidate_end, candidate + 2, candidate_end - 1
+        start = text.find("![", candidate_end)
+
+
+def convert_markdown_images(text: str) -> str:
+    """把markdown图片链接转为 [img]地址[/img]，结果与原正则替换完全一致"""
+    parts = []
+    last_end = 0
+    for start, end, url_start, url_end in iter_markdown_images(text):
+        parts.append(text[last_end:start])
+        parts.append("[img]")
+        parts.append(text[url_start:url_end])
+        parts.append("[/img]")
+        last_end = end
+    if not parts:
+        return text
+    parts.append(text[last_end:])
+    return "".join(parts)
+
+
+def _convert_links(line: str, spans: list = None, offset: int = 0) -> str:
+    """
+    [文字](地址) 转为 文字（地址），地址不含空白和括号
+
+    :param spans: 不为None时追加转换后每个链接的 (开始, 结束, 文字, 地址)，位置为转换后的位置加上offset
+    """
+    open_positions = _find_all(line, "[")
+    if not open_positions:
+        return line
+    parts = []
+    # parts拼接后的长度
+    length = 0
+    last_end = 0
+    close = line.find("](")
+    while close != -1:
+        # 文字从"]("之前最近的"["开始
+        index = bisect_left(open_positions, close) - 1
+        start = open_positions[index] if index >= 0 else -1
+        end = close + 2
+        while end < len(line) and line[end] not in "() \t":
+            end += 1
+        if start >= last_end and not (start > 0 and line[start - 1] == "!") and \
+                end < len(line) and line[end] == ")" and end > close + 2:
+            label = line[start + 1:close]
+            url = line[close + 2:end]
+            converted = url if not label or label == url else f"{label}（{url}）"
+            parts.append(line[last_end:start])
+            length += start - last_end
+            if spans is not None:
+                spans.append((offset + length, offset + length + len(converted), label, url))
+            parts.append(converted)
+            length += len(converted)
+            last_end = end + 1
+            close = line.find("](", last_end)
+        else:
+            close = line.find("](", close + 1)
+    if not parts:
+        return line
+    parts.append(line[last_end:])
+    return "".join(parts)
+
+
+def _convert_bold(line: str) -> str:
+    """**文字** 转为 文字"""
+    parts = []
+    last_end = 0
+    start = line.find("**")
+    while start != -1:
+        end = line.find("**", start + 2)
+        if end == -1:
+            break
+        if end > start + 2:
+            parts.append(line[last_end:start])
+            parts.append(line[start + 2:end])
+            last_end = end + 2
+            start = line.find("**", last_end)
+        else:
+            start = line.find("**", start + 1)
+    if not parts:
+        return line
+    parts.append(line[last_end:])
+    return "".join(parts)
+
+
+def _convert_list_item(line: str) -> str:
+    """- 项目、* 项目、+ 项目 转为 • 项目，保留缩进"""
+    stripped = line.lstrip(" \t")
+    if len(stripped) > 1 and stripped[0] in "-*+" and stripped[1] == " ":
+        return line[:len(line) - len(stripped)] + list_bullet + stripped[2:]
+    return line
+
+
+@dataclass
+class PopoMarkdownConverter:
+    # 图片转为[img]地址[/img]
+    images: bool = True
+    # 链接转为 文字（地址）
+    links: bool = False
+    # 去掉加粗标记
+    emphasis: bool = False
+    # 无序列表的标记统一为•
+    lists: bool = False
+    # 去掉代码块的```行，代码块内的内容原样保留，不做其他转换
+    code_fences: bool = False
+
+    def convert(self, text: str, link_spans: list = None) -> str:
+        """
+        :param link_spans: 不为None时追加转换后的文本中每个链接的 (开始, 结束, 文字, 地址)，
+                           用于把链接解析为消息节点（PopoMessage.parse）
+        """
+        if not text:
+            return text
+        if self.images:
+            text = convert_markdown_images(text)
+        if not (self.links or self.emphasis or self.lists or self.code_fences):
+            return text
+
+        lines = text.split("\n")
+        output = []
+        # 下一行在转换后文本中的位置
+        position = 0
+        in_code = False
+        for line in lines:
+            if line.lstrip(" \t").startswith("```"):
+                in_code = not in_code
+                if not self.code_fences:
+                    output.append(line)
+                    position += len(line) + 1
+                continue
+            if in_code:
+                output.append(line)
+                position += len(line) + 1
+                continue
+            if self.lists:
+                line = _convert_list_item(line)
+            if self.emphasis:
+                line = _convert_bold(line)
+            if self.links:
+                line = _convert_links(line, link_spans, position)
+            output.append(line)
+            position += len(line) + 1
+        return "\n".join(output)
+
+
+# 只转换图片，与原来的正则替换等价
+default_converter = PopoMarkdownConverter()
+# 链接、加粗、列表、代码块全部转为纯文本，按是否转换图片区分
+plain_text_converters = {
+    True: PopoMarkdownConverter(True, True, True, True, True),
+    False: PopoMarkdownConverter(False, True, True, True, True),
+}
+
+
+def convert_markdown(text: str, links: bool = False, emphasis: bool = False, lists: bool = False,
+                     code_fences: bool = False) -> str:
+    if not (links or emphasis or lists or code_fences):
+        return default_converter.convert(text)
+    return PopoMarkdownConverter(True, links, emphasis, lists, code_fences).convert(text)
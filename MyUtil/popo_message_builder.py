@@ -0,0 +1,199 @@
+from typing import Optional
+
+from MyUtil.popo_markdown_converter import PopoMarkdownConverter, iter_markdown_images
+
+"""
+POPO消息构造
+
+把智能体的输出解析一次，得到按顺序排列的节点列表（文本、@、图片、链接），
+应用机器人和自定义机器人（webhook）都基于同一个节点列表生成请求内容，发给多个接收人时也不必重复转换。
+
+POPO的rich_text目前只有text和at两种节点，图片（[img]地址[/img]）和链接都写在文本里，
+序列化时把相邻的文本类节点一次拼接成一个text节点。
+"""
+
+
+class TextNode:
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def to_text(self) -> str:
+        return self.text
+
+    def __eq__(self, other) -> bool:
+        return type(other) is TextNode and other.text == self.text
+
+    def __repr__(self) -> str:
+        return f"TextNode({self.text!r})"
+
+
+class ImageNode:
+    __slots__ = ("url",)
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def to_text(self) -> str:
+        return f"[img]{self.url}[/img]"
+
+    def __eq__(self, other) -> bool:
+        return type(other) is ImageNode and other.url == self.url
+
+    def __repr__(self) -> str:
+        return f"ImageNode({self.url!r})"
+
+
+class LinkNode:
+    __slots__ = ("text", "url")
+
+    def __init__(self, text: str, url: str):
+        self.text = text
+        self.url = url
+
+    def to_text(self) -> str:
+        # 与PopoMarkdownConverter转换链接的格式一致
+        if not self.text or self.text == self.url:
+            return self.url
+        return f"{self.text}（{self.url}）"
+
+    def __eq__(self, other) -> bool:
+        return type(other) is LinkNode and (other.text, other.url) == (self.text, self.url)
+
+    def __repr__(self) -> str:
+        return f"LinkNode({self.text!r}, {self.url!r})"
+
+
+class AtNode:
+    __slots__ = ("email",)
+
+    def __init__(self, email: str):
+        self.email = email
+
+    def __eq__(self, other) -> bool:
+        return type(other) is AtNode and other.email == self.email
+
+    def __repr__(self) -> str:
+        return f"AtNode({self.email!r})"
+
+
+class PopoMessage:
+    """解析后的消息，节点列表创建后不再修改"""
+
+    __slots__ = ("nodes", "_text")
+
+    def __init__(self, nodes: list):
+        self.nodes = nodes
+        self._text: Optional[str] = None
+
+    @classmethod
+    def parse(cls, message: str, auto_convert_markdown_image_link: bool = True,
+              converter: PopoMarkdownConverter = None) -> "PopoMessage":
+        """
+        解析智能体的输出，markdown图片转为图片节点
+
+        :param converter: 额外的markdown转换（链接、加粗、列表、代码块），链接解析为链接节点；
+                          指定时是否转换图片由converter.images决定
+        """
+        if converter is not None and (converter.links or converter.emphasis or converter.lists or
+                                      converter.code_fences):
+            return cls._parse_converted(message, converter)
+        if converter is not None:
+            auto_convert_markdown_image_link = converter.images
+        if not auto_convert_markdown_image_link:
+            return cls([TextNode(message)])
+        nodes = []
+        last_end = 0
+        for start, end, url_start, url_end in iter_markdown_images(message):
+            if start > last_end:
+                nodes.append(TextNode(message[last_end:start]))
+            nodes.append(ImageNode(message[url_start:url_end]))
+            last_end = end
+        if last_end < len(message) or not nodes:
+            nodes.append(TextNode(message[last_end:]))
+        return cls(nodes)
+
+    @classmethod
+    def _parse_converted(cls, message: str, converter: PopoMarkdownConverter) -> "PopoMessage":
+        """按converter转换后的文本拆分节点，链接和转换出的[img]标签分别为链接节点、图片节点"""
+        link_spans = []
+        text = converter.convert(message, link_spans)
+        nodes = []
+        last_end = 0
+        for start, end, label, url in link_spans:
+            _append_text_nodes(nodes, text[last_end:start], converter.images)
+            nodes.append(LinkNode(label, url))
+            last_end = end
+        _append_text_nodes(nodes, text[last_end:], converter.images)
+        return cls(nodes or [TextNode("")])
+
+    def with_at(self, email: str) -> "PopoMessage":
+        """在消息开头@email，正文另起一行"""
+        return PopoMessage([AtNode(email), TextNode("\n")] + self.nodes)
+
+    @property
+    def text(self) -> str:
+        """全部文本类节点序列化后的文本（不含@），只计算一次"""
+        if self._text is None:
+            self._text = "".join(node.to_text() for node in self.nodes if not isinstance(node, AtNode))
+        return self._text
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def to_rich_text_content(self, at: str = None) -> list:
+        """
+        应用机器人rich_text消息的content节点列表
+
+        :param at: 在消息开头@的popo邮箱（只有群消息才能@），正文另起一行
+        """
+        if at:
+            return self.with_at(at).to_rich_text_content()
+        content = []
+        texts = []
+        for node in self.nodes:
+            if isinstance(node, AtNode):
+                if texts:
+                    content.append({"tag": "text", "text": "".join(texts)})
+                    texts = []
+                content.append({"tag": "at", "email": node.email})
+            else:
+                texts.append(node.to_text())
+        if texts:
+            content.append({"tag": "text", "text": "".join(texts)})
+        return content
+
+    def to_webhook_text(self) -> str:
+        """自定义机器人（webhook）的消息文本，@节点写成@邮箱"""
+        if not any(isinstance(node, AtNode) for node in self.nodes):
+            return self.text
+        return "".join(f"@{node.email} " if isinstance(node, AtNode) else node.to_text() for node in self.nodes)
+
+    def split(self, max_chars: int) -> "list[PopoMessage]":
+        """
+        超长消息按split_message拆成多条
+
+        拆分基于序列化后的文本进行（不会拆开[img]标签），拆分后的消息只含文本节点
+        """
+        from MyUtil.popo_application_bot_util import split_message
+
+        if len(self) <= max_chars:
+            return [self]
+        return [PopoMessage([TextNode(part)]) for part in split_message(self.text, max_chars)]
+
+
+def _append_text_nodes(nodes: list, text: str, images: bool) -> None:
+    """追加一段文本，images为True时其中的[img]地址[/img]拆为图片节点"""
+    position = 0
+    while images:
+        start = text.find("[img]", position)
+        end = text.find("[/img]", start + 5) if start != -1 else -1
+        if end == -1:
+            break
+        if start > position:
+            nodes.append(TextNode(text[position:start]))
+        nodes.append(ImageNode(text[start + 5:end]))
+        position = end + 6
+    if position < len(text):
+        nodes.append(TextNode(text[position:]))
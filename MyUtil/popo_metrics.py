@@ -0,0 +1,182 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Optional
+
+"""
+回调处理的耗时与计数统计
+
+按机器人（popo_app_key）和应用类型记录各环节的耗时直方图与计数器：签名校验、解密、事件解析、
+调度等待、智能体调用、获取token、发送消息。只有开启了统计的机器人才会记录，
+未开启时span返回共用的空上下文管理器，开销只有一次集合查找。
+"""
+
+# 直方图的桶上界，毫秒
+histogram_buckets_ms = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class _NoopSpan:
+    """未开启统计时使用的空span"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_noop_span = _NoopSpan()
+
+
+class _Span:
+    __slots__ = ("_metrics", "_key", "_start")
+
+    def __init__(self, metrics: "PopoMetrics", key: tuple):
+        self._metrics = metrics
+        self._key = key
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self._metrics._observe(self._key, time.perf_counter() - self._start)
+        if exc_type is not None:
+            self._metrics._increment((self._key[0] + "_error",) + self._key[1:], 1)
+        return False
+
+
+class _Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # 最后一个桶记录超过最大上界的值
+        self.buckets = [0] * (len(histogram_buckets_ms) + 1)
+
+    def observe(self, milliseconds: float) -> None:
+        self.count += 1
+        self.total += milliseconds
+        if milliseconds > self.max:
+            self.max = milliseconds
+        self.buckets[bisect_left(histogram_buckets_ms, milliseconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """按桶估算分位数，返回所在桶的上界（不超过最大值）"""
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return round(min(histogram_buckets_ms[index], self.max) if index < len(histogram_buckets_ms)
+                             else self.max, 3)
+        return round(self.max, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max, 3),
+        }
+
+
+class PopoMetrics:
+    def __init__(self):
+        # 开启了统计的popo_app_key
+        self._enabled_bots = set()
+        # (指标名, popo_app_key, 应用类型) -> _Histogram / int
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+
+    def set_enabled(self, bot: str, enabled: bool) -> None:
+        """按端点配置开启或关闭某个机器人的统计，关闭时保留已有数据"""
+        if enabled:
+            self._enabled_bots.add(bot)
+        else:
+            self._enabled_bots.discard(bot)
+
+    def is_enabled(self, bot: str) -> bool:
+        return bot in self._enabled_bots
+
+    def span(self, name: str, bot: str, agent_type: str = ""):
+        """
+        统计with块的耗时，with块抛出异常时同时累加 name_error 计数
+
+        with get_metrics().span("agent_invoke", app_key, "chat"):
+            ...
+        """
+        if bot not in self._enabled_bots:
+            return _noop_span
+        return _Span(self, (name, bot, agent_type))
+
+    def observe(self, name: str, seconds: Optional[float], bot: str, agent_type: str = "") -> None:
+        """记录一个已经测得的耗时，秒"""
+        if bot in self._enabled_bots and seconds is not None:
+            self._observe((name, bot, agent_type), seconds)
+
+    def increment(self, name: str, bot: str, agent_type: str = "", value: int = 1) -> None:
+        if bot in self._enabled_bots:
+            self._increment((name, bot, agent_type), value)
+
+    def _observe(self, key: tuple, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(seconds * 1000)
+
+    def _increment(self, key: tuple, value: int) -> None:
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self, bot: str) -> dict:
+        """某个机器人的全部统计：{"spans": {指标名: {应用类型: 直方图}}, "counters": {指标名: {应用类型: 次数}}}"""
+        spans = {}
+        counters = {}
+        with self._lock:
+            for (name, key_bot, agent_type), histogram in self._histograms.items():
+                if key_bot == bot:
+                    spans.setdefault(name, {})[agent_type or "all"] = histogram.to_dict()
+            for (name, key_bot, agent_type), value in self._counters.items():
+                if key_bot == bot:
+                    counters.setdefault(name, {})[agent_type or "all"] = value
+        return {
+            "enabled": self.is_enabled(bot),
+            "since": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self._started_at)),
+            "histogram_buckets_ms": list(histogram_buckets_ms),
+            "spans": spans,
+            "counters": counters,
+        }
+
+    def reset(self, bot: str = None) -> None:
+        with self._lock:
+            if bot is None:
+                self._histograms.clear()
+                self._counters.clear()
+                self._started_at = time.time()
+                return
+            for store in (self._histograms, self._counters):
+                for key in [key for key in store if key[1] == bot]:
+                    del store[key]
+
+
+# 进程内共享的统计
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> PopoMetrics:
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = PopoMetrics()
+    return _metrics
@@ -0,0 +1,413 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Optional, Union
+
+from MyUtil.popo_application_bot_util import PopoBot, PopoRateLimitError
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_metrics import get_metrics
+from MyUtil.popo_logging import get_logger, log_sampled
+
+"""
+POPO消息发送队列
+
+回复、预回复、错误提示等消息统一放进发送队列，由队列自己的工作线程调用POPO接口，调用方不再阻塞在HTTP请求上。
+- 按popo_app_key和接收人分别用令牌桶限速，避免突发流量触发POPO的频率限制
+- 触发频率限制时按带随机抖动的指数退避重试
+- 同一接收人的消息按提交顺序串行发送；开启merge_small_messages时排队中的多条短消息合并成一条rich_text发送
+"""
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class PopoSendQueueConfig:
+    # 发送线程数
+    worker_count: int = 4
+    # 等待发送的消息上限，超过后拒绝新消息
+    max_queue_size: int = 5000
+    # 单个popo机器人每秒发送的消息数
+    app_key_rate: float = 20.0
+    # 单个popo机器人允许的突发消息数
+    app_key_burst: int = 20
+    # 单个接收人每秒收到的消息数
+    receiver_rate: float = 1.0
+    # 单个接收人允许的突发消息数
+    receiver_burst: int = 3
+    # 触发频率限制时的最大重试次数
+    max_retries: int = 3
+    # 第n次重试前等待 retry_backoff * 2^(n-1) 秒（再乘以0.5~1.5的随机抖动）
+    retry_backoff: float = 0.5
+    # 单次重试最长等待时间，秒
+    retry_backoff_max: float = 8.0
+    # 是否把排队中的连续短消息合并发送。默认关闭：预回复（如“处理中…”）和随后的回复是各自独立的消息，
+    # 合并后用户会收到一条拼在一起的消息；只在通知类的场景（同一接收人的多条独立短消息）显式开启
+    merge_small_messages: bool = False
+    # 不超过该长度的消息才会合并
+    merge_max_chars: int = 200
+    # 合并后消息的最大长度
+    merge_max_total_chars: int = 2000
+
+    def retry_delay(self, retries: int) -> float:
+        """已经重试retries次后，下一次重试前等待的时间，秒"""
+        return min(self.retry_backoff_max, self.retry_backoff * 2 ** retries) * random.uniform(0.5, 1.5)
+
+
+class SendQueueFullError(Exception):
+    """发送队列已满，消息被拒绝"""
+    pass
+
+
+class TokenBucket:
+    """令牌桶，非线程安全，由发送队列加锁使用"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """还需等待多久才有可用的令牌，秒，0表示现在就可以发送"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class PopoSendTask:
+    """一条待发送的消息"""
+    popo_bot: PopoBot
+    receiver: str
+    content: list = field(repr=False)
+    # 入队时间（time.monotonic）
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # 发送结束（无论成功失败）
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    error: Optional[BaseException] = None
+
+    @property
+    def app_key(self) -> str:
+        return self.popo_bot.appKey
+
+    @property
+    def lane_key(self) -> tuple:
+        return self.app_key, self.receiver
+
+    @property
+    def text_length(self) -> int:
+        return sum(len(node.get("text", "")) for node in self.content)
+
+    def wait(self, timeout: float = None) -> bool:
+        return self.done.wait(timeout)
+
+    def result(self, timeout: float = None) -> None:
+        """等待发送结束，发送失败时抛出原始异常"""
+        if not self.done.wait(timeout):
+            raise TimeoutError("等待popo消息发送超时")
+        if self.error is not None:
+            raise self.error
+
+
+class PopoSendBatch:
+    """一次submit提交的全部消息（超长消息拆分后的多段）"""
+
+    def __init__(self, tasks: list):
+        self.tasks = tasks
+
+    @property
+    def error(self) -> Optional[BaseException]:
+        return next((task.error for task in self.tasks if task.error is not None), None)
+
+    def wait(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for task in self.tasks:
+            if not task.wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                return False
+        return True
+
+    def result(self, timeout: float = None) -> None:
+        """等待全部发送结束，有发送失败时抛出第一个异常"""
+        if not self.wait(timeout):
+            raise TimeoutError("等待popo消息发送超时")
+        if self.error is not None:
+            raise self.error
+
+
+class _SendLane:
+    """同一接收人的待发送消息"""
+
+    def __init__(self):
+        self.tasks: "deque[PopoSendTask]" = deque()
+        # 正在发送，同一接收人同时只发送一条
+        self.busy = False
+        # 重试退避结束的时间（time.monotonic）
+        self.ready_at = 0.0
+        self.retries = 0
+
+
+def merge_content(contents: list) -> list:
+    """把多条消息的content合并成一条，消息之间换行，相邻的文本节点合并"""
+    merged: list = []
+    for index, content in enumerate(contents):
+        nodes = content if not index else [{"tag": "text", "text": "\n"}] + content
+        for node in nodes:
+            if node.get("tag") == "text" and merged and merged[-1].get("tag") == "text":
+                merged[-1] = {"tag": "text", "text": merged[-1]["text"] + node["text"]}
+            else:
+                merged.append(dict(node))
+    return merged
+
+
+class PopoSendQueue:
+    def __init__(self, config: PopoSendQueueConfig = None):
+        self.config = config or PopoSendQueueConfig()
+        # 有待发送消息的接收人，按轮转顺序排列
+        self._lanes: "OrderedDict[tuple, _SendLane]" = OrderedDict()
+        self._app_key_buckets: dict = {}
+        self._receiver_buckets: dict = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._workers: list = []
+        # 统计信息
+        self._submitted = 0
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._merged = 0
+        self._rejected = 0
+
+    def _ensure_workers(self) -> None:
+        if len(self._workers) >= self.config.worker_count:
+            return
+        with self._cond:
+            while len(self._workers) < self.config.worker_count:
+                worker = threading.Thread(
+                    target=self._worker_loop,
+                    name=f"popo-send-queue-{len(self._workers)}",
+                    daemon=True,
+                )
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, popo_bot: PopoBot, receiver: str, message: Union[str, PopoMessage], at: str = None,
+               auto_convert_markdown_image_link: bool = True) -> PopoSendBatch:
+        """
+        放入发送队列后立即返回，超长消息拆成多段按顺序发送
+
+        发给多个接收人时可以先PopoMessage.parse一次，再把同一个PopoMessage传给每次submit
+
+        :raises ValueError: 接收人格式错误
+        :raises SendQueueFullError: 等待发送的消息已达上限
+        """
+        parts = popo_bot.build_message_parts(receiver, message, at, auto_convert_markdown_image_link)
+        return self.submit_rich_text(popo_bot, receiver, *parts)
+
+    def submit_rich_text(self, popo_bot: PopoBot, receiver: str, *contents: list) -> PopoSendBatch:
+        tasks = [PopoSendTask(popo_bot=popo_bot, receiver=receiver, content=content) for content in contents]
+        self._ensure_workers()
+        with self._cond:
+            if self._pending + len(tasks) > self.config.max_queue_size:
+                self._rejected += len(tasks)
+                raise SendQueueFullError(f"popo消息发送队列已满（{self.config.max_queue_size}）")
+            lane_key = (popo_bot.appKey, receiver)
+            lane = self._lanes.get(lane_key)
+            if lane is None:
+                lane = self._lanes[lane_key] = _SendLane()
+            # 同一批的多段消息连续入队，保持顺序
+            lane.tasks.extend(tasks)
+            self._pending += len(tasks)
+            self._submitted += len(tasks)
+            self._cond.notify()
+        return PopoSendBatch(tasks)
+
+    def _bucket_locked(self, buckets: dict, key: Any, rate: float, capacity: int) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= 10000:
+                # 清理已经回满的令牌桶，与新建的等价
+                now = time.monotonic()
+                for full_key in [k for k, b in buckets.items() if b.is_full(now)]:
+                    del buckets[full_key]
+            bucket = buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+    def reserve(self, app_key: str, receiver: str) -> float:
+        """
+        不经过队列直接发送（如asyncio并发群发）时占用一次发送额度，与队列共用令牌桶
+
+        :return: 还需等待多久才能发送，秒，0表示现在就可以发送
+        """
+        config = self.config
+        with self._cond:
+            now = time.monotonic()
+            app_bucket = self._bucket_locked(self._app_key_buckets, app_key, config.app_key_rate, config.app_key_burst)
+            receiver_bucket = self._bucket_locked(self._receiver_buckets, (app_key, receiver), config.receiver_rate,
+                                                  config.receiver_burst)
+            wait = max(app_bucket.wait_time(now), receiver_bucket.wait_time(now))
+            # 先扣除令牌（允许透支），并发的调用方和队列的工作线程会相应地多等待
+            app_bucket.consume(now)
+            receiver_bucket.consume(now)
+            return wait
+
+    def _take_locked(self) -> "tuple[Optional[tuple], list, Optional[float]]":
+        """
+        轮转找第一个可以发送的接收人，取出其排队的消息（可合并时取出多条）
+
+        :return: (接收人, 消息列表, None)，或没有可发送的消息时 (None, [], 最近一个可发送的时间)
+        """
+        config = self.config
+        now = time.monotonic()
+        next_ready_at = None
+        for lane_key, lane in self._lanes.items():
+            if lane.busy:
+                continue
+            ready_at = lane.ready_at
+            if ready_at <= now:
+                app_bucket = self._bucket_locked(self._app_key_buckets, lane_key[0], config.app_key_rate,
+                                                 config.app_key_burst)
+                receiver_bucket = self._bucket_locked(self._receiver_buckets, lane_key, config.receiver_rate,
+                                                      config.receiver_burst)
+                wait = max(app_bucket.wait_time(now), receiver_bucket.wait_time(now))
+                if not wait:
+                    app_bucket.consume(now)
+                    receiver_bucket.consume(now)
+                    tasks = self._pop_tasks_locked(lane)
+                    lane.busy = True
+                    # 轮转，避免一个接收人的大量消息挡住其他接收人
+                    self._lanes.move_to_end(lane_key)
+                    return lane_key, tasks, None
+                ready_at = now + wait
+            if next_ready_at is None or ready_at < next_ready_at:
+                next_ready_at = ready_at
+        return None, [], next_ready_at
+
+    def _pop_tasks_locked(self, lane: _SendLane) -> list:
+        config = self.config
+        tasks = [lane.tasks.popleft()]
+        if config.merge_small_messages and tasks[0].text_length <= config.merge_max_chars:
+            total = tasks[0].text_length
+            while lane.tasks and lane.tasks[0].text_length <= config.merge_max_chars and \
+                    total + lane.tasks[0].text_length <= config.merge_max_total_chars:
+                total += lane.tasks[0].text_length
+                tasks.append(lane.tasks.popleft())
+        self._pending -= len(tasks)
+        return tasks
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                lane_key, tasks, next_ready_at = self._take_locked()
+                while lane_key is None:
+                    self._cond.wait(None if next_ready_at is None else max(0.0, next_ready_at - time.monotonic()))
+                    lane_key, tasks, next_ready_at = self._take_locked()
+            self._send(lane_key, tasks)
+
+    def _send(self, lane_key: tuple, tasks: list) -> None:
+        error = None
+        retry_delay = None
+        try:
+            content = merge_content([task.content for task in tasks]) if len(tasks) > 1 else tasks[0].content
+            tasks[0].popo_bot.send_rich_text(tasks[0].receiver, content)
+        except PopoRateLimitError as e:
+            error = e
+            get_metrics().increment("popo_send_rate_limited", tasks[0].popo_bot.appKey)
+            lane = self._lanes.get(lane_key)
+            if lane is not None and lane.retries < self.config.max_retries:
+                retry_delay = self.config.retry_delay(lane.retries)
+        except Exception as e:
+            error = e
+
+        with self._cond:
+            lane = self._lanes[lane_key]
+            lane.busy = False
+            if retry_delay is not None:
+                # 放回队首，保持发送顺序
+                lane.tasks.extendleft(reversed(tasks))
+                self._pending += len(tasks)
+                lane.retries += 1
+                lane.ready_at = time.monotonic() + retry_delay
+                self._retried += 1
+                # 触发频率限制时每个机器人都可能有大量接收人在重试，按机器人限流输出
+                log_sampled(logger, logging.WARNING, ("popo_send_rate_limited", lane_key[0]),
+                            "popo消息发送触发频率限制，%.2f秒后第%d次重试: receiver = %s",
+                            retry_delay, lane.retries, lane_key[1])
+                self._cond.notify()
+                return
+            lane.retries = 0
+            if not lane.tasks:
+                del self._lanes[lane_key]
+            if len(tasks) > 1:
+                self._merged += len(tasks) - 1
+            if error is None:
+                self._sent += len(tasks)
+            else:
+                self._failed += len(tasks)
+            self._cond.notify()
+        if error is not None:
+            logger.error("popo消息发送失败: receiver = %s, error = %s", lane_key[1], error)
+        for task in tasks:
+            task.error = error
+            task.done.set()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                "queue_depth": self._pending,
+                "max_queue_size": self.config.max_queue_size,
+                "receivers": len(self._lanes),
+                "submitted": self._submitted,
+                "sent": self._sent,
+                "failed": self._failed,
+                "retried": self._retried,
+                "merged": self._merged,
+                "rejected": self._rejected,
+            }
+
+    def get_app_key_stats(self, app_key: str) -> dict:
+        """单个机器人等待发送的消息数和接收人数，不包含其他机器人的数据"""
+        with self._cond:
+            lanes = [lane for lane_key, lane in self._lanes.items() if lane_key[0] == app_key]
+            return {
+                "queue_depth": sum(len(lane.tasks) for lane in lanes),
+                "receivers": len(lanes),
+                "retrying_receivers": sum(1 for lane in lanes if lane.retries),
+            }
+
+
+_send_queue = None
+_send_queue_lock = threading.Lock()
+
+
+def get_send_queue() -> PopoSendQueue:
+    global _send_queue
+    if _send_queue is None:
+        with _send_queue_lock:
+            if _send_queue is None:
+                _send_queue = PopoSendQueue()
+    return _send_queue
+
+
+def configure_send_queue(config: PopoSendQueueConfig) -> PopoSendQueue:
+    """替换全局发送队列的配置，已在排队的消息仍由旧队列发送"""
+    global _send_queue
+    with _send_queue_lock:
+        _send_queue = PopoSendQueue(config)
+    return _send_queue
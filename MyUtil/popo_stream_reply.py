@@ -0,0 +1,94 @@
+import time
+from typing import Callable
+
+"""
+流式回复缓冲
+
+把智能体流式输出的片段攒起来，在句子边界（或长度达到上限时）分段发送到POPO，
+两次发送之间至少间隔flush_interval秒，避免触发POPO的发送频率限制。
+第一段只要凑够一句话就立即发送，尽快让用户看到回复。
+"""
+
+# 视为句子结束的字符
+SENTENCE_ENDINGS = frozenset("。！？；!?;\n")
+
+
+class PopoStreamReplyBuffer:
+    def __init__(self, send: Callable[[str], None], flush_interval: float = 1.5, min_chars: int = 10,
+                 max_chars: int = 1000):
+        """
+        :param send: 发送一段消息的函数
+        :param flush_interval: 两次发送的最小间隔，秒（第一段不受限制）
+        :param min_chars: 一段消息的最少字符数，太短的句子会和后面的合并发送
+        :param max_chars: 缓冲超过该长度时不等句子结束直接发送
+        """
+        self._send = send
+        self.flush_interval = flush_interval
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+        self._parts = []
+        self._last_flush_at = None
+        self.flush_count = 0
+
+    @property
+    def text(self) -> str:
+        """目前收到的完整回复"""
+        return "".join(self._parts)
+
+    def feed(self, chunk: str) -> None:
+        if not chunk:
+            return
+        self._parts.append(chunk)
+        self._buffer += chunk
+        if len(self._buffer) < self.min_chars:
+            return
+        if self._last_flush_at is not None and time.monotonic() - self._last_flush_at < self.flush_interval:
+            return
+        end = self._find_flush_end()
+        if end:
+            self._flush(end)
+
+    def finish(self) -> None:
+        """发送剩余的内容"""
+        if self._buffer.strip():
+            self._flush(len(self._buffer))
+        self._buffer = ""
+
+    def _find_flush_end(self) -> int:
+        """返回可以发送的前缀长度，0表示暂不发送"""
+        buffer = self._buffer
+        end = 0
+        for index in range(len(buffer) - 1, self.min_chars - 2, -1):
+            if buffer[index] in SENTENCE_ENDINGS:
+                # "!"可能是markdown图片"!["的开头
+                if buffer[index] == "!" and buffer[index + 1:index + 2] in ("[", ""):
+                    continue
+                end = index + 1
+                break
+        if not end:
+            if len(buffer) < self.max_chars:
+                return 0
+            end = len(buffer)
+        end = self._safe_end(buffer, end)
+        if not end and len(buffer) >= self.max_chars * 4:
+            # 超长的代码块不再等待闭合
+            end = len(buffer)
+        return end
+
+    @staticmethod
+    def _safe_end(buffer: str, end: int) -> int:
+        """不在代码块或markdown图片链接的中间断开"""
+        prefix = buffer[:end]
+        if prefix.count("```") % 2:
+            return 0
+        image_start = prefix.rfind("![")
+        if image_start != -1 and prefix.find(")", image_start) == -1:
+            end = image_start
+        return end if buffer[:end].strip() else 0
+
+    def _flush(self, end: int) -> None:
+        part, self._buffer = self._buffer[:end], self._buffer[end:]
+        self._last_flush_at = time.monotonic()
+        self.flush_count += 1
+        self._send(part.strip("\n"))
@@ -0,0 +1,206 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from MyUtil.popo_logging import get_logger
+
+"""
+POPO机器人access token管理
+
+- 每个(appKey, appSecret)同一时间只有一个请求在获取token，其余调用等待它的结果（single-flight）
+- 按接口返回的过期时间缓存token，并由后台线程在过期前主动刷新，发消息时不再需要同步获取token
+"""
+
+logger = get_logger(__name__)
+
+# 接口没有返回过期时间时使用的有效期，秒
+default_token_ttl = 7200
+# 过期前多久开始后台刷新，秒
+refresh_ahead_seconds = 600
+# 距过期不足该时间的token视为已过期，秒
+expiry_margin_seconds = 30
+# 超过该时间没有使用的token不再后台刷新，秒
+idle_drop_seconds = 86400
+# 同一个token两次后台刷新的最小间隔，秒（接口返回的token有效期很短或没有变化时，避免连续请求token接口）
+min_refresh_interval = 30
+# 后台刷新连续失败或连续拿到短期token时，重试间隔按指数增长的上限，秒
+max_refresh_backoff = 600
+
+
+@dataclass
+class PopoAccessToken:
+    access_token: str
+    # 过期时间（time.time()）
+    expires_at: float
+    # 最后一次被使用的时间（time.time()）
+    last_used_at: float = 0.0
+
+    def is_valid(self, now: float = None) -> bool:
+        return (now or time.time()) < self.expires_at - expiry_margin_seconds
+
+    @classmethod
+    def from_response_data(cls, data: dict) -> "PopoAccessToken":
+        """
+        解析token接口返回的data
+
+        过期时间优先使用accessExpiredAt（毫秒时间戳），其次expiresIn（秒），都没有时按default_token_ttl计算
+        """
+        now = time.time()
+        expires_at = None
+        try:
+            if data.get("accessExpiredAt"):
+                expires_at = int(data["accessExpiredAt"]) / 1000
+            elif data.get("expiresIn"):
+                expires_at = now + int(data["expiresIn"])
+        except (TypeError, ValueError):
+            logger.warning("无法解析token的过期时间: %s", data.get('accessExpiredAt') or data.get('expiresIn'))
+        if expires_at is None or expires_at <= now:
+            expires_at = now + default_token_ttl
+        return cls(access_token=data.get("accessToken"), expires_at=expires_at, last_used_at=now)
+
+
+class _TokenFetch:
+    """一次进行中的token获取"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.token: Optional[PopoAccessToken] = None
+        self.error: Optional[BaseException] = None
+
+
+class PopoTokenManager:
+    def __init__(self, fetch_token: Callable[[str, str], PopoAccessToken]):
+        """
+        :param fetch_token: 实际请求token接口的函数，参数为(app_key, app_secret)
+        """
+        self._fetch_token = fetch_token
+        self._tokens: dict = {}
+        self._fetching: dict = {}
+        self._lock = threading.Lock()
+        self._refresh_cond = threading.Condition(self._lock)
+        self._refresher: Optional[threading.Thread] = None
+        # key -> (下次允许后台刷新的时间time.time(), 连续失败或拿到短期token的次数)
+        self._refresh_backoff: dict = {}
+        # 统计信息
+        self.fetch_count = 0
+        self.hit_count = 0
+
+    def get_token(self, app_key: str, app_secret: str) -> str:
+        key = (app_key, app_secret)
+        now = time.time()
+        token = self._tokens.get(key)
+        if token is not None and token.is_valid(now):
+            token.last_used_at = now
+            self.hit_count += 1
+            return token.access_token
+        token = self._fetch(key)
+        token.last_used_at = now
+        return token.access_token
+
+    def invalidate(self, app_key: str, app_secret: str, access_token: str = None) -> None:
+        """
+        清理缓存的token
+
+        :param access_token: 只有缓存的仍是该token时才清理，避免把并发中刚刷新的新token清掉
+        """
+        key = (app_key, app_secret)
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is not None and (access_token is None or token.access_token == access_token):
+                del self._tokens[key]
+
+    def _fetch(self, key: tuple) -> PopoAccessToken:
+        with self._lock:
+            fetch = self._fetching.get(key)
+            is_leader = fetch is None
+            if is_leader:
+                fetch = _TokenFetch()
+                self._fetching[key] = fetch
+        if not is_leader:
+            fetch.done.wait()
+            if fetch.error is not None:
+                raise fetch.error
+            return fetch.token
+
+        try:
+            fetch.token = self._fetch_token(*key)
+            self.fetch_count += 1
+            with self._lock:
+                self._tokens[key] = fetch.token
+                self._ensure_refresher_locked()
+                self._refresh_cond.notify()
+            return fetch.token
+        except BaseException as e:
+            fetch.error = e
+            raise
+        finally:
+            with self._lock:
+                self._fetching.pop(key, None)
+            fetch.done.set()
+
+    def _ensure_refresher_locked(self) -> None:
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="popo-token-refresher", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self) -> None:
+        while True:
+            with self._lock:
+                now = time.time()
+                due = []
+                next_due_at = None
+                for key, token in list(self._tokens.items()):
+                    if now - token.last_used_at > idle_drop_seconds:
+                        del self._tokens[key]
+                        self._refresh_backoff.pop(key, None)
+                        continue
+                    refresh_at = token.expires_at - refresh_ahead_seconds
+                    backoff = self._refresh_backoff.get(key)
+                    if backoff is not None:
+                        refresh_at = max(refresh_at, backoff[0])
+                    if refresh_at <= now:
+                        due.append(key)
+                    elif next_due_at is None or refresh_at < next_due_at:
+                        next_due_at = refresh_at
+                if not due:
+                    self._refresh_cond.wait(None if next_due_at is None else next_due_at - now)
+                    continue
+            for key in due:
+                attempts = self._refresh_backoff.get(key, (0, 0))[1] + 1
+                try:
+                    # 后台刷新不算使用，保留原来的最后使用时间
+                    old_token = self._tokens.get(key)
+                    token = self._fetch(key)
+                    token.last_used_at = old_token.last_used_at if old_token else time.time()
+                    logger.debug("后台刷新token成功: appKey = %s", key[0])
+                except Exception as e:
+                    logger.warning("后台刷新token失败: appKey = %s, error = %s", key[0], e)
+                    # 刷新失败时按指数退避重试，token未过期前发消息仍可使用旧token
+                    self._schedule_refresh(key, attempts, min_refresh_interval)
+                    continue
+                now = time.time()
+                if token.expires_at - refresh_ahead_seconds > now:
+                    self._refresh_backoff.pop(key, None)
+                else:
+                    # 拿到的token仍在刷新窗口内（同一个token或有效期很短），不立即再次刷新
+                    self._schedule_refresh(key, attempts, (token.expires_at - now) / 2)
+
+    def _schedule_refresh(self, key: tuple, attempts: int, delay: float) -> None:
+        """第attempts次刷新没有拿到长期有效的token，至少delay秒后再刷新"""
+        backoff = min(max_refresh_backoff, min_refresh_interval * 2 ** min(attempts - 1, 10))
+        self._refresh_backoff[key] = (time.time() + max(backoff, delay), attempts)
+
+
+_token_manager = None
+_token_manager_lock = threading.Lock()
+
+
+def get_token_manager(fetch_token: Callable[[str, str], PopoAccessToken]) -> PopoTokenManager:
+    """进程内共享的token管理器，fetch_token只在第一次创建时使用"""
+    global _token_manager
+    if _token_manager is None:
+        with _token_manager_lock:
+            if _token_manager is None:
+                _token_manager = PopoTokenManager(fetch_token)
+    return _token_manager
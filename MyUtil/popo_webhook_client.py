@@ -0,0 +1,192 @@
+import base64
+import hashlib
+import hmac
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional, Union
+
+from MyUtil.popo_application_bot_util import PopoApiError, PopoRateLimitError, _parse_response, \
+    rate_limit_error_keywords
+from MyUtil.popo_http_client import PopoHttpClient, PopoHttpClientConfig
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_logging import get_logger
+
+"""
+POPO自定义机器人（webhook）客户端
+
+- 独立的连接池，按webhook的host复用长连接，所有请求都带连接/读取超时
+- 签名按密钥缓存，有效期内复用同一个时间戳和签名
+- 只重试不会导致重复发送的失败：连接失败（由连接池重试）和POPO明确拒绝的频率限制
+- 同一条消息可以并发发给多个webhook（多个群）
+"""
+
+logger = get_logger(__name__)
+
+# 多个webhook地址/密钥之间的分隔符：中英文逗号、分号、空白
+_separator_pattern = re.compile(r'[,，;；\s]+')
+
+
+def split_values(values: str) -> list:
+    """把逗号、分号或空白分隔的多个值拆成列表，去掉空项，保持原有顺序"""
+    return [value for value in _separator_pattern.split(values or "") if value]
+
+
+@dataclass
+class PopoWebhookClientConfig:
+    # 并发发送的webhook数上限
+    max_concurrency: int = 10
+    # 触发频率限制后的最大重试次数
+    max_retries: int = 2
+    # 第n次重试前等待 retry_backoff * 2^(n-1) 秒（带随机抖动）
+    retry_backoff: float = 0.5
+    # 签名（时间戳）的复用时间，秒
+    signature_ttl: float = 30.0
+    # 缓存签名的密钥数上限，超过后清空重新计算
+    max_cached_signatures: int = 1024
+    # webhook分布在多个host上，多缓存一些host的连接池
+    http: PopoHttpClientConfig = field(default_factory=lambda: PopoHttpClientConfig(pool_connections=32,
+                                                                                      pool_maxsize=10))
+
+
+@dataclass
+class PopoWebhookResult:
+    webhook_url: str
+    # 接口返回的内容，失败为None
+    result: Optional[dict] = None
+    # 发送失败的异常，成功为None
+    error: Optional[BaseException] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _raise_for_webhook_response(response) -> dict:
+    result = _parse_response(response)
+    errcode = result.get("errcode")
+    if response.status_code == 200 and errcode == 0:
+        return result
+    errmsg = result.get("errmsg", f"HTTP状态码{response.status_code}")
+    message = f"消息发送失败，错误码：{errcode}，错误信息：{errmsg}"
+    if response.status_code == 429 or any(keyword in str(errmsg).lower() for keyword in rate_limit_error_keywords):
+        raise PopoRateLimitError(message, errcode, errmsg, response.status_code)
+    raise PopoApiError(message, errcode, errmsg, response.status_code)
+
+
+class PopoWebhookClient:
+    def __init__(self, config: PopoWebhookClientConfig = None):
+        self.config = config or PopoWebhookClientConfig()
+        self._http_client = PopoHttpClient(self.config.http)
+        # secret -> (时间戳毫秒字符串, 签名, 过期时间time.monotonic)
+        self._signatures = {}
+        self._lock = threading.Lock()
+
+    def sign(self, secret: str) -> "tuple[str, str]":
+        """返回(时间戳, 签名)，有效期内的重复调用直接返回缓存"""
+        now = time.monotonic()
+        cached = self._signatures.get(secret)
+        if cached is not None and cached[2] > now:
+            return cached[0], cached[1]
+
+        # 时间戳（毫秒级）
+        timestamp = str(int(time.time() * 1000))
+        string_to_sign = f"{timestamp}\n{secret}"
+        hmac_code = hmac.new(
+            string_to_sign.encode("utf-8"),
+            digestmod=hashlib.sha256
+        ).digest()
+        sign_data = base64.b64encode(hmac_code).decode("utf-8")
+        with self._lock:
+            if len(self._signatures) >= self.config.max_cached_signatures:
+                self._signatures.clear()
+            self._signatures[secret] = (timestamp, sign_data, now + self.config.signature_ttl)
+        return timestamp, sign_data
+
+    def build_body(self, message: PopoMessage, secret: str = None) -> bytes:
+        """请求体直接序列化为紧凑的UTF-8 JSON，中文不转义"""
+        payload = {"message": message.to_webhook_text()}
+        if secret:
+            payload["timestamp"], payload["signData"] = self.sign(secret)
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def send(self, webhook_url: str, message: Union[str, PopoMessage], secret: str = None,
+             auto_convert_markdown_image_link: bool = True) -> dict:
+        """
+        发送消息到一个自定义机器人
+
+        :raises PopoRateLimitError: 重试后仍触发频率限制
+        :raises PopoApiError: 其他接口错误
+        """
+        if not isinstance(message, PopoMessage):
+            message = PopoMessage.parse(message, auto_convert_markdown_image_link)
+        headers = {"Content-Type": "application/json; charset=utf-8"}
+
+        attempt = 0
+        while True:
+            response = self._http_client.post(webhook_url, headers=headers, data=self.build_body(message, secret))
+            try:
+                return _raise_for_webhook_response(response)
+            except PopoRateLimitError:
+                # 频率限制说明消息没有被接收，重试不会重复发送
+                if attempt >= self.config.max_retries:
+                    raise
+                attempt += 1
+                delay = self.config.retry_backoff * (2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def send_to_many(self, webhook_urls: list, message: Union[str, PopoMessage], secrets: list = None,
+                     auto_convert_markdown_image_link: bool = True) -> "list[PopoWebhookResult]":
+        """
+        把同一条消息并发发给多个自定义机器人，单个失败不影响其他
+
+        :param secrets: 与webhook_urls一一对应的密钥；只有一个时所有webhook共用，为空表示不签名
+        :return: 与webhook_urls顺序一致的发送结果
+        """
+        secrets = list(secrets or [])
+        if len(secrets) == 1:
+            secrets = secrets * len(webhook_urls)
+        elif secrets and len(secrets) != len(webhook_urls):
+            raise ValueError(f"签名校验密钥的数量（{len(secrets)}）与webhook地址的数量（{len(webhook_urls)}）不一致")
+        if not isinstance(message, PopoMessage):
+            # 只解析一次，所有webhook共用
+            message = PopoMessage.parse(message, auto_convert_markdown_image_link)
+
+        def send(index: int) -> PopoWebhookResult:
+            webhook_url = webhook_urls[index]
+            try:
+                return PopoWebhookResult(webhook_url, self.send(webhook_url, message, secrets[index] if secrets else None))
+            except Exception as e:
+                return PopoWebhookResult(webhook_url, error=e)
+
+        if len(webhook_urls) <= 1:
+            results = [send(index) for index in range(len(webhook_urls))]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.config.max_concurrency, len(webhook_urls)),
+                                    thread_name_prefix="popo-webhook") as pool:
+                results = list(pool.map(send, range(len(webhook_urls))))
+        failed = sum(1 for result in results if not result.ok)
+        if failed:
+            logger.warning("popo自定义机器人群发：%d个webhook中%d个发送失败", len(results), failed)
+        return results
+
+    def close(self) -> None:
+        self._http_client.close()
+
+
+# 进程内共享的客户端
+_webhook_client = None
+_webhook_client_lock = threading.Lock()
+
+
+def get_webhook_client() -> PopoWebhookClient:
+    global _webhook_client
+    if _webhook_client is None:
+        with _webhook_client_lock:
+            if _webhook_client is None:
+                _webhook_client = PopoWebhookClient()
+    return _webhook_client
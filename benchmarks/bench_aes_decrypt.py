@@ -0,0 +1,84 @@
+import argparse
+import base64
+import json
+import time
+import tracemalloc
+
+from benchmarks.popo_callback_factory import BENCH_AES_KEY, build_merge_list, build_p2p_event
+from MyUtil.popo_encryption_tool import AESCipher
+
+"""
+回调解密+JSON解析：原来的实现与基于缓冲区、流式解密的对比
+
+- legacy：原实现，base64解码、CBC解密各生成一份副本，切掉补位再复制一次，解码成字符串后json.loads
+- buffer：aes_cbc_decrypt_json，CBC解密直接写入预分配的bytearray、原地校验并去除补位后解码、json.loads
+  （密文超过stream_decrypt_threshold时自动按块流式解密）
+- stream：分块调用AESCBCStreamDecryptor.update（模拟按块读取请求体），最后json.loads
+
+同时用tracemalloc统计每种方式的内存峰值（统计内存时单独运行一次）。
+
+运行：python -m benchmarks.bench_aes_decrypt --merge-items 0 100 1000 10000
+"""
+
+
+def legacy_decrypt_json(aes_cipher: AESCipher, encrypted_text: str):
+    """改造前的aes_cbc_decrypt + json.loads"""
+    from Crypto.Cipher import AES
+    encrypted = base64.b64decode(encrypted_text)
+    decrypted = AES.new(key=aes_cipher.key, mode=AES.MODE_CBC, IV=aes_cipher.iv).decrypt(encrypted)
+    return json.loads(decrypted[:-ord(decrypted[len(decrypted) - 1:])].decode())
+
+
+def buffer_decrypt_json(aes_cipher: AESCipher, encrypted_text: str):
+    return aes_cipher.aes_cbc_decrypt_json(encrypted_text)
+
+
+def stream_decrypt_json(aes_cipher: AESCipher, encrypted_text: str, chunk_size: int = 16 * 1024):
+    decryptor = aes_cipher.stream_decryptor(len(encrypted_text) // 4 * 3)
+    for start in range(0, len(encrypted_text), chunk_size):
+        decryptor.update(encrypted_text[start:start + chunk_size])
+    return json.loads(decryptor.finish().decode())
+
+
+def _bench(func, aes_cipher: AESCipher, encrypted_text: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(aes_cipher, encrypted_text)
+    return (time.perf_counter() - start) / iterations
+
+
+def _peak_memory(func, aes_cipher: AESCipher, encrypted_text: str) -> int:
+    """一次调用期间新分配内存的峰值，字节（不含密文本身）"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func(aes_cipher, encrypted_text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--merge-items", type=int, nargs="+", default=[0, 100, 1000, 10000])
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    aes_cipher = AESCipher(BENCH_AES_KEY)
+    # 先解密一次，加载pycryptodome
+    aes_cipher.aes_cbc_decrypt(aes_cipher.aes_cbc_encrypt("warmup"))
+    cases = {"legacy": legacy_decrypt_json, "buffer": buffer_decrypt_json, "stream": stream_decrypt_json}
+    for count in args.merge_items:
+        event = build_p2p_event(notify="[聊天记录]", extra=build_merge_list(count) if count else None)
+        encrypted_text = aes_cipher.aes_cbc_encrypt(json.dumps(event, ensure_ascii=False))
+        for func in cases.values():
+            # 预热，同时确认结果一致
+            assert func(aes_cipher, encrypted_text) == event
+        iterations = max(5, args.iterations // max(1, count // 10))
+        timings = {name: _bench(func, aes_cipher, encrypted_text, iterations) for name, func in cases.items()}
+        peaks = {name: _peak_memory(func, aes_cipher, encrypted_text) for name, func in cases.items()}
+        print(f"合并消息{count:>6}条 密文{len(encrypted_text) / 1024:9.1f}KiB  " + "  ".join(
+            f"{name}={timings[name] * 1e6:10.1f}µs/峰值{peaks[name] / 1024:8.1f}KiB" for name in cases))
+
+
+if __name__ == '__main__':
+    main()
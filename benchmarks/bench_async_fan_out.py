@@ -0,0 +1,59 @@
+import httpcore  # noqa: F401  本地装了trio时，必须在gevent的monkey patch之前导入（trio依赖select.epoll）
+import dify_plugin  # noqa: F401  先完成gevent的monkey patch，再创建线程和socket
+import argparse
+import time
+
+from benchmarks.popo_mock_server import PopoMockServer
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_async_client import PopoAsyncClientConfig, send_to_many_sync
+from MyUtil.popo_send_queue import get_send_queue
+
+"""
+同一条消息发给大量接收人：逐个调用PopoBot.send_message，与AsyncPopoBot并发发送的耗时对比
+
+替身服务器与客户端在同一进程内，单核机器上每秒只能处理约一两百个请求，并发数再往上加只会排队，
+测试更高的并发数需要把替身服务器放到其他机器上。
+并发群发与发送队列共用单个机器人的限速（默认每秒20条），--app-key-rate 调高后才能比较并发本身的效果。
+运行：python -m benchmarks.bench_async_fan_out --receivers 500 --latency 0.05
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--receivers", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="替身服务器每个请求的额外延迟，秒")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--app-key-rate", type=float, default=1000, help="单个机器人每秒发送的消息数上限")
+    args = parser.parse_args()
+
+    send_queue_config = get_send_queue().config
+    send_queue_config.app_key_rate = args.app_key_rate
+    send_queue_config.app_key_burst = int(args.app_key_rate)
+
+    receivers = [f"user{i}@corp.netease.com" if i % 5 else str(1000000 + i) for i in range(args.receivers)]
+    message = "告警：服务响应时间超过阈值 ![趋势](http://example.com/trend.png)"
+    with PopoMockServer(latency=args.latency) as server:
+        PopoBot.api_base_url = server.base_url
+        popo_bot = PopoBot("bench_app_key", "bench_app_secret")
+        popo_bot.get_token(popo_bot.appKey, popo_bot.app_secret)
+
+        start = time.perf_counter()
+        for receiver in receivers:
+            popo_bot.send_message(receiver, message)
+        elapsed = time.perf_counter() - start
+        print(f"{'sequential':<16} 接收人={len(receivers)} 耗时={elapsed:6.2f}s 新建连接数={server.stats['connections']}")
+
+        for concurrency in args.concurrency:
+            server.reset_stats()
+            start = time.perf_counter()
+            results = send_to_many_sync(popo_bot.appKey, popo_bot.app_secret, receivers, message,
+                                        config=PopoAsyncClientConfig(max_concurrency=concurrency))
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for result in results if not result.ok)
+            stats = server.stats
+            print(f"{'async x' + str(concurrency):<16} 接收人={len(results)} 失败={failed} 耗时={elapsed:6.2f}s "
+                  f"请求数={stats['send']} 新建连接数={stats['connections']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import time
+
+from benchmarks.popo_callback_factory import build_merge_list, build_p2p_event
+from models.popo_bot_callback_structures import P2PMessageData, RobotEvent, _parse_file_info, _parse_merge_list, \
+    _parse_quote_info, _parse_video_info, dict_to_robot_event, PopoEventType
+
+"""
+回调事件解析：原来的一次性解析全部嵌套结构并生成indent=2的raw_json，与按需解析的对比
+
+- eager：原实现的开销，解析全部嵌套结构并序列化带缩进的raw_json
+- lazy：只访问notify、from_、session_id（普通消息的处理路径）
+- lazy+merge_list / lazy+raw_json：再访问合并消息列表或原始JSON（工作流智能体会用到raw_json）
+
+运行：python -m benchmarks.bench_callback_event_parsing --merge-items 0 100 1000
+"""
+
+
+def eager_parse(data: dict) -> RobotEvent:
+    """原来的解析方式：全部嵌套结构立即解析，raw_json带缩进"""
+    event_data_dict = data["eventData"]
+    event_data = P2PMessageData(
+        msg_type=event_data_dict["msgType"],
+        addtime=event_data_dict["addtime"],
+        session_type=event_data_dict["sessionType"],
+        robot_ids=event_data_dict["robotIds"],
+        from_=event_data_dict["from"],
+        to=event_data_dict["to"],
+        session_id=event_data_dict["sessionId"],
+        uuid=event_data_dict["uuid"],
+        notify=event_data_dict["notify"],
+        merge_title=event_data_dict.get("mergeTitle"),
+        _event_data=event_data_dict
+    )
+    event_data._quote_info = _parse_quote_info(event_data_dict.get("quoteInfo"))
+    event_data._file_info = _parse_file_info(event_data_dict.get("fileInfo"))
+    event_data._video_info = _parse_video_info(event_data_dict.get("videoInfo"))
+    event_data._merge_list = _parse_merge_list(event_data_dict.get("mergeList"))
+    robot_event = RobotEvent(PopoEventType.from_str(data["eventType"]), event_data, data)
+    robot_event._raw_json = json.dumps(data, ensure_ascii=False, indent=2)
+    return robot_event
+
+
+def lazy_hot_path(data: dict) -> None:
+    robot_event = dict_to_robot_event(data)
+    robot_event.event_data.notify.strip()
+    robot_event.event_data.from_
+    robot_event.event_data.session_id
+
+
+def lazy_merge_list(data: dict) -> None:
+    robot_event = dict_to_robot_event(data)
+    robot_event.event_data.notify.strip()
+    robot_event.event_data.merge_list
+
+
+def lazy_raw_json(data: dict) -> None:
+    robot_event = dict_to_robot_event(data)
+    robot_event.event_data.notify.strip()
+    robot_event.raw_json
+
+
+def _bench(func, data: dict, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(data)
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--merge-items", type=int, nargs="+", default=[0, 100, 1000])
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = {"eager": eager_parse, "lazy": lazy_hot_path, "lazy+merge_list": lazy_merge_list,
+             "lazy+raw_json": lazy_raw_json}
+    for count in args.merge_items:
+        data = build_p2p_event(notify="[聊天记录]", extra=build_merge_list(count) if count else None)
+        iterations = max(10, args.iterations // max(1, count // 10))
+        results = {name: _bench(func, data, iterations) for name, func in cases.items()}
+        print(f"合并消息{count:>5}条  " + "  ".join(f"{name}={elapsed * 1e6:9.1f}µs" for name, elapsed in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import dify_plugin  # noqa: F401  先完成gevent的monkey patch，再创建线程和socket
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.popo_callback_factory import FakeDifySession, build_callback_request, build_endpoint_settings, \
+    build_p2p_event
+from benchmarks.popo_mock_server import PopoMockServer
+from endpoints.popo_application_bot_callback import PopoBotToolEndpoint
+from MyUtil import popo_agent_dispatcher
+from MyUtil.popo_agent_dispatcher import PopoAgentDispatcher
+from MyUtil.popo_application_bot_util import PopoBot
+
+"""
+并发回放N个POPO回调，统计端点响应时间的p50/p99
+
+legacy模式模拟改造前的行为：提交到session._executor后固定休眠1秒；dispatcher模式为当前的调度器交接。
+运行：python -m benchmarks.bench_callback_handoff --callbacks 200 --concurrency 50
+"""
+
+
+class _LegacySleepJob:
+    start_deadline = 0.0
+
+    def __init__(self, job):
+        self._job = job
+
+    def wait_started(self, timeout=None):
+        return True
+
+
+class _LegacySleepDispatcher:
+    """改造前：session._executor.submit(call_agent) 后 time.sleep(1)"""
+
+    def __init__(self, executor):
+        self._executor = executor
+
+    def submit(self, job):
+        self._executor.submit(job.handler, job)
+        time.sleep(1)
+        return _LegacySleepJob(job)
+
+
+def _percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def run(mode: str, callbacks: int, concurrency: int, agent_latency: float) -> None:
+    session = FakeDifySession(agent_latency=agent_latency)
+    # 压测只有一个机器人，放开单机器人的并发和排队上限，只比较交接方式
+    # （智能体耗时数秒时同时执行的调用数远多于并发回放数，上限设为回调总数）
+    settings = build_endpoint_settings(max_concurrency_per_app_key=str(callbacks),
+                                       max_concurrency_per_agent=str(callbacks))
+    popo_agent_dispatcher._dispatcher = PopoAgentDispatcher(max_queue_size=callbacks,
+                                                            max_queue_size_per_app_key=callbacks)
+    # 每种模式用不同的用户：上一种模式还在执行的调用占着这些会话的预占，会让本模式的调用等待会话创建
+    requests_ = [build_callback_request(build_p2p_event(from_=f"{mode}-user{i}@corp.netease.com"))
+                 for i in range(callbacks)]
+    for request in requests_:
+        request.get_data()  # 预先读取请求体，只统计端点处理时间
+
+    # 端点在第一次回调时才从popo_agent_dispatcher导入get_agent_dispatcher，替换模块上的函数即可
+    original_get_dispatcher = popo_agent_dispatcher.get_agent_dispatcher
+    if mode == "legacy":
+        legacy_dispatcher = _LegacySleepDispatcher(session._executor)
+        popo_agent_dispatcher.get_agent_dispatcher = lambda: legacy_dispatcher
+
+    samples = []
+    samples_lock = threading.Lock()
+
+    def replay(request):
+        endpoint = PopoBotToolEndpoint(session)
+        start = time.perf_counter()
+        response = endpoint._invoke(request, {}, settings)
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.get_data(as_text=True)
+        with samples_lock:
+            samples.append(elapsed)
+
+    try:
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(replay, requests_))
+        wall = time.perf_counter() - wall_start
+    finally:
+        popo_agent_dispatcher.get_agent_dispatcher = original_get_dispatcher
+
+    print(f"{mode:<10} callbacks={callbacks} concurrency={concurrency} "
+          f"p50={_percentile(samples, 0.5) * 1000:8.2f}ms p99={_percentile(samples, 0.99) * 1000:8.2f}ms "
+          f"throughput={callbacks / wall:8.1f}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--callbacks", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--agent-latency", type=float, default=2.0, help="模拟智能体调用耗时，秒（阻塞模式下通常为数秒）")
+    args = parser.parse_args()
+
+    with PopoMockServer() as server:
+        PopoBot.api_base_url = server.base_url
+        for mode in ("legacy", "dispatcher"):
+            run(mode, args.callbacks, args.concurrency, args.agent_latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import json
+import time
+
+from benchmarks.popo_callback_factory import BENCH_AES_KEY, build_callback_query, build_endpoint_settings, \
+    build_p2p_event
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_encryption_tool import AESCipher
+from MyUtil.popo_endpoint_config_cache import PopoEndpointConfigCache
+from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings
+
+"""
+回调的配置解析+验签+解密路径的单次耗时，对比每次重新构建与按配置缓存
+
+运行：python -m benchmarks.bench_callback_verify_decrypt --iterations 20000
+"""
+
+
+def _uncached(settings, query, encrypt):
+    """改造前：每个请求都重新解析配置、创建AESCipher和PopoBot"""
+    plugin_settings = PopoBotEndpointSettings(settings)
+    aes_cipher = AESCipher(plugin_settings.aes_key)
+    if not aes_cipher.popo_check_signature(plugin_settings.token, query["timestamp"], query["nonce"],
+                                           query["signature"]):
+        raise ValueError("校验签名验证失败")
+    PopoBot(plugin_settings.popo_app_key, plugin_settings.popo_app_secret)
+    return json.loads(aes_cipher.aes_cbc_decrypt(encrypt))
+
+
+def _cached(cache, settings, query, encrypt):
+    endpoint_config = cache.get(settings)
+    if not endpoint_config.signature_verifier.verify(query["timestamp"], query["nonce"], query["signature"]):
+        raise ValueError("校验签名验证失败")
+    return endpoint_config.aes_cipher.aes_cbc_decrypt_json(encrypt)
+
+
+def _measure(name: str, func, iterations: int) -> None:
+    func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {elapsed / iterations * 1e6:8.2f}us/请求")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    settings = build_endpoint_settings()
+    query = build_callback_query()
+    encrypt = AESCipher(BENCH_AES_KEY).aes_cbc_encrypt(json.dumps(build_p2p_event(), ensure_ascii=False))
+    cache = PopoEndpointConfigCache()
+
+    _measure("uncached", lambda: _uncached(settings, query, encrypt), args.iterations)
+    _measure("cached", lambda: _cached(cache, settings, query, encrypt), args.iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import dify_plugin  # noqa: F401  先完成gevent的monkey patch，再创建线程和socket
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.popo_callback_factory import FakeDifySession, build_callback_request, build_endpoint_settings, \
+    build_group_at_event, build_p2p_event
+from benchmarks.popo_mock_server import PopoMockServer
+from endpoints.popo_application_bot_callback import PopoBotToolEndpoint
+from MyUtil.popo_agent_dispatcher import get_agent_dispatcher
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_metrics import get_metrics
+
+"""
+端到端回调吞吐基准
+
+本地启动POPO接口替身（token/send-msg）和Dify session替身（chat/workflow，可配置耗时），
+用AESCipher加密、签名生成回调，按目标速率（开环，不等上一个请求结束）调用PopoBotToolEndpoint._invoke，统计：
+- 端点响应延迟（POPO要求3秒内响应）与实际吞吐
+- 端到端首条回复延迟：从回调到达到替身服务器收到第一条回复（回复吞吐受发送队列按popo_app_key的限速约束，默认每秒20条）
+- 进程内存增长（RSS，可选tracemalloc按代码行统计）
+- 各环节耗时（开启了端点的统计功能）
+
+--json-out 保存结果，--baseline 与之前保存的结果对比，吞吐或延迟劣化超过 --tolerance 时以非0退出码结束，
+升级插件前在同一台机器上各跑一次即可发现性能回退。
+
+运行：python -m benchmarks.bench_end_to_end --rate 50 --duration 10 --agent-latency 0.5
+"""
+
+
+def _percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _rss_mb() -> float:
+    """当前进程的常驻内存，MB（仅Linux，其他平台返回0）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return 0.0
+
+
+def _latency_summary(samples: list) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": round(_percentile(samples, 0.5) * 1000, 2),
+        "p90_ms": round(_percentile(samples, 0.9) * 1000, 2),
+        "p99_ms": round(_percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(max(samples) * 1000, 2) if samples else 0.0,
+    }
+
+
+def build_callbacks(count: int, group_ratio: float) -> list:
+    """每条回调的发送人/群都不相同，回复可以按接收人对应到回调；返回(回复接收人, 请求)"""
+    callbacks = []
+    group_every = round(1 / group_ratio) if group_ratio > 0 else 0
+    for i in range(count):
+        if group_every and i % group_every == 0:
+            group_id = str(10000000 + i)
+            event = build_group_at_event(group_id, from_=f"bench{i}@corp.netease.com", notify=f"第{i}个问题")
+            receiver = group_id
+        else:
+            receiver = f"bench{i}@corp.netease.com"
+            event = build_p2p_event(from_=receiver, notify=f"第{i}个问题")
+        request = build_callback_request(event)
+        request.get_data()  # 预先读取请求体，只统计端点处理时间
+        callbacks.append((receiver, request))
+    return callbacks
+
+
+def run(args) -> dict:
+    settings = build_endpoint_settings(agent_type=args.agent_type, response_mode=args.response_mode,
+                                       enable_memory=args.agent_type != "workflow", enable_metrics=True,
+                                       max_concurrency_per_app_key=str(args.max_concurrency),
+                                       max_concurrency_per_agent=str(args.max_concurrency))
+    session = FakeDifySession(agent_latency=args.agent_latency, answer=args.answer)
+    total = int(args.rate * args.duration)
+    callbacks = build_callbacks(total, args.group_ratio)
+
+    with PopoMockServer(latency=args.popo_latency, track_receivers=True) as server:
+        PopoBot.api_base_url = server.base_url
+        # 预热：建立连接、获取token、加载模块，不计入结果
+        warmup = build_callbacks(min(5, total), 0)
+        for _, request in warmup:
+            PopoBotToolEndpoint(session)._invoke(request, {}, settings)
+        time.sleep(args.agent_latency + 0.5)
+        server.reset_stats()
+        get_metrics().reset(settings["popo_app_key"])
+
+        gc.collect()
+        rss_before = _rss_mb()
+        if args.tracemalloc:
+            tracemalloc.start()
+            snapshot_before = tracemalloc.take_snapshot()
+
+        arrived_at = {}
+        endpoint_latency = []
+        status_codes = {}
+        lock = threading.Lock()
+
+        def replay(item):
+            receiver, request = item
+            start = time.perf_counter()
+            with lock:
+                arrived_at[receiver] = start
+            response = PopoBotToolEndpoint(session)._invoke(request, {}, settings)
+            elapsed = time.perf_counter() - start
+            with lock:
+                endpoint_latency.append(elapsed)
+                status_codes[response.status_code] = status_codes.get(response.status_code, 0) + 1
+
+        # 开环施压：按固定间隔提交，不等待之前的请求结束
+        interval = 1 / args.rate
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.max_inflight) as pool:
+            for index, item in enumerate(callbacks):
+                delay = wall_start + index * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(replay, item)
+            issue_elapsed = time.perf_counter() - wall_start
+        endpoint_elapsed = time.perf_counter() - wall_start
+
+        # 等待全部回复发出：每个接收人至少收到一条，或连续drain_timeout秒没有新的回复
+        last_count, last_change = -1, time.perf_counter()
+        while True:
+            received = server.received
+            replied = {receiver for _, receiver in received}
+            if len(replied) >= total or time.perf_counter() - last_change > args.drain_timeout:
+                break
+            if len(received) != last_count:
+                last_count, last_change = len(received), time.perf_counter()
+            time.sleep(0.05)
+        drain_elapsed = (max(t for t, _ in received) - wall_start) if received else endpoint_elapsed
+
+        first_reply = {}
+        for received_time, receiver in received:
+            if receiver in arrived_at and receiver not in first_reply:
+                first_reply[receiver] = received_time - arrived_at[receiver]
+
+        gc.collect()
+        rss_after = _rss_mb()
+        top_growth = []
+        if args.tracemalloc:
+            snapshot_after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            for stat in snapshot_after.compare_to(snapshot_before, "lineno")[:10]:
+                top_growth.append(f"{stat.traceback[0].filename}:{stat.traceback[0].lineno} "
+                                  f"{stat.size_diff / 1024:+.1f}KiB ({stat.count_diff:+d})")
+
+        metrics = get_metrics().snapshot(settings["popo_app_key"])
+        return {
+            "config": {key: value for key, value in vars(args).items() if key not in ("json_out", "baseline")},
+            "callbacks": total,
+            "status_codes": status_codes,
+            "issue_rate": round(total / issue_elapsed, 1) if issue_elapsed else 0.0,
+            "endpoint_throughput": round(total / endpoint_elapsed, 1),
+            "reply_throughput": round(len(first_reply) / drain_elapsed, 1) if drain_elapsed else 0.0,
+            "replied": len(first_reply),
+            "popo_send_requests": server.stats["send"],
+            "endpoint_latency": _latency_summary(endpoint_latency),
+            "first_reply_latency": _latency_summary(list(first_reply.values())),
+            "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1),
+                       "growth": round(rss_after - rss_before, 1)},
+            "tracemalloc_top_growth": top_growth,
+            "dispatcher": get_agent_dispatcher().get_stats(),
+            "spans": metrics["spans"],
+        }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """返回劣化超过容忍度的指标"""
+    regressions = []
+    checks = [
+        ("endpoint_throughput", result["endpoint_throughput"], baseline["endpoint_throughput"], True),
+        ("reply_throughput", result["reply_throughput"], baseline["reply_throughput"], True),
+        ("endpoint_latency.p99_ms", result["endpoint_latency"]["p99_ms"], baseline["endpoint_latency"]["p99_ms"], False),
+        ("first_reply_latency.p99_ms", result["first_reply_latency"]["p99_ms"],
+         baseline["first_reply_latency"]["p99_ms"], False),
+    ]
+    for name, current, previous, higher_is_better in checks:
+        if not previous:
+            continue
+        change = (current - previous) / previous
+        if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+            regressions.append(f"{name}: {previous} -> {current} ({change:+.0%})")
+    return regressions
+
+
+def print_report(result: dict) -> None:
+    print(f"回调数={result['callbacks']} 状态码={result['status_codes']} 实际施压速率={result['issue_rate']}/s")
+    print(f"端点吞吐={result['endpoint_throughput']}/s  回复吞吐={result['reply_throughput']}/s  "
+          f"收到回复={result['replied']}  POPO发送请求={result['popo_send_requests']}")
+    for name in ("endpoint_latency", "first_reply_latency"):
+        latency = result[name]
+        print(f"{name:<20} p50={latency['p50_ms']:8.2f}ms p90={latency['p90_ms']:8.2f}ms "
+              f"p99={latency['p99_ms']:8.2f}ms max={latency['max_ms']:8.2f}ms")
+    rss = result["rss_mb"]
+    print(f"RSS {rss['before']}MB -> {rss['after']}MB（增长{rss['growth']}MB）")
+    for line in result["tracemalloc_top_growth"]:
+        print(f"  {line}")
+    for name, values in result["spans"].items():
+        for agent_type, histogram in values.items():
+            print(f"  {name:<24}{agent_type:<10} count={histogram['count']:>6} avg={histogram['avg_ms']:9.3f}ms "
+                  f"p99≈{histogram['p99_ms']}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=50, help="每秒发起的回调数")
+    parser.add_argument("--duration", type=float, default=10, help="施压时长，秒")
+    parser.add_argument("--agent-type", choices=["chat", "chatflow", "workflow"], default="chat")
+    parser.add_argument("--response-mode", choices=["blocking", "streaming"], default="blocking")
+    parser.add_argument("--agent-latency", type=float, default=0.5, help="模拟智能体调用耗时，秒")
+    parser.add_argument("--popo-latency", type=float, default=0.02, help="POPO接口替身每个请求的延迟，秒")
+    parser.add_argument("--answer", default=None, help="智能体的固定回复，不填则回复“收到：问题”")
+    parser.add_argument("--group-ratio", type=float, default=0.2, help="群@消息所占比例")
+    parser.add_argument("--max-concurrency", type=int, default=32, help="单个机器人/智能体的并发调用上限")
+    parser.add_argument("--max-inflight", type=int, default=256, help="同时处理中的回调请求数上限")
+    parser.add_argument("--drain-timeout", type=float, default=10, help="多久没有新的回复就不再等待，秒")
+    parser.add_argument("--tracemalloc", action="store_true", help="按代码行统计内存增长（会明显变慢）")
+    parser.add_argument("--json-out", help="把结果保存为JSON文件")
+    parser.add_argument("--baseline", help="与之前保存的JSON结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的劣化比例")
+    args = parser.parse_args()
+
+    result = run(args)
+    print_report(result)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("config") != result["config"]:
+            print("注意：基线的运行参数与本次不同，对比结果仅供参考")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print("性能回退：")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("与基线相比没有超过容忍度的回退")
+
+
+if __name__ == '__main__':
+    main()
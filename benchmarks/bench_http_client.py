@@ -0,0 +1,62 @@
+import argparse
+import statistics
+import time
+
+import requests
+
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_http_client import get_http_client
+from benchmarks.popo_mock_server import PopoMockServer
+
+"""
+对比每条消息新建连接（requests.post）与共享连接池（PopoHttpClient）的发送延迟
+
+运行：python -m benchmarks.bench_http_client --messages 500
+"""
+
+
+def _percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def _report(name: str, samples: list, connections: int) -> None:
+    print(f"{name:<22} avg={statistics.mean(samples) * 1000:7.3f}ms "
+          f"p50={_percentile(samples, 0.5) * 1000:7.3f}ms "
+          f"p99={_percentile(samples, 0.99) * 1000:7.3f}ms "
+          f"新建连接数={connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.0, help="替身服务器每个请求的额外延迟，秒")
+    args = parser.parse_args()
+
+    with PopoMockServer(latency=args.latency) as server:
+        url = server.base_url + "/robots/v1/im/send-msg"
+        body = {"receiver": "someone@corp.netease.com", "message": {"content": [{"tag": "text", "text": "hello"}]},
+                "msgType": "rich_text"}
+
+        samples = []
+        for _ in range(args.messages):
+            start = time.perf_counter()
+            requests.post(url, json=body, timeout=5).json()
+            samples.append(time.perf_counter() - start)
+        _report("requests.post", samples, server.stats["connections"])
+
+        server.reset_stats()
+        PopoBot.api_base_url = server.base_url
+        popo_bot = PopoBot("bench_app_key", "bench_app_secret")
+        popo_bot.send_message("someone@corp.netease.com", "warmup")
+        samples = []
+        for _ in range(args.messages):
+            start = time.perf_counter()
+            popo_bot.send_message("someone@corp.netease.com", "hello")
+            samples.append(time.perf_counter() - start)
+        _report("PopoBot（连接池）", samples, server.stats["connections"])
+        get_http_client().close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+"""
+插件冷启动的导入耗时基准（基于 python -X importtime）
+
+Dify运行时会频繁重启插件，每次启动都会导入全部工具和端点模块。分两个场景统计：
+- startup：插件启动时加载的provider、工具和端点模块
+- first_callback：再加上第一次回调才加载的模块（加解密、事件解析、调度、记忆）
+
+dify_plugin本身的导入耗时单独列出，只统计在它之后导入的模块。每个场景在新进程中运行多次取中位数。
+--json-out 保存结果，--baseline 与之前保存的结果对比，启动耗时劣化超过 --tolerance 时以非0退出码结束。
+
+运行：python -m benchmarks.bench_import_time --runs 5
+"""
+
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 插件启动时由dify_plugin按yaml加载的模块
+startup_modules = [
+    "provider.popo_platform",
+    "tools.popo_application_bot",
+    "tools.popo_custom_bot",
+    "endpoints.popo_application_bot_callback",
+    "endpoints.popo_application_bot_metrics",
+]
+# 第一次回调时才加载的模块
+first_callback_modules = [
+    "MyUtil.popo_endpoint_config_cache",
+    "MyUtil.popo_agent_dispatcher",
+    "MyUtil.popo_callback_dedup",
+    "MyUtil.popo_bot_memory",
+    "MyUtil.popo_stream_reply",
+    "models.popo_bot_callback_structures",
+    "Crypto.Cipher.AES",
+]
+project_packages = ("MyUtil", "models", "tools", "endpoints", "provider")
+
+
+def _parse_importtime(stderr: str) -> list:
+    """返回 [(模块名, 层级, 自身耗时µs, 累计耗时µs)]，按导入完成的顺序"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        entries.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def measure(modules: list) -> dict:
+    """在新进程中先导入dify_plugin，再导入modules"""
+    code = "import dify_plugin\n" + "".join(f"import {module}\n" for module in modules)
+    env = dict(os.environ, PYTHONPATH=project_root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=project_root, env=env,
+                               capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    entries = _parse_importtime(completed.stderr)
+    if completed.returncode != 0:
+        raise RuntimeError(f"导入失败：{completed.stderr[-2000:]}")
+
+    dify_index = next(index for index, entry in enumerate(entries) if entry[0] == "dify_plugin" and entry[1] == 0)
+    plugin_entries = entries[dify_index + 1:]
+    return {
+        "wall_ms": wall * 1000,
+        "dify_plugin_ms": entries[dify_index][3] / 1000,
+        # dify_plugin之后导入的全部模块（插件代码及其依赖）
+        "plugin_ms": sum(entry[3] for entry in plugin_entries if entry[1] == 0) / 1000,
+        "modules": {entry[0]: entry[3] / 1000 for entry in plugin_entries if entry[1] == 0},
+        "heaviest": sorted(((entry[0], entry[2] / 1000) for entry in plugin_entries), key=lambda item: -item[1])[:10],
+    }
+
+
+def run_scenario(modules: list, runs: int) -> dict:
+    results = [measure(modules) for _ in range(runs)]
+    median = lambda key: round(statistics.median(result[key] for result in results), 2)
+    last = results[-1]
+    return {
+        "wall_ms": median("wall_ms"),
+        "dify_plugin_ms": median("dify_plugin_ms"),
+        "plugin_ms": median("plugin_ms"),
+        "modules": {name: round(statistics.median(result["modules"].get(name, 0.0) for result in results), 2)
+                    for name in last["modules"]},
+        "heaviest": [(name, round(ms, 2)) for name, ms in last["heaviest"]],
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for scenario in ("startup", "first_callback"):
+        current, previous = result[scenario]["plugin_ms"], baseline[scenario]["plugin_ms"]
+        if previous and (current - previous) / previous > tolerance:
+            regressions.append(f"{scenario}.plugin_ms: {previous} -> {current} ({(current - previous) / previous:+.0%})")
+    return regressions
+
+
+def print_report(result: dict) -> None:
+    for scenario in ("startup", "first_callback"):
+        values = result[scenario]
+        print(f"[{scenario}] 进程总耗时={values['wall_ms']:.1f}ms  dify_plugin={values['dify_plugin_ms']:.1f}ms  "
+              f"插件模块={values['plugin_ms']:.1f}ms")
+        for name, ms in values["modules"].items():
+            if name.startswith(project_packages) or name in first_callback_modules:
+                print(f"  {name:<45}{ms:8.2f}ms")
+        print("  自身耗时最多：" + "，".join(f"{name} {ms}ms" for name, ms in values["heaviest"][:5]))
+    print(f"第一次回调额外的导入耗时：{result['first_callback']['plugin_ms'] - result['startup']['plugin_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="每个场景运行的次数，取中位数")
+    parser.add_argument("--json-out", help="把结果保存为JSON文件")
+    parser.add_argument("--baseline", help="与之前保存的JSON结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的劣化比例")
+    args = parser.parse_args()
+
+    result = {
+        "startup": run_scenario(startup_modules, args.runs),
+        "first_callback": run_scenario(startup_modules + first_callback_modules, args.runs),
+    }
+    print_report(result)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print("导入耗时回退：")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("与基线相比没有超过容忍度的回退")
+
+
+if __name__ == '__main__':
+    main()
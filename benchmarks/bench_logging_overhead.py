@@ -0,0 +1,109 @@
+import argparse
+import logging
+import time
+from datetime import datetime
+
+from benchmarks.popo_callback_factory import build_callback_request, build_endpoint_settings, build_p2p_event
+from MyUtil.popo_bot_memory import PopoBotMemory
+from MyUtil.popo_endpoint_config_cache import get_endpoint_config
+from MyUtil.popo_logging import debug_payload, lazy
+
+"""
+每个回调在日志上花费的CPU：原来的f-string写法与延迟格式化写法的对比
+
+按一次chat阻塞调用的路径（端点、记忆、发送消息）重放全部debug日志语句：
+- production：线上只开启INFO，debug日志不输出，原写法仍会拼接字符串、序列化配置和记忆
+- dev：本地开发开启DEBUG（未设置POPO_LOG_PAYLOADS），日志经过格式化后丢弃
+
+运行：python -m benchmarks.bench_logging_overhead --iterations 20000
+"""
+
+
+class _DiscardHandler(logging.Handler):
+    """完成格式化但不输出，只统计格式化的开销"""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.format(record)
+
+
+def build_context() -> dict:
+    plugin_settings = get_endpoint_config(build_endpoint_settings()).plugin_settings
+    event = build_p2p_event(notify="帮我总结一下今天的会议纪要")
+    request = build_callback_request(event)
+    request.get_data()
+    memory = PopoBotMemory("user@corp.netease.com", "user@corp.netease.com", "conversation-id", datetime.now(),
+                           plugin_settings.agent_app_id, plugin_settings.popo_app_key)
+    response = {"conversation_id": "conversation-id", "answer": "会议纪要如下：" * 50, "metadata": {"usage": {}}}
+    body = {"receiver": "user@corp.netease.com", "message": {"content": [{"tag": "text", "text": response["answer"]}]},
+            "msgType": "rich_text"}
+    return {"settings": plugin_settings, "request": request, "callback_message": event, "memory": memory,
+            "response": response, "body": body}
+
+
+def legacy_logging(logger: logging.Logger, c: dict) -> None:
+    """原来各处的debug日志写法"""
+    r = c["request"]
+    plugin_settings = c["settings"]
+    memory = c["memory"]
+    logger.debug(f"settings = {plugin_settings}")
+    logger.debug(f"signature = {r.args.get('signature')}, timestamp = {r.args.get('timestamp')}, "
+                 f"nonce = {r.args.get('nonce')}, encrypt = {None}")
+    logger.debug(f"请求方法: {r.method}")
+    logger.debug(f"请求参数：{r.args}, 请求体：{r.data}")
+    logger.debug(f"解密内容：{c['callback_message']}")
+    logger.debug(f"调用智能体参数 - app_id: {plugin_settings.agent_app_id}")
+    logger.debug(f"应用类型：{plugin_settings.agent_type}")
+    logger.debug("没有找到记忆" if memory is None else "记忆：" + str(memory.to_dict()))
+    logger.debug(f"存入记忆成功: keyName = {'key'}, memory_content = {memory.to_dict()}")
+    logger.debug(c["response"])
+    logger.debug(f"发送消息：{c['body']}")
+    logger.debug(f"回复结束，回复对象：{'user@corp.netease.com'}")
+
+
+def current_logging(logger: logging.Logger, c: dict) -> None:
+    """现在的写法：占位符延迟格式化，完整内容需要POPO_LOG_PAYLOADS"""
+    r = c["request"]
+    plugin_settings = c["settings"]
+    memory = c["memory"]
+    debug_payload(logger, "settings = %s", plugin_settings)
+    debug_payload(logger, "signature = %s, timestamp = %s, nonce = %s, encrypt = %s",
+                  r.args.get('signature'), r.args.get('timestamp'), r.args.get('nonce'), None)
+    logger.debug("请求方法: %s", r.method)
+    debug_payload(logger, "请求参数：%s, 请求体：%s", r.args, lazy(r.get_data))
+    debug_payload(logger, "解密内容：%s", c["callback_message"])
+    logger.debug("调用智能体参数 - app_id: %s", plugin_settings.agent_app_id)
+    logger.debug("应用类型：%s", plugin_settings.agent_type)
+    logger.debug("记忆：%s", lazy(memory.to_dict) if memory is not None else "没有找到")
+    logger.debug("存入记忆成功: keyName = %s, memory_content = %s", "key", lazy(memory.to_dict))
+    debug_payload(logger, "智能体响应：%s", c["response"])
+    debug_payload(logger, "发送消息：%s", c["body"])
+    logger.debug("回复结束，回复对象：%s", "user@corp.netease.com")
+
+
+def _bench(func, logger: logging.Logger, context: dict, iterations: int) -> float:
+    """每次调用的CPU时间，秒"""
+    start = time.process_time()
+    for _ in range(iterations):
+        func(logger, context)
+    return (time.process_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    context = build_context()
+    logger = logging.getLogger("bench_logging_overhead")
+    logger.propagate = False
+    logger.addHandler(_DiscardHandler())
+    for mode, level in (("production", logging.INFO), ("dev", logging.DEBUG)):
+        logger.setLevel(level)
+        legacy = _bench(legacy_logging, logger, context, args.iterations)
+        current = _bench(current_logging, logger, context, args.iterations)
+        print(f"{mode:<11} 原写法={legacy * 1e6:8.2f}µs/回调  现写法={current * 1e6:8.2f}µs/回调  "
+              f"节省={(legacy - current) * 1e6:8.2f}µs（{(1 - current / legacy):.0%}）")
+
+
+if __name__ == '__main__':
+    main()
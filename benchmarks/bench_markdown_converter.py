@@ -0,0 +1,83 @@
+import argparse
+import random
+import re
+import time
+
+from MyUtil.popo_markdown_converter import convert_markdown, convert_markdown_images
+
+"""
+图片链接转换的等价性模糊测试与病态输入基准
+
+- 随机生成由 ![ ] ( ) 换行 等字符组成的文本，校验与原正则替换的结果完全一致
+- 构造会让原正则大量回溯的输入，对比原正则与单次扫描实现的耗时随长度的增长
+
+运行：python -m benchmarks.bench_markdown_converter --fuzz 100000
+"""
+
+legacy_pattern = r'!\[(.*?)]\(([^()]*(\([^()]*\)[^()]*)*)\)'
+_fuzz_alphabet = ["!", "[", "]", "(", ")", "\n", "a", " ", "![", "](", "()", "[img]"]
+
+
+def legacy_convert(text: str) -> str:
+    return re.sub(legacy_pattern, r'[img]\2[/img]', text)
+
+
+def fuzz(iterations: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for _ in range(iterations):
+        text = "".join(rng.choice(_fuzz_alphabet) for _ in range(rng.randint(0, 40)))
+        expected = legacy_convert(text)
+        actual = convert_markdown_images(text)
+        if expected != actual:
+            raise AssertionError(f"结果不一致: {text!r}\n原正则: {expected!r}\n新实现: {actual!r}")
+    print(f"模糊测试通过：{iterations}条随机文本与原正则结果一致")
+
+
+# 病态输入：每个"!["都要尝试同一行后面的所有"]("，而每个地址都要扫描到文本末尾才发现不匹配
+pathological_inputs = {
+    "many_images_unclosed_url": lambda n: "![" * n + "](" + "a" * n,
+    "many_candidates_one_line": lambda n: "![a" + "](b" * n,
+    "nested_parens": lambda n: "![a](" + "((" * n,
+    "balanced_pairs_unclosed": lambda n: "![a](" + "(x)" * n,
+    "llm_like_noise": lambda n: ("![图](http://a.com/x(" + "(1)" * 3 + "\n") * (n // 10),
+}
+
+
+def _time(func, text: str) -> float:
+    start = time.perf_counter()
+    func(text)
+    return time.perf_counter() - start
+
+
+def bench(sizes: list, legacy_timeout: float) -> None:
+    for name, build in pathological_inputs.items():
+        legacy_slow = False
+        for size in sizes:
+            text = build(size)
+            new_elapsed = _time(convert_markdown_images, text)
+            if legacy_slow:
+                legacy = "跳过"
+            else:
+                legacy_elapsed = _time(legacy_convert, text)
+                legacy = f"{legacy_elapsed * 1000:10.2f}ms"
+                # 原正则接近平方增长，超过阈值后不再测更大的输入
+                legacy_slow = legacy_elapsed > legacy_timeout
+            print(f"{name:<26} 长度={len(text):>8} 原正则={legacy:>12} 新实现={new_elapsed * 1000:8.2f}ms")
+
+    text = "\n".join(f"- **第{i}项** 见[文档](http://a.com/{i}) ![图](http://a.com/{i}.png)" for i in range(20000))
+    elapsed = _time(lambda t: convert_markdown(t, links=True, emphasis=True, lists=True, code_fences=True), text)
+    print(f"{'全部转换（链接/加粗/列表）':<26} 长度={len(text):>8} 新实现={elapsed * 1000:8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fuzz", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--legacy-timeout", type=float, default=2.0, help="原正则单次耗时超过该值后不再测更大的输入，秒")
+    args = parser.parse_args()
+    fuzz(args.fuzz, args.seed)
+    bench([1000, 4000, 16000, 64000], args.legacy_timeout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import dify_plugin  # noqa: F401  先完成gevent的monkey patch，再创建线程和socket
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.popo_mock_server import PopoMockServer
+from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_send_queue import PopoSendQueue, PopoSendQueueConfig
+
+"""
+突发发送对比：每条消息直接调用send_message，与经过发送队列（令牌桶限速+退避重试+短消息合并）
+
+替身服务器对单个接收人限流（默认每秒2条），统计最终送达和丢失的消息数。
+运行：python -m benchmarks.bench_send_queue --receivers 5 --messages-per-receiver 10
+"""
+
+
+def run_direct(popo_bot: PopoBot, receivers: list, messages: int, concurrency: int) -> None:
+    failed = 0
+    lock = threading.Lock()
+
+    def send(receiver_index):
+        nonlocal failed
+        receiver, index = receiver_index
+        try:
+            popo_bot.send_message(receiver, f"第{index}条消息")
+        except ValueError:
+            with lock:
+                failed += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, [(receiver, i) for i in range(messages) for receiver in receivers]))
+    elapsed = time.perf_counter() - start
+    total = messages * len(receivers)
+    print(f"{'direct':<12} 消息数={total} 丢失={failed} 耗时={elapsed:6.2f}s")
+
+
+def run_queue(popo_bot: PopoBot, receivers: list, messages: int, config: PopoSendQueueConfig, name: str) -> None:
+    send_queue = PopoSendQueue(config)
+    start = time.perf_counter()
+    submit_start = time.perf_counter()
+    batches = [send_queue.submit(popo_bot, receiver, f"第{i}条消息") for i in range(messages) for receiver in receivers]
+    submit_elapsed = time.perf_counter() - submit_start
+    for batch in batches:
+        batch.wait()
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for batch in batches if batch.error is not None)
+    stats = send_queue.get_stats()
+    print(f"{name:<12} 消息数={len(batches)} 丢失={failed} 耗时={elapsed:6.2f}s "
+          f"提交耗时={submit_elapsed * 1000:6.2f}ms 合并={stats['merged']} 重试={stats['retried']}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--receivers", type=int, default=5)
+    parser.add_argument("--messages-per-receiver", type=int, default=10)
+    parser.add_argument("--receiver-rate-limit", type=int, default=2, help="替身服务器每个接收人每秒允许的消息数")
+    args = parser.parse_args()
+
+    receivers = [f"user{i}@corp.netease.com" for i in range(args.receivers)]
+    with PopoMockServer(receiver_rate_limit=args.receiver_rate_limit) as server:
+        PopoBot.api_base_url = server.base_url
+        popo_bot = PopoBot("bench_app_key", "bench_app_secret")
+        popo_bot.get_token(popo_bot.appKey, popo_bot.app_secret)
+
+        run_direct(popo_bot, receivers, args.messages_per_receiver, concurrency=16)
+        time.sleep(1)
+        server.reset_stats()
+        # 不合并，只靠限速
+        run_queue(popo_bot, receivers, args.messages_per_receiver,
+                  PopoSendQueueConfig(merge_small_messages=False), "queue")
+        time.sleep(1)
+        # 限速比服务器宽松，依赖退避重试
+        run_queue(popo_bot, receivers, args.messages_per_receiver,
+                  PopoSendQueueConfig(merge_small_messages=False, receiver_rate=10, receiver_burst=10,
+                                      max_retries=10), "queue+retry")
+        time.sleep(1)
+        run_queue(popo_bot, receivers, args.messages_per_receiver, PopoSendQueueConfig(merge_small_messages=True),
+                  "queue+merge")
+
+
+if __name__ == '__main__':
+    main()
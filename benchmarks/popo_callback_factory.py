@@ -0,0 +1,255 @@
+import hashlib
+import itertools
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from werkzeug import Request
+from werkzeug.test import EnvironBuilder
+
+from MyUtil.popo_encryption_tool import AESCipher
+
+"""
+基准测试用的回调构造工具与Dify session替身
+
+- build_endpoint_settings：构造端点配置
+- build_callback_request：用AESCipher加密、按POPO规则签名，生成POST回调请求
+- FakeDifySession：可配置延迟的 session.app.chat/workflow 与内存版 session.storage；
+  与dify_plugin的全双工反向调用一样，先通过session.writer写出请求，再等待智能体执行
+"""
+
+BENCH_TOKEN = "bench_token"
+BENCH_AES_KEY = "PFPsJJk5AnYEJwcXHeDdwBm6f2AQCsGF"
+BENCH_BOT_ACCOUNT = "bench_robot@popo.netease.com"
+
+_message_counter = itertools.count()
+
+
+def build_endpoint_settings(agent_type: str = "chat", **overrides) -> dict:
+    settings = {
+        "token": BENCH_TOKEN,
+        "aesKey": BENCH_AES_KEY,
+        "agent": {"app_id": "bench_agent_app_id", "files": [], "inputs": {}, "type": "app"},
+        "agent_type": agent_type,
+        "is_auto_reply": True,
+        "popo_app_key": "bench_app_key",
+        "popo_app_secret": "bench_app_secret",
+        "auto_reply_preset_message": None,
+        "enable_memory": True,
+    }
+    settings.update(overrides)
+    return settings
+
+
+def build_p2p_event(from_: str = "user@corp.netease.com", notify: str = "你好", session_id: str = None,
+                    message_uuid: str = None, extra: dict = None) -> dict:
+    event_data = {
+        "msgType": 1,
+        "addtime": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "sessionType": 1,
+        "robotIds": [BENCH_BOT_ACCOUNT],
+        "from": from_,
+        "to": BENCH_BOT_ACCOUNT,
+        "sessionId": session_id or from_,
+        "uuid": message_uuid or f"{uuid.uuid4().hex}-{next(_message_counter)}",
+        "notify": notify,
+    }
+    if extra:
+        event_data.update(extra)
+    return {"eventType": "IM_P2P_TO_ROBOT_MSG", "eventData": event_data}
+
+
+def build_group_at_event(group_id: str, from_: str = "user@corp.netease.com", notify: str = "你好",
+                         message_uuid: str = None) -> dict:
+    """群内@机器人的消息事件"""
+    return {
+        "eventType": "IM_CHAT_TO_ROBOT_AT_MSG",
+        "eventData": {
+            "msgType": 1,
+            "sessionId": group_id,
+            "uuid": message_uuid or f"{uuid.uuid4().hex}-{next(_message_counter)}",
+            "notify": f"@机器人 {notify}",
+            "addtime": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "sessionType": 3,
+            "from": from_,
+            "to": group_id,
+            "atType": 1,
+            "atList": [BENCH_BOT_ACCOUNT],
+        },
+    }
+
+
+def build_p2p_recall_event(message_uuid: str, session_id: str = "user@corp.netease.com") -> dict:
+    """撤回单聊消息的事件"""
+    return {
+        "eventType": "IM_P2P_USER_RECALL_MSG",
+        "eventData": {
+            "recallTime": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "sessionType": 1,
+            "sessionId": session_id,
+            "uuid": message_uuid,
+        },
+    }
+
+
+def build_merge_list(count: int, from_: str = "user@corp.netease.com") -> dict:
+    """合并转发消息的附加字段"""
+    return {
+        "msgType": 161,
+        "mergeTitle": "聊天记录",
+        "mergeList": [
+            {
+                "msgType": 1,
+                "addtime": "2025-08-27 19:14:35",
+                "sessionType": 1,
+                "from": from_,
+                "to": BENCH_BOT_ACCOUNT,
+                "sessionId": from_,
+                "uuid": uuid.uuid4().hex,
+                "notify": f"第{i}条合并消息，" + "内容" * 20,
+            }
+            for i in range(count)
+        ],
+    }
+
+
+def sign(token: str, timestamp: str, nonce: str) -> str:
+    data = "".join(sorted([token, timestamp, nonce]))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def build_callback_query(token: str = BENCH_TOKEN) -> dict:
+    timestamp = str(int(time.time() * 1000))
+    nonce = uuid.uuid4().hex[:8]
+    return {"signature": sign(token, timestamp, nonce), "timestamp": timestamp, "nonce": nonce}
+
+
+def build_callback_request(event: dict, aes_key: str = BENCH_AES_KEY, token: str = BENCH_TOKEN) -> Request:
+    encrypt = AESCipher(aes_key).aes_cbc_encrypt(json.dumps(event, ensure_ascii=False))
+    builder = EnvironBuilder(
+        path="/popo_application_bot_callback?" + urlencode(build_callback_query(token)),
+        method="POST",
+        json={"encrypt": encrypt},
+    )
+    try:
+        return Request(builder.get_environ())
+    finally:
+        builder.close()
+
+
+class _FakeChat:
+    def __init__(self, session: "FakeDifySession"):
+        self._session = session
+
+    def invoke(self, app_id, query, inputs, response_mode="streaming", conversation_id=None, files=None):
+        self._session.record_call("chat", query, conversation_id)
+        conversation_id = conversation_id or uuid.uuid4().hex
+        answer = self._session.answer_for(query)
+        if response_mode == "streaming":
+            return self._session.stream_chat(answer, conversation_id)
+        self._session.backwards_invoke()
+        return {"event": "message", "conversation_id": conversation_id, "answer": answer}
+
+
+class _FakeWorkflow:
+    def __init__(self, session: "FakeDifySession"):
+        self._session = session
+
+    def invoke(self, app_id, inputs, response_mode="blocking", files=None):
+        self._session.record_call("workflow", inputs.get("popo_input_message"), None)
+        answer = self._session.answer_for(inputs.get("popo_input_message"))
+        if response_mode == "streaming":
+            return self._session.stream_workflow(answer)
+        self._session.backwards_invoke()
+        return {"data": {"status": "succeeded", "outputs": {"popo_output_message": answer}}}
+
+
+class _FakeApp:
+    def __init__(self, session: "FakeDifySession"):
+        self.chat = _FakeChat(session)
+        self.workflow = _FakeWorkflow(session)
+
+
+class FakeStorage:
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def set(self, key: str, val: bytes) -> None:
+        with self._lock:
+            self._data[key] = bytes(val)
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            if key not in self._data:
+                raise Exception("not found")
+            return self._data[key]
+
+    def exist(self, key: str) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class FakeWriter:
+    """全双工时的ResponseWriter，请求写出即送达"""
+
+    def session_message(self, session_id=None, data=None) -> None:
+        pass
+
+
+class FakeDifySession:
+    """模拟dify_plugin的Session，只实现插件用到的部分"""
+
+    def __init__(self, agent_latency: float = 0.0, answer: str = None, stream_chunk_size: int = 8,
+                 stream_chunk_interval: float = 0.0):
+        self.agent_latency = agent_latency
+        self.answer = answer
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_chunk_interval = stream_chunk_interval
+        self.install_method = None
+        self.writer = FakeWriter()
+        self._executor = ThreadPoolExecutor(max_workers=64)
+        self.app = _FakeApp(self)
+        self.storage = FakeStorage()
+        self.calls = []
+        self._calls_lock = threading.Lock()
+
+    def record_call(self, kind: str, query: str, conversation_id: str) -> None:
+        with self._calls_lock:
+            self.calls.append((kind, query, conversation_id))
+
+    def backwards_invoke(self) -> None:
+        """写出反向调用请求，再等待智能体执行完"""
+        self.writer.session_message()
+        time.sleep(self.agent_latency)
+
+    def answer_for(self, query: str) -> str:
+        return self.answer if self.answer is not None else f"收到：{query}"
+
+    def _chunks(self, answer: str):
+        for i in range(0, len(answer), self.stream_chunk_size):
+            if self.stream_chunk_interval:
+                time.sleep(self.stream_chunk_interval)
+            yield answer[i:i + self.stream_chunk_size]
+
+    def stream_chat(self, answer: str, conversation_id: str):
+        # 与dify_plugin一样，开始迭代时才写出请求
+        self.backwards_invoke()
+        for chunk in self._chunks(answer):
+            yield {"event": "message", "conversation_id": conversation_id, "answer": chunk}
+        yield {"event": "message_end", "conversation_id": conversation_id}
+
+    def stream_workflow(self, answer: str):
+        self.backwards_invoke()
+        yield {"event": "workflow_started", "data": {}}
+        for chunk in self._chunks(answer):
+            yield {"event": "text_chunk", "data": {"text": chunk}}
+        yield {"event": "workflow_finished",
+               "data": {"status": "succeeded", "outputs": {"popo_output_message": answer}}}
@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+本地POPO开放平台替身，用于基准测试
+
+提供 /open-apis/robots/v1/token、/open-apis/robots/v1/im/send-msg 以及自定义机器人 /open-apis/robots/v1/hook/<id>，
+可配置每个请求的额外延迟和单个接收人的发送频率限制，并统计收到的请求数与新建连接数。
+"""
+
+
+class _PopoMockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.stats_lock:
+            self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.path.endswith("/robots/v1/token"):
+            key = "token"
+            result = {
+                "errcode": 0,
+                "errmsg": "success",
+                "data": {
+                    "accessToken": "mock-token",
+                    "accessExpiredAt": int((time.time() + self.server.token_ttl) * 1000),
+                },
+            }
+        elif self.path.endswith("/robots/v1/im/send-msg"):
+            key = "send"
+            result = {"errcode": 0, "errmsg": "success", "data": None}
+            receiver = json.loads(body).get("receiver") if self.server.receiver_rate_limit or \
+                self.server.track_receivers else None
+            if self.server.receiver_rate_limit and self._is_throttled(receiver):
+                key = "throttled"
+                result = {"errcode": 50004, "errmsg": "request too many times, please try again later", "data": None}
+            elif self.server.track_receivers:
+                with self.server.stats_lock:
+                    self.server.received.append((time.perf_counter(), receiver))
+        elif "/robots/v1/hook/" in self.path:
+            key = "hook"
+            result = {"errcode": 0, "errmsg": "success"}
+        else:
+            self.send_error(404)
+            return
+
+        with self.server.stats_lock:
+            self.server.stats[key] += 1
+            if self.server.keep_bodies:
+                self.server.bodies.append((key, body))
+
+        payload = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def _is_throttled(self, receiver: str) -> bool:
+        """1秒内发给同一接收人的消息超过receiver_rate_limit条时限流"""
+        now = time.monotonic()
+        with self.server.stats_lock:
+            sent = [t for t in self.server.sent_at.get(receiver, []) if now - t < 1]
+            if len(sent) >= self.server.receiver_rate_limit:
+                self.server.sent_at[receiver] = sent
+                return True
+            sent.append(now)
+            self.server.sent_at[receiver] = sent
+            return False
+
+
+class _PopoMockHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024  # 默认的5在并发压测时会直接reset连接
+
+
+class PopoMockServer:
+    def __init__(self, latency: float = 0.0, token_ttl: float = 7200, keep_bodies: bool = False,
+                 receiver_rate_limit: int = None, track_receivers: bool = False):
+        self._server = _PopoMockHTTPServer(("127.0.0.1", 0), _PopoMockHandler)
+        self._server.daemon_threads = True
+        self._server.latency = latency
+        self._server.token_ttl = token_ttl
+        self._server.keep_bodies = keep_bodies
+        self._server.receiver_rate_limit = receiver_rate_limit
+        # 记录每条成功发送的(time.perf_counter, 接收人)，用于统计端到端的回复延迟
+        self._server.track_receivers = track_receivers
+        self._server.received = []
+        self._server.sent_at = {}
+        self._server.bodies = []
+        self._server.stats_lock = threading.Lock()
+        self._server.stats = {"connections": 0, "token": 0, "send": 0, "hook": 0, "throttled": 0}
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/open-apis"
+
+    @property
+    def stats(self) -> dict:
+        with self._server.stats_lock:
+            return dict(self._server.stats)
+
+    @property
+    def bodies(self) -> list:
+        with self._server.stats_lock:
+            return list(self._server.bodies)
+
+    @property
+    def received(self) -> list:
+        with self._server.stats_lock:
+            return list(self._server.received)
+
+    def reset_stats(self) -> None:
+        with self._server.stats_lock:
+            for key in self._server.stats:
+                self._server.stats[key] = 0
+            self._server.bodies.clear()
+            self._server.received.clear()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,66 @@
+import argparse
+import threading
+import time
+import uuid
+
+from MyUtil import popo_bot_memory
+from benchmarks.popo_callback_factory import FakeStorage, build_endpoint_settings, build_p2p_event
+from models.popo_bot_callback_structures import dict_to_robot_event
+from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings
+
+"""
+多线程同时对同一个会话get-or-reserve，检查是否只创建了一个Dify会话
+
+运行：python -m benchmarks.stress_memory_reservation --threads 64 --rounds 20
+"""
+
+
+def run(backend: str, threads: int, rounds: int, agent_latency: float) -> None:
+    plugin_settings = PopoBotEndpointSettings(build_endpoint_settings(memory_backend=backend))
+    storage = FakeStorage()
+    forked = 0
+    for round_ in range(rounds):
+        # 持久化存储的记忆会读取进程内尚未持久化的记忆，两种后端不能共用会话
+        robot_event = dict_to_robot_event(build_p2p_event(from_=f"stress-{backend}{round_}@corp.netease.com"))
+        created = []
+        used = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+
+        def call_agent():
+            barrier.wait()
+            with popo_bot_memory.reserve_popobot_memory(robot_event, plugin_settings, storage) as reservation:
+                conversation_id = reservation.conversation_id
+                if not conversation_id:
+                    # 模拟chat.invoke创建新会话
+                    time.sleep(agent_latency)
+                    conversation_id = uuid.uuid4().hex
+                    with lock:
+                        created.append(conversation_id)
+                reservation.commit(conversation_id)
+            with lock:
+                used.append(conversation_id)
+
+        workers = [threading.Thread(target=call_agent) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if len(created) != 1 or len(set(used)) != 1:
+            forked += 1
+    print(f"backend={backend:<8} threads={threads} rounds={rounds} 会话分叉的轮数={forked}")
+    assert forked == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--agent-latency", type=float, default=0.01)
+    args = parser.parse_args()
+    for backend in ("memory", "storage"):
+        run(backend, args.threads, args.rounds, args.agent_latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,47 +1,55 @@
+import hmac
 import json
 import logging
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 
 from dify_plugin.config.config import InstallMethod
-from dify_plugin.config.logger_format import plugin_logger_handler
-import sys
-from typing import Mapping
+from typing import Mapping, TYPE_CHECKING
 
 from werkzeug import Request, Response
 from dify_plugin import Endpoint
 
-from MyUtil import popo_bot_memory
 from MyUtil.popo_application_bot_util import PopoBot
-from MyUtil.popo_encryption_tool import AESCipher
-from models.popo_bot_callback_structures import dict_to_robot_event, RobotEvent, PopoEventType
-from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings, GroupMessageReplyMethod, AgentType
-
-
-# 日志，本地开发的使用用debug
-logger = logging.getLogger(__name__)
-if sys.platform in ('win32', 'cygwin', 'darwin'):
-    is_dev = True
-    # 清空已有的handlers避免重复
-    logger.handlers.clear()
-    logger.setLevel(logging.DEBUG)
-    # 为开发环境创建专门的handler
-    dev_handler = logging.StreamHandler()
-    dev_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    dev_handler.setFormatter(dev_formatter)
-    logger.addHandler(dev_handler)
-    logger.propagate = False  # 防止日志向父级传播
-else:
-    is_dev = False
-    logger.setLevel(logging.INFO)
-    logger.addHandler(plugin_logger_handler)
+from MyUtil.popo_metrics import get_metrics
+from MyUtil.popo_send_queue import get_send_queue
+from MyUtil.popo_logging import debug_payload, get_logger, is_dev, lazy, log_sampled
+from models.popo_bot_endpoint_settings_structures import PopoBotEndpointSettings, GroupMessageReplyMethod, AgentType, \
+    ResponseMode, MemoryBackendType
+
+if TYPE_CHECKING:
+    from MyUtil.popo_agent_dispatcher import AgentDispatchJob
+    from models.popo_bot_callback_structures import RobotEvent
+
+
+logger = get_logger(__name__)
+
+# 排队等待调度器开始反向调用智能体的时间，秒；到时仍在排队的任务超出并发上限直接开始，再等待同样的时间后端点返回
+agent_handoff_timeout = 1
 
 # 定义 PopoBotToolEndpoint 类，继承自 Endpoint
 class PopoBotToolEndpoint(Endpoint):
     def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
-        if logger.level == logging.DEBUG: self.session.install_method = InstallMethod.Remote
+        if is_dev: self.session.install_method = InstallMethod.Remote
+        # 回调处理用到的加解密、事件解析、调度和记忆模块在第一次回调时才加载，插件启动和只调用工具时不需要
+        from MyUtil import popo_bot_memory
+        from MyUtil.popo_agent_dispatcher import AgentDispatchJob, DispatchQueueFullError, get_agent_dispatcher
+        from MyUtil.popo_callback_dedup import get_callback_deduplicator, get_dedup_key
+        from MyUtil.popo_endpoint_config_cache import get_endpoint_config
+        from models.popo_bot_callback_structures import dict_to_robot_event, PopoEventType
+        # 已标记为处理过的回调的去重key，处理失败时撤销标记，让POPO的重发可以重新处理
+        dedup_key = None
+        dedup_storage = None
         try:
-            plugin_settings = PopoBotEndpointSettings(settings)
+            # 解析后的配置、加解密和签名校验对象按配置缓存，配置修改后自动失效
+            endpoint_config = get_endpoint_config(settings)
+            plugin_settings = endpoint_config.plugin_settings
+            # 各环节耗时按机器人和应用类型统计，未开启时不记录
+            metrics = get_metrics()
+            metrics.set_enabled(plugin_settings.popo_app_key, plugin_settings.enable_metrics)
+            metric_labels = (plugin_settings.popo_app_key, plugin_settings.agent_type.value)
             logger.debug("进入_invoke回调")
             # 非POPO回调时的连通性测试
             if not r.args:
@@ -49,6 +57,14 @@ class PopoBotToolEndpoint(Endpoint):
                     "备注": "端点连通性测试成功，插件使用方式请参考文档：https://docs.popo.netease.com/lingxi/4684e4335f894ab3a8a6b920adc71562"
                 }
                 result.update(plugin_settings.get_desensitized_settings())
+                # 调度器、记忆和去重记录是进程内所有机器人共享的，只返回本机器人的统计
+                app_key = plugin_settings.popo_app_key
+                result["dispatcher"] = get_agent_dispatcher().get_app_key_stats(app_key)
+                memory_storage = None
+                if plugin_settings.memory_backend == MemoryBackendType.STORAGE:
+                    memory_storage = self.session.storage
+                result["memory_count"] = popo_bot_memory.count_memory(popo_app_key=app_key, storage=memory_storage)
+                result["callback_dedup"] = get_callback_deduplicator().get_stats(app_key)
                 logger.debug("连通性测试成功")
                 return Response(
                     json.dumps(result, ensure_ascii=False),
@@ -56,21 +72,28 @@ class PopoBotToolEndpoint(Endpoint):
                     content_type="application/json; charset=utf-8"
                 )
 
+            # 记忆管理请求，需要携带端点配置中的token
+            if "memory_action" in r.args:
+                return self._handle_memory_admin(r, plugin_settings)
+
             # popo方的query数据
             signature = r.args.get('signature')
             timestamp = r.args.get('timestamp')
             nonce = r.args.get('nonce')
             encrypt = r.args.get('encrypt')  # get请求时才有这个参数
 
-            logger.debug(f"settings = {plugin_settings}")
-            logger.debug(f"signature = {signature}, timestamp = {timestamp}, nonce = {nonce}, encrypt = {encrypt}")
+            # 配置和请求参数只在开启了完整内容输出时记录，避免每个回调都序列化一次配置
+            debug_payload(logger, "settings = %s", plugin_settings)
+            debug_payload(logger, "signature = %s, timestamp = %s, nonce = %s, encrypt = %s",
+                          signature, timestamp, nonce, encrypt)
             logger.debug("开始验证POPO签名")
-            aes_cipher = AESCipher(plugin_settings.aes_key)
+            aes_cipher = endpoint_config.aes_cipher
             ## 校验POPO签名   https://open.popo.netease.com/docs/robot/start/application-robot
-            verify_result = aes_cipher.popo_check_signature(plugin_settings.token, timestamp, nonce, signature)
+            with metrics.span("signature_check", *metric_labels):
+                verify_result = endpoint_config.signature_verifier.verify(timestamp, nonce, signature)
             if not verify_result:
                 raise ValueError("校验签名验证失败")
-            logger.debug(f"请求方法: {r.method}")
+            logger.debug("请求方法: %s", r.method)
             # 处理来自POPO的不同类型请求，GET是保存回调配置时的校验，POST是消息订阅
             if r.method == "GET":
                 logger.debug("收到GET请求")
@@ -88,19 +111,33 @@ class PopoBotToolEndpoint(Endpoint):
                 return response
             elif r.method == "POST":
                 logger.debug("收到POST请求")
-                logger.debug(f"请求参数：{r.args}, 请求体：{r.data}")
+                debug_payload(logger, "请求参数：%s, 请求体：%s", r.args, lazy(r.get_data))
                 popo_message_encrypt = r.get_json().get("encrypt")
                 if not popo_message_encrypt or popo_message_encrypt == "":
                     raise ValueError("POST响应中的数据未能成功解析到encrypt")
                 try:
-                    callback_message = json.loads(aes_cipher.aes_cbc_decrypt(popo_message_encrypt))
-                    logger.debug(f"解密内容：{callback_message}")
+                    with metrics.span("decrypt", *metric_labels):
+                        callback_message = aes_cipher.aes_cbc_decrypt_json(popo_message_encrypt)
+                    debug_payload(logger, "解密内容：%s", callback_message)
                 except Exception as e:
-                    logging.error(f"解密失败: {str(e)}", exc_info=True)
+                    # 堆栈由外层统一记录
+                    logger.error("解密失败: %s", e)
                     raise
 
-                robot_event = dict_to_robot_event(callback_message)
-                popo_bot = PopoBot(plugin_settings.popo_app_key, plugin_settings.popo_app_secret)
+                with metrics.span("event_parse", *metric_labels):
+                    robot_event = dict_to_robot_event(callback_message)
+                metrics.increment("callback_" + robot_event.event_type.value, *metric_labels)
+                popo_bot = endpoint_config.popo_bot
+
+                # POPO未及时收到响应时会重发回调，同一条消息只处理一次
+                if plugin_settings.callback_dedup_backend == MemoryBackendType.STORAGE:
+                    dedup_storage = self.session.storage
+                dedup_key = get_dedup_key(robot_event, plugin_settings.popo_app_key)
+                if get_callback_deduplicator().is_duplicate(dedup_key, dedup_storage, plugin_settings.popo_app_key):
+                    log_sampled(logger, logging.INFO, ("duplicate_callback", plugin_settings.popo_app_key),
+                                "收到重复的回调，直接响应: %s", dedup_key)
+                    metrics.increment("duplicate_callback", *metric_labels)
+                    return Response(status=200)
 
                 if robot_event.event_type in (PopoEventType.IM_P2P_TO_ROBOT_MSG, PopoEventType.IM_CHAT_TO_ROBOT_AT_MSG):
                     # 私聊or群聊
@@ -120,31 +157,51 @@ class PopoBotToolEndpoint(Endpoint):
                                         any(notify_text.startswith(cmd) for cmd in clean_commands) or
                                         any(notify_text.endswith(cmd) for cmd in clean_commands))
                     if is_clean_command:
-                        popo_bot.send_message(message_recipient, "重置对话流记忆，已开启新会话")
-                        popo_bot_memory.clear_memory(robot_event, plugin_settings)
+                        get_send_queue().submit(popo_bot, message_recipient, "重置对话流记忆，已开启新会话")
+                        popo_bot_memory.clear_memory(robot_event, plugin_settings, self.session.storage)
                         return Response(status=200)
 
                     # 预回复消息
                     if plugin_settings.auto_reply_preset_message:
-                        popo_bot.send_message(message_recipient, plugin_settings.auto_reply_preset_message,robot_event.event_data.from_)
+                        get_send_queue().submit(popo_bot, message_recipient, plugin_settings.auto_reply_preset_message, robot_event.event_data.from_)
                     # 由于POPO方要求必须在三秒内响应，这里必须异步
                     logger.debug("开始异步调用智能体")
-
-                    # thread = threading.Thread(
-                    #     daemon=False,
-                    #     target=self.call_agent,
-                    #     kwargs={
-                    #         "plugin_settings": plugin_settings,
-                    #         "robot_event": robot_event,
-                    #         "message_recipient":message_recipient,
-                    #         "popo_bot":popo_bot
-                    #     }
-                    # )
-                    #thread.start()
-                    # 改成session提供的线程池执行
-                    self.session._executor.submit(self.call_agent,plugin_settings,robot_event,message_recipient,popo_bot)
-                    # 阻塞，防止session失效
-                    time.sleep(1)
+                    # 交给调度器执行智能体调用和回复，入队后只等到调度器开始反向调用智能体（防止session失效），不再固定休眠
+                    dispatcher = get_agent_dispatcher()
+                    try:
+                        job = dispatcher.submit(AgentDispatchJob(
+                            handler=self.call_agent,
+                            plugin_settings=plugin_settings,
+                            robot_event=robot_event,
+                            message_recipient=message_recipient,
+                            popo_bot=popo_bot,
+                            handoff_timeout=agent_handoff_timeout,
+                        ))
+                    except DispatchQueueFullError as e:
+                        # 队列已满时撤销去重标记并返回503，由POPO稍后重发这条消息，按配置回复繁忙提示
+                        log_sampled(logger, logging.WARNING, ("dispatch_rejected", plugin_settings.popo_app_key), "%s", e)
+                        metrics.increment("dispatch_rejected", *metric_labels)
+                        get_callback_deduplicator().forget(dedup_key, dedup_storage)
+                        dedup_key = None
+                        if plugin_settings.busy_reply_message:
+                            get_send_queue().submit(popo_bot, message_recipient, plugin_settings.busy_reply_message, robot_event.event_data.from_)
+                        return _json_response({"status": "error", "message": str(e)}, 503)
+                    # 合并进已有任务时，截止时间已顺延到本条消息
+                    start_deadline = job.start_deadline
+                    with metrics.span("handoff_wait", *metric_labels):
+                        job_started = job.wait_started(max(0.0, start_deadline - time.monotonic()))
+                        if not job_started and dispatcher.start_overdue(job):
+                            # 并发上限内未能开始的任务已超出上限开始执行，等它送出反向调用后再返回
+                            job_started = job.wait_started(agent_handoff_timeout)
+                    if not job_started:
+                        logger.debug("调度器未在等待时间内开始调用智能体，端点先行返回")
+                    if plugin_settings.memory_backend == MemoryBackendType.STORAGE:
+                        # 返回前session仍有效，顺带清理本机器人过期的持久化记忆
+                        popo_bot_memory.sweep_storage_memory(plugin_settings.popo_app_key, self.session.storage)
+                elif robot_event.event_type in (PopoEventType.IM_P2P_USER_RECALL_MSG, PopoEventType.IM_CHAT_USER_RECALL_AT_MSG):
+                    # 用户撤回消息：排队中的智能体调用直接丢弃，执行中的不再回复
+                    recall_result = get_agent_dispatcher().recall(plugin_settings.popo_app_key, robot_event.event_data.uuid)
+                    logger.debug("撤回消息 %s：%s", robot_event.event_data.uuid, recall_result)
                 return Response(
                     status=200,
                 )
@@ -155,20 +212,76 @@ class PopoBotToolEndpoint(Endpoint):
                     content_type="application/json; charset=utf-8"
                 )
         except Exception as e:
-            logging.error(f"invoke执行异常: {str(e)}", exc_info=True)
+            # 堆栈只格式化一次，日志和响应共用
+            detailed_error = traceback.format_exc()
+            logger.error("invoke执行异常: %s\n%s", e, detailed_error)
+            get_metrics().increment("callback_error", settings.get("popo_app_key"))
+            if dedup_key:
+                get_callback_deduplicator().forget(dedup_key, dedup_storage)
             # popo_bot.send_message(robot_event.event_data.from_,traceback.format_exc())
             return Response(
-                json.dumps({"status": "error", "message": "处理请求失败", "error": str(e),"detailed_error":{traceback.format_exc()}}, ensure_ascii=False),
+                json.dumps({"status": "error", "message": "处理请求失败", "error": str(e),"detailed_error": detailed_error}, ensure_ascii=False),
                 status=500,
                 content_type="application/json; charset=utf-8"
             )
+    def _handle_memory_admin(self, r: Request, plugin_settings: PopoBotEndpointSettings) -> Response:
+        """
+        记忆管理，只作用于本端点的机器人，请求头X-Popo-Admin-Token需与端点配置的token一致
+        记忆后端为storage时同时作用于持久化存储中本机器人key列表里的记忆
+
+        - GET  ?memory_action=list：本机器人的记忆key
+        - POST ?memory_action=clear：清除本机器人的全部记忆
+        - POST ?memory_action=clear_agent：清除本机器人中本端点智能体的记忆（不影响接入同一智能体的其他机器人）
+        - POST ?memory_action=clear_idle&idle_seconds=N：清除本机器人超过N秒没有新消息的记忆
+        """
+        from MyUtil import popo_bot_memory
+        admin_token = r.headers.get("X-Popo-Admin-Token") or ""
+        if not plugin_settings.token or not hmac.compare_digest(admin_token.encode(), plugin_settings.token.encode()):
+            return _json_response({"status": "error", "message": "token错误"}, 403)
+        storage = self.session.storage if plugin_settings.memory_backend == MemoryBackendType.STORAGE else None
+        app_key = plugin_settings.popo_app_key
+        action = r.args.get("memory_action")
+        if action == "list":
+            keys = popo_bot_memory.list_memory_keys(popo_app_key=app_key, storage=storage)
+            return _json_response({"status": "success", "count": len(keys), "keys": keys})
+        if r.method != "POST":
+            return _json_response({"status": "error", "message": "清除记忆需要使用POST请求"}, 405)
+        if action == "clear":
+            cleared = popo_bot_memory.clear_memory_by_app_key(app_key, storage)
+        elif action == "clear_agent":
+            cleared = popo_bot_memory.clear_memory_by_agent(plugin_settings.agent_app_id, app_key, storage)
+        elif action == "clear_idle":
+            try:
+                idle_seconds = float(r.args.get("idle_seconds", ""))
+            except ValueError:
+                return _json_response({"status": "error", "message": "idle_seconds必须是数字"}, 400)
+            cleared = popo_bot_memory.clear_idle_memory(idle_seconds, storage, app_key)
+        else:
+            return _json_response({"status": "error", "message": f"不支持的操作：{action}"}, 400)
+        logger.info("记忆管理：%s，清除%d条，appKey = %s", action, cleared, app_key)
+        return _json_response({"status": "success", "cleared": cleared})
+
     # 反向调用智能体
-    def call_agent(self, plugin_settings: PopoBotEndpointSettings, robot_event: RobotEvent,message_recipient: str,popo_bot: PopoBot):
+    def call_agent(self, job: "AgentDispatchJob"):
+        from MyUtil import popo_bot_memory
         logger.debug("异步调用智能体开始执行")
+        plugin_settings: PopoBotEndpointSettings = job.plugin_settings
+        robot_event: RobotEvent = job.robot_event
+        message_recipient: str = job.message_recipient
+        popo_bot: PopoBot = job.popo_bot
+        metrics = get_metrics()
+        metric_labels = (plugin_settings.popo_app_key, plugin_settings.agent_type.value)
+        # 在调度队列中等待的时间（含合并窗口、并发上限导致的排队）
+        metrics.observe("dispatch_wait", job.wait_time, *metric_labels)
+        if job.is_cancelled:
+            logger.debug("消息已撤回，跳过智能体调用")
+            return
         try:
-            logger.debug(f"调用智能体参数 - app_id: {plugin_settings.agent_app_id}")
+            logger.debug("调用智能体参数 - app_id: %s", plugin_settings.agent_app_id)
+            # 合并了多条消息时为按顺序拼接后的内容
+            query = job.query
             inputs_param = {
-                "popo_input_message": robot_event.event_data.notify,
+                "popo_input_message": query,
                 "popo_user": robot_event.event_data.from_,
                 "popo_event_type": robot_event.event_type.value,
                 "popo_to": robot_event.event_data.to,
@@ -176,34 +289,45 @@ class PopoBotToolEndpoint(Endpoint):
                 "popo_raw_json": robot_event.raw_json,
             }
             if plugin_settings.agent_type == AgentType.WORKFLOW:
-                inputs_param[plugin_settings.workflow_input_field] = robot_event.event_data.notify
+                inputs_param[plugin_settings.workflow_input_field] = query
 
-            logger.debug(f"应用类型：{plugin_settings.agent_type}")
+            logger.debug("应用类型：%s", plugin_settings.agent_type)
+            if plugin_settings.response_mode == ResponseMode.STREAMING:
+                with metrics.span("agent_invoke_streaming", *metric_labels):
+                    self.call_agent_streaming(job, query, inputs_param)
+                logger.debug("流式回复结束，回复对象：%s", message_recipient)
+                return
             if plugin_settings.agent_type in (AgentType.CHAT, AgentType.CHATFLOW):
                 logger.debug("准备调用 chat.invoke")
-                memory = popo_bot_memory.get_popobot_memory(robot_event, plugin_settings)
-                logger.debug("没有找到记忆" if memory is None else "记忆："+str(memory.to_dict()))
-                response = self.session.app.chat.invoke(
-                    app_id=plugin_settings.agent_app_id,
-                    inputs=inputs_param,
-                    query=robot_event.event_data.notify,
-                    response_mode="blocking",
-                    conversation_id= "" if memory is None else memory.conversation_id
-                )
-                logger.debug("调用 chat.invoke 完成")
-                popo_bot_memory.set_popobot_memory(robot_event,plugin_settings,response["conversation_id"])
-                if not response:
-                    raise ValueError("来自chat.invoke的空响应")
-                else:
-                    logger.debug(response)
-                    agent_output = response["answer"]
+                # 同一会话并发的调用只有一个会创建新会话，其余等待并复用它的conversation_id
+                with popo_bot_memory.reserve_popobot_memory(robot_event, plugin_settings, self.session.storage) as reservation:
+                    memory = reservation.memory
+                    logger.debug("记忆：%s", lazy(memory.to_dict) if memory is not None else "没有找到")
+                    with metrics.span("agent_invoke", *metric_labels), _mark_started_on_send(self.session, job):
+                        response = self.session.app.chat.invoke(
+                            app_id=plugin_settings.agent_app_id,
+                            inputs=inputs_param,
+                            query=query,
+                            response_mode="blocking",
+                            conversation_id=reservation.conversation_id
+                        )
+                    # serverless安装时无法在请求写出时标记，阻塞调用返回时反向调用必然已送达
+                    job.mark_started()
+                    logger.debug("调用 chat.invoke 完成")
+                    if not response:
+                        raise ValueError("来自chat.invoke的空响应")
+                    reservation.commit(response["conversation_id"])
+                debug_payload(logger, "智能体响应：%s", response)
+                agent_output = response["answer"]
 
             elif plugin_settings.agent_type == AgentType.WORKFLOW:
-                response = self.session.app.workflow.invoke(
-                    app_id=plugin_settings.agent_app_id,
-                    inputs=inputs_param,
-                    response_mode="blocking",
-                )
+                with metrics.span("agent_invoke", *metric_labels), _mark_started_on_send(self.session, job):
+                    response = self.session.app.workflow.invoke(
+                        app_id=plugin_settings.agent_app_id,
+                        inputs=inputs_param,
+                        response_mode="blocking",
+                    )
+                job.mark_started()
                 if not response:
                     raise ValueError("来自chat.invoke的空响应")
 
@@ -211,11 +335,144 @@ class PopoBotToolEndpoint(Endpoint):
                     raise ValueError("工作流未正常执行")
                 else:
                     agent_output = response["data"]["outputs"][plugin_settings.workflow_output_field]
-            popo_bot.send_message(message_recipient,agent_output, robot_event.event_data.from_)
-            logger.debug(f"回复结束，回复对象：{message_recipient}")
+            if job.is_cancelled:
+                logger.debug("消息已在智能体执行期间撤回，不再回复")
+                return
+            # 交给发送队列后直接返回，不阻塞在POPO接口上
+            get_send_queue().submit(popo_bot, message_recipient, agent_output, robot_event.event_data.from_)
+            logger.debug("回复结束，回复对象：%s", message_recipient)
 
         except Exception as e:
+            metrics.increment("agent_error", *metric_labels)
             error_msg = f"调用智能体失败:\n{str(e)}\n详细错误信息:\n{traceback.format_exc()}"
-            logging.error(error_msg, exc_info=True)
-            popo_bot.send_message(robot_event.event_data.from_, error_msg)
-            raise
\ No newline at end of file
+            # error_msg里已经包含堆栈，不再重复格式化
+            logger.error(error_msg)
+            get_send_queue().submit(popo_bot, robot_event.event_data.from_, error_msg)
+            raise
+
+    # 流式调用智能体，边生成边分段回复
+    def call_agent_streaming(self, job: "AgentDispatchJob", query: str, inputs_param: dict):
+        from MyUtil import popo_bot_memory
+        from MyUtil.popo_stream_reply import PopoStreamReplyBuffer
+        plugin_settings: PopoBotEndpointSettings = job.plugin_settings
+        robot_event: RobotEvent = job.robot_event
+        popo_bot: PopoBot = job.popo_bot
+        at = robot_event.event_data.from_
+
+        def send_part(part: str) -> None:
+            nonlocal at
+            # 只在第一段消息里@提问人
+            # 同一接收人的消息由发送队列按顺序发送
+            get_send_queue().submit(popo_bot, job.message_recipient, part, at)
+            at = None
+
+        reply_buffer = PopoStreamReplyBuffer(send_part, flush_interval=plugin_settings.stream_flush_interval)
+        conversation_id = None
+        if plugin_settings.agent_type in (AgentType.CHAT, AgentType.CHATFLOW):
+            with popo_bot_memory.reserve_popobot_memory(robot_event, plugin_settings, self.session.storage) as reservation, \
+                    _mark_started_on_send(self.session, job):
+                memory = reservation.memory
+                logger.debug("记忆：%s", lazy(memory.to_dict) if memory is not None else "没有找到")
+                stream = self.session.app.chat.invoke(
+                    app_id=plugin_settings.agent_app_id,
+                    inputs=inputs_param,
+                    query=query,
+                    response_mode="streaming",
+                    conversation_id=reservation.conversation_id
+                )
+                for chunk in stream:
+                    # 收到第一个事件说明反向调用已被受理，端点可以返回（serverless安装时在这里标记）
+                    job.mark_started()
+                    event = chunk.get("event")
+                    conversation_id = chunk.get("conversation_id") or conversation_id
+                    if conversation_id and reservation.is_owner:
+                        # 新会话一创建就保存，让等待中的调用尽早复用
+                        reservation.commit(conversation_id)
+                    if job.is_cancelled:
+                        # 消息已撤回，停止接收并关闭流，不再回复剩余内容
+                        break
+                    if event in ("message", "agent_message"):
+                        reply_buffer.feed(chunk.get("answer", ""))
+                    elif event == "error":
+                        raise ValueError(f"智能体执行出错：{chunk.get('message')}")
+                if conversation_id:
+                    reservation.commit(conversation_id)
+            if job.is_cancelled:
+                logger.debug("消息已在智能体执行期间撤回，不再回复")
+                return
+            reply_buffer.finish()
+
+        elif plugin_settings.agent_type == AgentType.WORKFLOW:
+            finished = None
+            with _mark_started_on_send(self.session, job):
+                stream = self.session.app.workflow.invoke(
+                    app_id=plugin_settings.agent_app_id,
+                    inputs=inputs_param,
+                    response_mode="streaming",
+                )
+                for chunk in stream:
+                    job.mark_started()
+                    if job.is_cancelled:
+                        logger.debug("消息已在工作流执行期间撤回，不再回复")
+                        return
+                    event = chunk.get("event")
+                    if event == "text_chunk":
+                        reply_buffer.feed(chunk.get("data", {}).get("text", ""))
+                    elif event == "workflow_finished":
+                        finished = chunk.get("data", {})
+                    elif event == "error":
+                        raise ValueError(f"工作流执行出错：{chunk.get('message')}")
+            if not finished or finished.get("status") != "succeeded":
+                raise ValueError("工作流未正常执行")
+            if reply_buffer.flush_count or reply_buffer.text:
+                reply_buffer.finish()
+            else:
+                # 输出节点没有流式输出时，直接发送最终结果
+                send_part(finished["outputs"][plugin_settings.workflow_output_field])
+
+
+# 当前线程正在反向调用智能体的任务
+_handoff_local = threading.local()
+
+
+class _HandoffSignalWriter:
+    """
+    转发到session原来的writer，反向调用请求写出后标记当前线程的任务已开始
+
+    全双工（本地调试、远程安装）时session_message直接把请求写到与daemon的连接上，写完即已送达，端点此时返回不影响这次调用；
+    serverless安装时请求在session_message_text之后才由httpx发出，不在这里标记
+    """
+
+    def __init__(self, writer):
+        self._writer = writer
+
+    def session_message(self, *args, **kwargs):
+        result = self._writer.session_message(*args, **kwargs)
+        job = getattr(_handoff_local, "job", None)
+        if job is not None:
+            job.mark_started()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._writer, name)
+
+
+@contextmanager
+def _mark_started_on_send(session, job: "AgentDispatchJob"):
+    """反向调用期间，请求一写出就让等待中的端点返回，不必等到智能体执行完"""
+    # 只包装一次、不再还原，同一个session被多个线程使用时也不会互相覆盖
+    if not isinstance(session.writer, _HandoffSignalWriter):
+        session.writer = _HandoffSignalWriter(session.writer)
+    _handoff_local.job = job
+    try:
+        yield
+    finally:
+        _handoff_local.job = None
+
+
+def _json_response(result: dict, status: int = 200) -> Response:
+    return Response(
+        json.dumps(result, ensure_ascii=False),
+        status=status,
+        content_type="application/json; charset=utf-8"
+    )
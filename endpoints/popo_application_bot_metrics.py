@@ -0,0 +1,26 @@
+import json
+from typing import Mapping
+
+from werkzeug import Request, Response
+from dify_plugin import Endpoint
+
+from MyUtil.popo_metrics import get_metrics
+from MyUtil.popo_send_queue import get_send_queue
+
+
+# 只读的统计端点，只返回当前端点配置对应机器人的数据
+class PopoBotMetricsEndpoint(Endpoint):
+    def _invoke(self, r: Request, values: Mapping, settings: Mapping) -> Response:
+        # 与回调端点一样，第一次请求时才加载
+        from MyUtil.popo_agent_dispatcher import get_agent_dispatcher
+        from MyUtil.popo_endpoint_config_cache import get_endpoint_config
+        plugin_settings = get_endpoint_config(settings).plugin_settings
+        result = get_metrics().snapshot(plugin_settings.popo_app_key)
+        # 调度队列和发送队列是进程内所有机器人共享的，只返回本机器人的部分
+        result["dispatcher"] = get_agent_dispatcher().get_app_key_stats(plugin_settings.popo_app_key)
+        result["send_queue"] = get_send_queue().get_app_key_stats(plugin_settings.popo_app_key)
+        return Response(
+            json.dumps(result, ensure_ascii=False),
+            status=200,
+            content_type="application/json; charset=utf-8"
+        )
@@ -1,26 +1,11 @@
 import json
-import logging
-import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 from typing import List, Optional, Dict
 
-from dify_plugin.config.logger_format import plugin_logger_handler
-
-logger = logging.getLogger(__name__)
-if sys.platform in ('win32', 'cygwin', 'darwin'):
-    # 清空已有的handlers避免重复
-    logger.handlers.clear()
-    logger.setLevel(logging.DEBUG)
-    # 为开发环境创建专门的handler
-    dev_handler = logging.StreamHandler()
-    dev_formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-    dev_handler.setFormatter(dev_formatter)
-    logger.addHandler(dev_handler)
-    logger.propagate = False  # 防止日志向父级传播
-else:
-    logger.setLevel(logging.INFO)
-    logger.addHandler(plugin_logger_handler)
+from MyUtil.popo_logging import get_logger
+
+logger = get_logger(__name__)
 
 # ------------------------------
 # 事件类型枚举
@@ -35,16 +20,16 @@ class PopoEventType(Enum):
     @classmethod
     def from_str(cls, event_type_str: str) -> "PopoEventType":
         """将接口返回的字符串转换为枚举成员（不存在则报错）"""
-        for member in cls:
-            if member.name == event_type_str:
-                return member
-        raise ValueError(f"不支持的事件类型: {event_type_str}")
+        member = cls.__members__.get(event_type_str)
+        if member is None:
+            raise ValueError(f"不支持的事件类型: {event_type_str}")
+        return member
 
 
 # ------------------------------
 # 通用子结构（无初始值，必须传入所有字段）
 # ------------------------------
-@dataclass
+@dataclass(slots=True)
 class QuoteInfo:
     """引用消息的详细信息（仅msgType=211时存在）"""
     file_name: Optional[str]  # 可选字段（可能为None）
@@ -57,7 +42,7 @@ class QuoteInfo:
     notify: str  # 必选字段
 
 
-@dataclass
+@dataclass(slots=True)
 class FileInfo:
     """文件消息的详细信息（仅msgType=171时存在）"""
     size: int  # 必选（文件大小，字节）
@@ -66,7 +51,7 @@ class FileInfo:
     md5: str  # 必选（文件MD5）
 
 
-@dataclass
+@dataclass(slots=True)
 class VideoInfo:
     """视频消息的详细信息（仅msgType=142时存在）"""
     cover_url: str  # 必选（封面URL）
@@ -79,7 +64,7 @@ class VideoInfo:
     md5: str  # 必选（MD5）
 
 
-@dataclass
+@dataclass(slots=True)
 class MergeListItem:
     """合并消息中的单条消息（仅msgType=161时存在）"""
     msg_type: int  # 必选（消息类型）
@@ -92,12 +77,79 @@ class MergeListItem:
     notify: str  # 必选（消息内容）
 
 
+# 嵌套结构尚未解析
+_unparsed = object()
+
+
+def _parse_quote_info(q: Optional[Dict]) -> Optional[QuoteInfo]:
+    if q is None:
+        return None
+    return QuoteInfo(
+        file_name=q.get("fileName"),
+        file_id=q.get("fileId"),
+        from_user_name=q["fromUserName"],
+        reply_text=q["replyText"],
+        addtime=q["addtime"],
+        from_=q["from"],
+        uuid=q["uuid"],
+        notify=q["notify"]
+    )
+
+
+def _parse_file_info(f: Optional[Dict]) -> Optional[FileInfo]:
+    if f is None:
+        return None
+    return FileInfo(
+        size=f["size"],
+        name=f["name"],
+        file_id=f["fileId"],
+        md5=f["md5"]
+    )
+
+
+def _parse_video_info(v: Optional[Dict]) -> Optional[VideoInfo]:
+    if v is None:
+        return None
+    return VideoInfo(
+        cover_url=v["coverUrl"],
+        file_name=v["fileName"],
+        size=v["size"],
+        format=v["format"],
+        width=v["width"],
+        url=v["url"],
+        height=v["height"],
+        md5=v["md5"]
+    )
+
+
+def _parse_merge_list(items: Optional[List[Dict]]) -> Optional[List[MergeListItem]]:
+    if items is None:
+        return None
+    return [
+        MergeListItem(
+            msg_type=item["msgType"],
+            addtime=item["addtime"],
+            session_type=item["sessionType"],
+            from_=item["from"],
+            to=item["to"],
+            session_id=item["sessionId"],
+            uuid=item["uuid"],
+            notify=item["notify"]
+        )
+        for item in items
+    ]
+
+
 # ------------------------------
 # 不同事件类型对应的数据结构（无初始值）
 # ------------------------------
-@dataclass
+@dataclass(slots=True)
 class P2PMessageData:
-    """用户发送给机器人的单聊消息数据（IM_P2P_TO_ROBOT_MSG）"""
+    """
+    用户发送给机器人的单聊消息数据（IM_P2P_TO_ROBOT_MSG）
+
+    引用、文件、视频、合并消息等嵌套结构在第一次访问时才从原始数据解析，缺失必填字段时在访问时报错
+    """
     msg_type: int  # 必选（消息类型：1=文本，211=引用，等）
     addtime: str  # 必选（发送时间）
     session_type: int  # 必选（会话类型：1=单聊）
@@ -107,15 +159,41 @@ class P2PMessageData:
     session_id: str  # 必选（会话ID）
     uuid: str  # 必选（消息唯一标识）
     notify: str  # 必选（消息内容/提示）
-    # 以下为可选嵌套结构（根据msg_type决定是否存在）
-    quote_info: Optional[QuoteInfo]
-    file_info: Optional[FileInfo]
-    video_info: Optional[VideoInfo]
-    merge_list: Optional[List[MergeListItem]]
     merge_title: Optional[str]
-
-
-@dataclass
+    # 原始eventData，用于按需解析嵌套结构
+    _event_data: dict = field(repr=False, compare=False)
+    # 以下为已解析的可选嵌套结构（根据msg_type决定是否存在）
+    _quote_info: Optional[QuoteInfo] = field(init=False, default=_unparsed, repr=False, compare=False)
+    _file_info: Optional[FileInfo] = field(init=False, default=_unparsed, repr=False, compare=False)
+    _video_info: Optional[VideoInfo] = field(init=False, default=_unparsed, repr=False, compare=False)
+    _merge_list: Optional[List[MergeListItem]] = field(init=False, default=_unparsed, repr=False, compare=False)
+
+    @property
+    def quote_info(self) -> Optional[QuoteInfo]:
+        if self._quote_info is _unparsed:
+            self._quote_info = _parse_quote_info(self._event_data.get("quoteInfo"))
+        return self._quote_info
+
+    @property
+    def file_info(self) -> Optional[FileInfo]:
+        if self._file_info is _unparsed:
+            self._file_info = _parse_file_info(self._event_data.get("fileInfo"))
+        return self._file_info
+
+    @property
+    def video_info(self) -> Optional[VideoInfo]:
+        if self._video_info is _unparsed:
+            self._video_info = _parse_video_info(self._event_data.get("videoInfo"))
+        return self._video_info
+
+    @property
+    def merge_list(self) -> Optional[List[MergeListItem]]:
+        if self._merge_list is _unparsed:
+            self._merge_list = _parse_merge_list(self._event_data.get("mergeList"))
+        return self._merge_list
+
+
+@dataclass(slots=True)
 class P2PRecallData:
     """用户撤回单聊消息的数据（IM_P2P_USER_RECALL_MSG）"""
     recall_time: str  # 必选（撤回时间）
@@ -124,7 +202,7 @@ class P2PRecallData:
     uuid: str  # 必选（被撤回消息的唯一标识）
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupRecallAtData:
     """群组用户撤回@机器人消息的数据（IM_CHAT_USER_RECALL_AT_MSG）"""
     uuid: str  # 必选（被撤回消息的唯一标识）
@@ -133,7 +211,7 @@ class GroupRecallAtData:
     to: str  # 必选（群组ID）
 
 
-@dataclass
+@dataclass(slots=True)
 class GroupAtData:
     """群组用户@机器人的消息数据（IM_CHAT_TO_ROBOT_AT_MSG）"""
     msg_type: int  # 必选（消息类型）
@@ -151,12 +229,26 @@ class GroupAtData:
 # ------------------------------
 # 统一事件结构
 # ------------------------------
-@dataclass
+@dataclass(slots=True)
 class RobotEvent:
     """机器人接收的所有事件的统一结构"""
     event_type: PopoEventType  # 必选（事件类型枚举）
     event_data: P2PMessageData | P2PRecallData | GroupRecallAtData | GroupAtData  # 必选（对应事件的数据）
-    raw_json: str # 原始JSON数据
+    raw_data: Dict = field(repr=False, compare=False)  # 原始数据
+    _raw_json: Optional[str] = field(init=False, default=None, repr=False, compare=False)
+
+    @property
+    def raw_json(self) -> str:
+        """原始JSON数据（紧凑格式），第一次访问时才序列化"""
+        if self._raw_json is None:
+            self._raw_json = self.to_json()
+        return self._raw_json
+
+    def to_json(self, indent: int = None) -> str:
+        """序列化原始数据，指定indent时输出带缩进的格式"""
+        if indent is None:
+            return json.dumps(self.raw_data, ensure_ascii=False, separators=(",", ":"))
+        return json.dumps(self.raw_data, ensure_ascii=False, indent=indent)
 
 
 # ------------------------------
@@ -166,68 +258,15 @@ def dict_to_robot_event(data: Dict) -> RobotEvent:
     """
     将接口返回的字典转换为RobotEvent对象（无默认值，缺失字段直接报错）
 
-    注意：若接口数据缺失任何必填字段，会直接抛出KeyError或TypeError
+    注意：若接口数据缺失任何必填字段，会直接抛出KeyError或TypeError；
+    单聊消息的嵌套结构（引用、文件、视频、合并消息）缺失必填字段时，在第一次访问该属性时抛出
     """
 
     event_type = PopoEventType.from_str(data["eventType"])
     event_data_dict = data["eventData"]
 
     if event_type == PopoEventType.IM_P2P_TO_ROBOT_MSG:
-        # 解析单聊消息（严格校验所有必选字段）
-        quote_info = None
-        if "quoteInfo" in event_data_dict:
-            q = event_data_dict["quoteInfo"]
-            quote_info = QuoteInfo(
-                file_name=q.get("fileName"),
-                file_id=q.get("fileId"),
-                from_user_name=q["fromUserName"],
-                reply_text=q["replyText"],
-                addtime=q["addtime"],
-                from_=q["from"],
-                uuid=q["uuid"],
-                notify=q["notify"]
-            )
-
-        file_info = None
-        if "fileInfo" in event_data_dict:
-            f = event_data_dict["fileInfo"]
-            file_info = FileInfo(
-                size=f["size"],
-                name=f["name"],
-                file_id=f["fileId"],
-                md5=f["md5"]
-            )
-
-        video_info = None
-        if "videoInfo" in event_data_dict:
-            v = event_data_dict["videoInfo"]
-            video_info = VideoInfo(
-                cover_url=v["coverUrl"],
-                file_name=v["fileName"],
-                size=v["size"],
-                format=v["format"],
-                width=v["width"],
-                url=v["url"],
-                height=v["height"],
-                md5=v["md5"]
-            )
-
-        merge_list = None
-        if "mergeList" in event_data_dict:
-            merge_list = [
-                MergeListItem(
-                    msg_type=item["msgType"],
-                    addtime=item["addtime"],
-                    session_type=item["sessionType"],
-                    from_=item["from"],
-                    to=item["to"],
-                    session_id=item["sessionId"],
-                    uuid=item["uuid"],
-                    notify=item["notify"]
-                )
-                for item in event_data_dict["mergeList"]
-            ]
-
+        # 解析单聊消息（严格校验所有必选字段，嵌套结构在访问时解析）
         event_data = P2PMessageData(
             msg_type=event_data_dict["msgType"],
             addtime=event_data_dict["addtime"],
@@ -238,11 +277,8 @@ def dict_to_robot_event(data: Dict) -> RobotEvent:
             session_id=event_data_dict["sessionId"],
             uuid=event_data_dict["uuid"],
             notify=event_data_dict["notify"],
-            quote_info=quote_info,
-            file_info=file_info,
-            video_info=video_info,
-            merge_list=merge_list,
-            merge_title=event_data_dict.get("mergeTitle")
+            merge_title=event_data_dict.get("mergeTitle"),
+            _event_data=event_data_dict
         )
 
     elif event_type == PopoEventType.IM_P2P_USER_RECALL_MSG:
@@ -278,6 +314,6 @@ def dict_to_robot_event(data: Dict) -> RobotEvent:
     else:
         raise ValueError(f"未处理的事件类型: {event_type}")
 
-    return RobotEvent(event_type=event_type, event_data=event_data,raw_json=json.dumps(data, ensure_ascii=False, indent=2))
+    return RobotEvent(event_type=event_type, event_data=event_data, raw_data=data)
 
 
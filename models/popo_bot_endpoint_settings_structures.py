@@ -9,11 +9,39 @@ class AgentType(Enum):
     CHATFLOW = "chatflow"
     WORKFLOW = "workflow"
 
+class ResponseMode(Enum):
+    BLOCKING = "blocking"
+    STREAMING = "streaming"
+
+class MemoryBackendType(Enum):
+    MEMORY = "memory"
+    STORAGE = "storage"
+
 class GroupMessageReplyMethod(Enum):
     GROUP_CHAT = "group_chat"
     PRIVATE_CHAT = "private_chat"
 
 
+def parse_positive_int(value: Any) -> Optional[int]:
+    """解析text-input填写的正整数，空值返回None"""
+    if value is None or str(value).strip() == "":
+        return None
+    number = int(str(value).strip())
+    if number <= 0:
+        raise ValueError(f"配置项必须是正整数：{value}")
+    return number
+
+
+def parse_positive_float(value: Any) -> Optional[float]:
+    """解析text-input填写的正数，空值返回None"""
+    if value is None or str(value).strip() == "":
+        return None
+    number = float(str(value).strip())
+    if number <= 0:
+        raise ValueError(f"配置项必须是正数：{value}")
+    return number
+
+
 class PopoBotEndpointSettings:
     def __init__(self, settings: Mapping):
         # 机器人token
@@ -41,10 +69,29 @@ class PopoBotEndpointSettings:
         self.group_message_reply_method: GroupMessageReplyMethod = GroupMessageReplyMethod("group_chat")#GroupMessageReplyMethod(settings.get("group_message_reply_method") or "group_chat")
         # 是否为对话流应用启用记忆功能
         self.enable_memory: bool = settings.get("enable_memory", True)
+        # 会话记忆的存储位置，进程内或插件持久化存储
+        self.memory_backend: MemoryBackendType = MemoryBackendType(settings.get("memory_backend") or "memory")
+        # 回调去重记录的存储位置，与会话记忆的存储位置相互独立；持久化存储可以跨插件重启和多个插件进程识别重发
+        self.callback_dedup_backend: MemoryBackendType = MemoryBackendType(
+            settings.get("callback_dedup_backend") or "memory")
         # 工作流类型应用的输入字段
         self.workflow_input_field: str = "popo_input_message"#settings.get("workflow_input_field", "popo_input_message")
         # 工作流类型应用的输出字段
         self.workflow_output_field: str = "popo_output_message"#settings.get("workflow_output_field", "popo_output_message")
+        # 调度队列已满时回复的消息（不填则不回复）
+        self.busy_reply_message: Optional[str] = settings.get("busy_reply_message")
+        # 单个popo机器人同时执行的智能体调用数上限（不填则使用默认值）
+        self.max_concurrency_per_app_key: Optional[int] = parse_positive_int(settings.get("max_concurrency_per_app_key"))
+        # 单个智能体同时执行的调用数上限（不填则使用默认值）
+        self.max_concurrency_per_agent: Optional[int] = parse_positive_int(settings.get("max_concurrency_per_agent"))
+        # 同一会话连续消息的合并窗口，毫秒（不填则不合并）
+        self.message_merge_window_ms: Optional[int] = parse_positive_int(settings.get("message_merge_window_ms"))
+        # 智能体的响应模式，流式时边生成边分段回复
+        self.response_mode: ResponseMode = ResponseMode(settings.get("response_mode") or "blocking")
+        # 流式回复时两次发送的最小间隔，秒
+        self.stream_flush_interval: float = parse_positive_float(settings.get("stream_flush_interval")) or 1.5
+        # 是否统计回调处理各环节的耗时，通过统计端点查看
+        self.enable_metrics: bool = settings.get("enable_metrics", False)
         # 日志上报地址（可忽略，线上插件的运行日志将post到该地址）
         # self.log_reporting_address = settings.get("logReportingAddress") or "https://log-jystudy.app.codewave.163.com/rest/addLog"
         # 主线程休眠时间（可忽略，调试用）
@@ -68,8 +115,17 @@ class PopoBotEndpointSettings:
             "auto_reply_preset_message": self.auto_reply_preset_message,
             "group_message_reply_method": self.group_message_reply_method.value,
             "enable_memory": self.enable_memory,
+            "memory_backend": self.memory_backend.value,
+            "callback_dedup_backend": self.callback_dedup_backend.value,
             "workflow_input_field": self.workflow_input_field,
-            "workflow_output_field": self.workflow_output_field
+            "workflow_output_field": self.workflow_output_field,
+            "busy_reply_message": self.busy_reply_message,
+            "max_concurrency_per_app_key": self.max_concurrency_per_app_key,
+            "max_concurrency_per_agent": self.max_concurrency_per_agent,
+            "message_merge_window_ms": self.message_merge_window_ms,
+            "response_mode": self.response_mode.value,
+            "stream_flush_interval": self.stream_flush_interval,
+            "enable_metrics": self.enable_metrics
         }
 
     def get_desensitized_settings(self) -> dict:
@@ -98,8 +154,17 @@ class PopoBotEndpointSettings:
             "auto_reply_preset_message": self.auto_reply_preset_message,
             "group_message_reply_method": self.group_message_reply_method.value,
             "enable_memory": self.enable_memory,
+            "memory_backend": self.memory_backend.value,
+            "callback_dedup_backend": self.callback_dedup_backend.value,
             "workflow_input_field": self.workflow_input_field,
-            "workflow_output_field": self.workflow_output_field
+            "workflow_output_field": self.workflow_output_field,
+            "busy_reply_message": self.busy_reply_message,
+            "max_concurrency_per_app_key": self.max_concurrency_per_app_key,
+            "max_concurrency_per_agent": self.max_concurrency_per_agent,
+            "message_merge_window_ms": self.message_merge_window_ms,
+            "response_mode": self.response_mode.value,
+            "stream_flush_interval": self.stream_flush_interval,
+            "enable_metrics": self.enable_metrics
         }
 
     def __str__(self) -> str:
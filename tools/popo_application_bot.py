@@ -4,7 +4,11 @@ from typing import Any
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
 
-from MyUtil.popo_application_bot_util import PopoBot
+from MyUtil.popo_application_bot_util import PopoBot, split_receivers
+from MyUtil.popo_async_client import PopoFanOutResult, send_to_many_sync
+from MyUtil.popo_markdown_converter import plain_text_converters
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_send_queue import get_send_queue
 
 
 class SendPopoMessageTool(Tool):
@@ -12,12 +16,60 @@ class SendPopoMessageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
         app_key = tool_parameters.get("popo_app_key")
         app_secret = tool_parameters.get("popo_app_secret")
-        receiver = tool_parameters.get("receiver")
+        receivers = split_receivers(tool_parameters.get("receiver"))
         message = tool_parameters.get("message")
         at = tool_parameters.get("at")
         auto_convert_markdown_image_link = tool_parameters.get("auto_convert_markdown_image_link")
+        convert_markdown_to_text = tool_parameters.get("convert_markdown_to_text")
 
+        if not receivers:
+            raise ValueError("popo消息发送错误：未填写接收人")
+
+        # 消息只解析一次，所有接收人共用
+        converter = plain_text_converters[bool(auto_convert_markdown_image_link)] if convert_markdown_to_text else None
+        message = PopoMessage.parse(message or "", auto_convert_markdown_image_link, converter)
         popo_bot = PopoBot(app_key, app_secret)
-        popo_bot.send_message(receiver, message, at,auto_convert_markdown_image_link)
+        if len(receivers) == 1:
+            # 单个接收人经过发送队列限速，等待发送完成后再返回结果，失败时直接抛出异常
+            get_send_queue().submit(popo_bot, receivers[0], message, at).result()
+            results = [PopoFanOutResult(receivers[0])]
+        else:
+            results = self._send_to_many(popo_bot, receivers, message, at)
+
+        succeeded = sum(1 for result in results if result.ok)
+        summary = _format_summary(results, succeeded)
+        if not succeeded:
+            raise ValueError(f"popo消息发送错误：全部接收人发送失败。\n{summary}")
+        yield self.create_text_message(summary)
+        yield self.create_json_message({
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": [{"receiver": result.receiver, "success": result.ok,
+                         "error": None if result.ok else str(result.error)} for result in results],
+        })
+
+    @staticmethod
+    def _send_to_many(popo_bot: PopoBot, receivers: list, message: PopoMessage,
+                      at: str) -> "list[PopoFanOutResult]":
+        """先统一校验接收人，再把消息并发发给格式正确的接收人，结果按receivers的顺序返回"""
+        invalid = {}
+        valid = []
+        for receiver in receivers:
+            try:
+                popo_bot.validate_receiver(receiver)
+                valid.append(receiver)
+            except ValueError as e:
+                invalid[receiver] = PopoFanOutResult(receiver, e)
+
+        sent = {}
+        if valid:
+            for result in send_to_many_sync(popo_bot.appKey, popo_bot.app_secret, valid, message, at):
+                sent[result.receiver] = result
+        return [invalid[receiver] if receiver in invalid else sent[receiver] for receiver in receivers]
+
 
-        yield self.create_text_message("")
+def _format_summary(results: "list[PopoFanOutResult]", succeeded: int) -> str:
+    lines = [f"发送成功{succeeded}个，失败{len(results) - succeeded}个"]
+    lines.extend(f"{result.receiver}：{result.error}" for result in results if not result.ok)
+    return "\n".join(lines)
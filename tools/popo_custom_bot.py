@@ -1,72 +1,60 @@
-import base64
-import hashlib
-import hmac
-import json
-import re
-import time
-
 from collections.abc import Generator
-from typing import Any
+from typing import Any, Union
 from dify_plugin import Tool
 from dify_plugin.entities.tool import ToolInvokeMessage
-import requests
+
+from MyUtil.popo_markdown_converter import plain_text_converters
+from MyUtil.popo_message_builder import PopoMessage
+from MyUtil.popo_webhook_client import get_webhook_client, split_values
 
 
 class SendPopoMessageTool(Tool):
     def _invoke(self, tool_parameters: dict[str, Any]) -> Generator[ToolInvokeMessage]:
-        webhook_url = tool_parameters.get("webhook_url")
+        webhook_urls = split_values(tool_parameters.get("webhook_url"))
         message = tool_parameters.get("message")
-        secret = tool_parameters.get("secret")
+        secrets = split_values(tool_parameters.get("secret"))
         auto_convert_markdown_image_link = tool_parameters.get("auto_convert_markdown_image_link")
-        send_result = send_message(webhook_url, message, secret, auto_convert_markdown_image_link)
+        if tool_parameters.get("convert_markdown_to_text"):
+            # 链接等markdown转为纯文本，消息只解析一次，所有webhook共用
+            message = PopoMessage.parse(message or "", auto_convert_markdown_image_link,
+                                        plain_text_converters[bool(auto_convert_markdown_image_link)])
+
+        if len(webhook_urls) <= 1:
+            send_result = send_message(webhook_urls[0] if webhook_urls else "", message,
+                                       secrets[0] if secrets else None, auto_convert_markdown_image_link)
+            yield self.create_text_message(str(send_result))
+            return
 
-        yield self.create_text_message(str(send_result))
+        # 多个webhook并发发送，返回每个webhook的发送结果
+        results = get_webhook_client().send_to_many(webhook_urls, message, secrets, auto_convert_markdown_image_link)
+        succeeded = sum(1 for result in results if result.ok)
+        lines = [f"发送成功{succeeded}个，失败{len(results) - succeeded}个"]
+        lines.extend(f"{result.webhook_url}：{result.error}" for result in results if not result.ok)
+        summary = "\n".join(lines)
+        if not succeeded:
+            raise ValueError(f"消息发送失败：全部webhook发送失败。\n{summary}")
+        yield self.create_text_message(summary)
+        yield self.create_json_message({
+            "total": len(results),
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": [{"webhook_url": result.webhook_url, "success": result.ok,
+                         "error": None if result.ok else str(result.error)} for result in results],
+        })
 
 
-def send_message(webhook_url: str, message: str, secret: str, auto_convert_markdown_image_link: bool = True):
+def send_message(webhook_url: str, message: Union[str, PopoMessage], secret: str,
+                 auto_convert_markdown_image_link: bool = True):
     """
     发送消息到POPO自定义机器人
 
     :param auto_convert_markdown_image_link: 自动将markdown图片格式转换成popo所需的格式
     :param webhook_url: 机器人 webhook 地址（形如 https://open.popo.netease.com/...）
-    :param message: 要发送的消息内容
+    :param message: 要发送的消息内容，也可以是已经解析好的PopoMessage（与应用机器人共用）
     :param secret: 签名校验的密钥
     """
-
-    # 将markdown图片转换成popo所需的[img]xxx[/img]
-    if auto_convert_markdown_image_link:
-        pattern = r'!\[(.*?)]\(([^()]*(\([^()]*\)[^()]*)*)\)'
-        message = re.sub(pattern, r'[img]\2[/img]', message)
-
-    headers = {"Content-Type": "application/json"}
-    payload = {"message": message}
-
-    if secret:
-        # 生成时间戳（毫秒级）
-        timestamp = int(time.time() * 1000)
-        payload["timestamp"] = str(timestamp)
-
-        # 生成签名
-        string_to_sign = f"{timestamp}\n{secret}"
-        hmac_code = hmac.new(
-            string_to_sign.encode("utf-8"),
-            digestmod=hashlib.sha256
-        ).digest()
-        sign_data = base64.b64encode(hmac_code).decode("utf-8")
-        payload["signData"] = sign_data
-
-    response = requests.post(
-        webhook_url,
-        headers=headers,
-        data=json.dumps(payload)
-    )
-    response.raise_for_status()  # 检查 HTTP 错误状态码
-    result = response.json()
-    # 如果errcode不为0，则抛出异常
-
-    if result.get("errcode") != 0:
-        raise Exception(f"消息发送失败，错误码：{result.get('errcode')}，错误信息：{result.get('errmsg')}")
-    return result
+    # 共用连接池和签名缓存，请求都带超时，触发频率限制时退避重试
+    return get_webhook_client().send(webhook_url, message, secret, auto_convert_markdown_image_link)
 
 
 if __name__ == '__main__':